@@ -0,0 +1,106 @@
+import os
+import time
+import base64
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import httplib2
+from google_auth_httplib2 import AuthorizedHttp
+from googleapiclient.errors import HttpError
+
+# Calls per batch round trip. Google accepts up to 100 but advises staying at 50, bigger
+# batches tend to have their calls throttled individually.
+BATCH_SIZE = min(int(os.getenv("GMAIL_BATCH_SIZE", "50")), 100)
+# Concurrent attachment downloads per fetch
+ATTACHMENT_WORKERS = int(os.getenv("GMAIL_ATTACHMENT_WORKERS", "8"))
+# Throttled or failed calls of a batch are sent again in a later batch, this many times
+BATCH_RETRIES = 3
+RETRYABLE_STATUSES = (403, 429, 500, 502, 503)
+
+
+def list_history_message_ids(service, start_history_id):
+    """
+    Ids of the messages added since start_history_id in history order, following every
+    page, and the mailbox's current history id.
+    """
+    message_ids = {}
+    history_id = None
+    page_token = None
+    while True:
+        response = service.users().history().list(
+            userId='me',
+            startHistoryId=start_history_id,
+            historyTypes=['messageAdded'],
+            pageToken=page_token
+        ).execute()
+        for record in response.get("history", []):
+            for message in record.get("messages", []):
+                message_ids[message["id"]] = None
+        history_id = response.get("historyId", history_id)
+        page_token = response.get("nextPageToken")
+        if not page_token:
+            return list(message_ids), history_id
+
+
+def get_messages(service, message_ids, format='full'):
+    """
+    Returns {message_id: message} fetched BATCH_SIZE per HTTP round trip through the batch
+    endpoint. Messages gone in the meantime (404) are left out, replying to a mail changes
+    its id. Other failures are retried with backoff and raised once the retries run out.
+    """
+    messages = {}
+    pending = list(dict.fromkeys(message_ids))
+    for attempt in range(BATCH_RETRIES + 1):
+        failed = []
+        errors = []
+
+        def collect(request_id, response, exception):
+            if exception is None:
+                messages[request_id] = response
+            elif isinstance(exception, HttpError) and exception.resp.status == 404:
+                return
+            elif isinstance(exception, HttpError) and exception.resp.status in RETRYABLE_STATUSES:
+                failed.append(request_id)
+                errors.append(exception)
+            else:
+                raise exception
+
+        for start in range(0, len(pending), BATCH_SIZE):
+            batch = service.new_batch_http_request(callback=collect)
+            for message_id in pending[start:start + BATCH_SIZE]:
+                batch.add(service.users().messages().get(userId='me', id=message_id, format=format), request_id=message_id)
+            batch.execute()
+        if not failed:
+            return messages
+        if attempt == BATCH_RETRIES:
+            raise errors[0]
+        pending = failed
+        time.sleep(2 ** attempt)
+
+
+def get_attachments(service, credentials, wanted, handle=None):
+    """
+    Downloads the attachments in wanted, a list of (message_id, attachment_id), on up to
+    ATTACHMENT_WORKERS threads. Returns {(message_id, attachment_id): result} where result
+    is the decoded bytes, or what handle(key, data) returned for them when it is given, so
+    a caller can store each attachment without holding all of them in memory.
+    httplib2 connections are not thread safe, every worker authorizes its own.
+    """
+    local = threading.local()
+
+    def download(key):
+        http = getattr(local, "http", None)
+        if http is None:
+            http = local.http = AuthorizedHttp(credentials, http=httplib2.Http())
+        message_id, attachment_id = key
+        attachment = service.users().messages().attachments().get(
+            userId='me', messageId=message_id, id=attachment_id
+        ).execute(http=http, num_retries=BATCH_RETRIES)
+        data = base64.urlsafe_b64decode(attachment["data"].encode("UTF-8"))
+        return key, handle(key, data) if handle else data
+
+    wanted = list(dict.fromkeys(wanted))
+    if not wanted:
+        return {}
+    with ThreadPoolExecutor(max_workers=min(ATTACHMENT_WORKERS, len(wanted)), thread_name_prefix="GmailAttachment") as pool:
+        return dict(pool.map(download, wanted))
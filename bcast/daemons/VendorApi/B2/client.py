@@ -0,0 +1,36 @@
+import os
+import threading
+
+import boto3
+from botocore.client import Config
+
+# HTTP connections kept per client, upload threads of every worker share them
+MAX_POOL_CONNECTIONS = int(os.getenv("S3_MAX_POOL_CONNECTIONS", "50"))
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_s3_client(endpoint_url, access_key_id, secret_access_key, region_name='us-west-002'):
+    """
+    Returns the process wide S3 client for these credentials, building it on first use.
+    Building a client loads the botocore service models and opens a new connection pool,
+    so it is done once per endpoint and credentials instead of per upload or signed url.
+    boto3 clients are thread safe, sessions are not, hence a session per client.
+    """
+    key = (endpoint_url, access_key_id, secret_access_key, region_name)
+    client = _clients.get(key)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(key)
+            if client is None:
+                client = boto3.session.Session().client(
+                    's3',
+                    endpoint_url=endpoint_url,
+                    aws_access_key_id=access_key_id,
+                    aws_secret_access_key=secret_access_key,
+                    config=Config(signature_version="s3v4", max_pool_connections=MAX_POOL_CONNECTIONS),
+                    region_name=region_name
+                )
+                _clients[key] = client
+    return client
@@ -0,0 +1,656 @@
+"""
+End-to-end benchmark of the webhook -> kafka -> conversation daemon pipeline.
+
+Replays generated WhatsApp (text, image, status receipt), Messenger and Gmail webhooks through
+webhook-server.py into a WhatsAppKafkaConsumer running in this process, and reports
+throughput and p50/p99 latency per message type.
+
+Gmail mails are delivered to a fake mailbox and announced by a push to /webhook/gmail/push, so
+the gmail numbers include the push queue, the fetch workers' history, batch and attachment
+calls and the parking of attachments. A message is done when the daemon emits its socket
+event (whatsapp_chat, or whatsapp_chat_media for the image upload) or, for status receipts,
+when the receipt shows up on the message row.
+
+Everything runs against local stand-ins, never point it at production services:
+    - kafka on localhost:9092, which webhook-server.py produces to
+      (docker run -p 9092:9092 apache/kafka)
+    - a scratch postgres with the django migrations applied, PG_* as usual
+    - an S3 compatible store for the B2_* settings, e.g. minio with a scratch bucket
+    - the Graph API, the Gmail API and the websocket server are faked inside this process
+
+The fixtures (owner, organization, platforms and the messages status receipts refer to) are
+created for the run and deleted afterwards. The same --seed generates the same traffic.
+
+    python benchmark_pipeline.py --messages 2000 --seed 7
+"""
+import os
+import sys
+import json
+import time
+import hmac
+import base64
+import uuid
+import random
+import hashlib
+import argparse
+import importlib.util
+import logging
+import subprocess
+import statistics
+import threading
+from collections import defaultdict
+from datetime import timedelta
+from email.parser import BytesParser
+from urllib.parse import urlsplit, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DAEMONS_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_DIR = os.path.dirname(DAEMONS_DIR)
+
+BENCH_SECRET = "benchmark-secret"
+BENCH_TOKEN = "benchmark-token"
+# Share of each message type in the generated traffic
+MESSAGE_MIX = (
+    ("whatsapp_text", 45),
+    ("whatsapp_image", 10),
+    ("whatsapp_status", 25),
+    ("messenger_text", 12),
+    ("gmail", 8),
+)
+STATUS_POLL_SECONDS = 0.02
+
+
+def status_message_id(run_id, index):
+    return f"wamid.bench.{run_id}.status.{index}"
+
+
+def fixture_names(run_id):
+    return {
+        "owner_email": f"owner-{run_id}@benchmark.local",
+        "organization": f"Benchmark {run_id}",
+        "whatsapp_login_id": f"bench-wa-{run_id}",
+        "messenger_login_id": f"bench-fb-{run_id}",
+        "gmail_login_id": f"inbox-{run_id}@benchmark.local",
+    }
+
+
+def run_fixtures(action, run_id, statuses):
+    """
+    Seeds or deletes the run's rows through the django models. Runs in a child process since
+    the project's VendorApi package would shadow the daemons' one.
+    """
+    sys.path.insert(0, PROJECT_DIR)
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "bcast.settings")
+    import django
+    django.setup()
+    from django.db import transaction
+    from django.utils import timezone
+    from manage_users.models import CustomUser, EnterpriseProfile
+    from manage_organization.models import Organization
+    from manage_platform.models import Platform, GmailAccount, GmailPushNotification
+    from manage_contact.models import Contact
+    from manage_conversation.models import Conversation, UserMessage
+
+    names = fixture_names(run_id)
+    if action == "cleanup":
+        # Everything else the run created hangs off the owner through cascading foreign keys
+        GmailPushNotification.objects.filter(email_address=names["gmail_login_id"]).delete()
+        CustomUser.objects.filter(email=names["owner_email"]).delete()
+        return
+
+    with transaction.atomic():
+        owner = CustomUser.objects.create_user(
+            phone_number=f"bench-{run_id}",
+            email=names["owner_email"],
+            username=f"bench-{run_id}",
+            user_type="owner"
+        )
+        organization = Organization.objects.create(name=names["organization"], owner=owner)
+        EnterpriseProfile.objects.create(user=owner, organization=organization)
+        platforms = {}
+        for platform_name, login_id in (
+            ("whatsapp", names["whatsapp_login_id"]),
+            ("messenger", names["messenger_login_id"]),
+            ("gmail", names["gmail_login_id"]),
+        ):
+            platforms[platform_name] = Platform.objects.create(
+                organization=organization,
+                owner=owner,
+                platform_name=platform_name,
+                user_platform_name=f"{platform_name} {run_id}",
+                login_id=login_id,
+                app_id="benchmark",
+                login_credentials=BENCH_TOKEN,
+                secret_key=BENCH_SECRET
+            )
+        # The fake mailbox starts at history id 0, the fetch workers read everything after it
+        GmailAccount.objects.create(
+            platform=platforms["gmail"],
+            email_address=names["gmail_login_id"],
+            access_token=BENCH_TOKEN,
+            refresh_token=BENCH_TOKEN,
+            token_expiry=timezone.now() + timedelta(days=1),
+            history_id="0"
+        )
+        # Status receipts move every message of a conversation, so each receipt gets its own
+        contacts = Contact.objects.bulk_create([
+            Contact(name=f"status-{index}", phone=f"bench-status-{index}", platform_name="whatsapp", created_by=owner, organization=organization)
+            for index in range(statuses)
+        ])
+        conversations = Conversation.objects.bulk_create([
+            Conversation(organization=organization, platform=platforms["whatsapp"], contact=contact, status="active", open_by="agent")
+            for contact in contacts
+        ])
+        UserMessage.objects.bulk_create([
+            UserMessage(
+                conversation=conversation,
+                organization=organization,
+                platform=platforms["whatsapp"],
+                user=owner,
+                message_body="benchmark",
+                status="sent",
+                messageid=status_message_id(run_id, index)
+            )
+            for index, conversation in enumerate(conversations)
+        ])
+
+
+class LatencyTracker:
+    """Send and completion times of every message, keyed by the token carried in its body"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.kinds = {}
+        self.sent = {}
+        self.completed = {}
+        self.media_tokens = {}
+        self.all_done = threading.Event()
+        self.expected = 0
+
+    def start(self, expected):
+        """Forgets earlier samples, all_done is set once expected messages completed"""
+        with self._lock:
+            self.kinds, self.sent, self.completed, self.media_tokens = {}, {}, {}, {}
+            self.expected = expected
+            self.all_done.clear()
+
+    def sent_now(self, token, kind):
+        with self._lock:
+            self.kinds[token] = kind
+            self.sent[token] = time.perf_counter()
+
+    def complete(self, token):
+        now = time.perf_counter()
+        with self._lock:
+            if token not in self.sent or token in self.completed:
+                return
+            self.completed[token] = now
+            if len(self.completed) >= self.expected:
+                self.all_done.set()
+
+    def on_chat(self, data):
+        token = find_token(data)
+        if token is None:
+            return
+        if data.get("media_pending"):
+            # The message is saved, the image itself is announced by whatsapp_chat_media
+            with self._lock:
+                self.media_tokens[data.get("message_id")] = token
+        self.complete(token)
+
+    def on_chat_media(self, data):
+        with self._lock:
+            token = self.media_tokens.pop(data.get("message_id"), None)
+        if token is not None:
+            self.complete(token + ":upload")
+
+    def pending(self, kind):
+        with self._lock:
+            return [token for token, token_kind in self.kinds.items() if token_kind == kind and token not in self.completed]
+
+    def report(self, started_at):
+        by_kind = defaultdict(list)
+        with self._lock:
+            for token, kind in self.kinds.items():
+                by_kind[kind].append((self.sent[token], self.completed.get(token)))
+        rows = []
+        for kind, samples in sorted(by_kind.items()):
+            latencies = sorted((done - sent) * 1000 for sent, done in samples if done is not None)
+            first_sent = min(sent for sent, _ in samples)
+            last_done = max((done for _, done in samples if done is not None), default=first_sent)
+            rows.append({
+                "type": kind,
+                "sent": len(samples),
+                "completed": len(latencies),
+                "throughput_per_s": round(len(latencies) / (last_done - first_sent), 1) if last_done > first_sent else 0,
+                "p50_ms": round(percentile(latencies, 50), 1) if latencies else None,
+                "p99_ms": round(percentile(latencies, 99), 1) if latencies else None,
+            })
+        with self._lock:
+            completed = list(self.completed.values())
+        total = {
+            "type": "total",
+            "sent": len(self.sent),
+            "completed": len(completed),
+            "throughput_per_s": round(len(completed) / (max(completed) - started_at), 1) if completed else 0,
+        }
+        return rows, total
+
+
+TOKEN_PREFIX = "bench-token-"
+
+
+def find_token(data):
+    for text in [data.get("message_body")] + [block.get("html") for block in data.get("content_blocks") or []]:
+        if isinstance(text, str) and TOKEN_PREFIX in text:
+            start = text.index(TOKEN_PREFIX)
+            end = start + len(TOKEN_PREFIX)
+            while end < len(text) and (text[end].isalnum() or text[end] == "-"):
+                end += 1
+            return text[start:end]
+    return None
+
+
+def percentile(values, pct):
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method="inclusive")[pct - 1]
+
+
+def start_fake_graph_api(seed, media_bytes):
+    """
+    Serves the two Graph API calls the daemon makes: the media url lookup and the
+    download behind it, and the messenger profile. Media content is derived from the seed.
+    """
+    class GraphApiHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            path = self.path.split("?", 1)[0].strip("/")
+            if path.startswith("download/"):
+                body = random.Random(f"{seed}:{path}").randbytes(media_bytes)
+                content_type = "image/jpeg"
+            elif path.startswith("media-"):
+                body = json.dumps({"url": f"http://127.0.0.1:{self.server.server_port}/download/{path}", "mime_type": "image/jpeg"}).encode()
+                content_type = "application/json"
+            else:
+                body = json.dumps({"first_name": f"Customer {path[-6:]}", "last_name": "Benchmark", "profile_pic": None}).encode()
+                content_type = "application/json"
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), GraphApiHandler)
+    threading.Thread(target=server.serve_forever, daemon=True, name="FakeGraphApi").start()
+    return server
+
+
+class FakeMailbox:
+    """The benchmark inbox the fake Gmail API serves, every delivered mail gets the next history id"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.history = []  # (history_id, message_id, thread_id) in delivery order
+        self.messages = {}
+        self.attachments = {}
+
+    def deliver(self, message, attachment=None):
+        """Stores a message resource, the attachment bytes under its part's attachmentId. Returns the new history id"""
+        with self._lock:
+            history_id = len(self.history) + 1
+            self.history.append((history_id, message["id"], message["threadId"]))
+            self.messages[message["id"]] = message
+            if attachment is not None:
+                for part in message["payload"]["parts"]:
+                    if part["body"].get("attachmentId"):
+                        self.attachments[(message["id"], part["body"]["attachmentId"])] = attachment
+            return history_id
+
+    def history_since(self, start_history_id):
+        with self._lock:
+            return self.history[start_history_id:], len(self.history)
+
+
+def start_fake_gmail_api(mailbox):
+    """
+    Serves the Gmail API calls of the fetch workers from the mailbox: history.list, messages.get
+    through the batch endpoint and attachments.get.
+    """
+    class GmailApiHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            status, body = self.route(self.path)
+            self.send(status, "application/json; charset=UTF-8", json.dumps(body).encode())
+
+        def do_POST(self):
+            if urlsplit(self.path).path.rstrip("/") != "/batch/gmail/v1":
+                return self.send(404, "application/json", b"{}")
+            content_type = self.headers["Content-Type"]
+            request_body = self.rfile.read(int(self.headers["Content-Length"]))
+            batch = BytesParser().parsebytes(f"Content-Type: {content_type}\r\n\r\n".encode() + request_body)
+            boundary = f"batch_{uuid.uuid4().hex}"
+            parts = []
+            for part in batch.get_payload():
+                # Every part is an HTTP request line and headers, the response echoes its Content-ID
+                method, path, _ = part.get_payload().splitlines()[0].split(" ", 2)
+                status, body = self.route(path)
+                parts.append(
+                    f"--{boundary}\r\nContent-Type: application/http\r\nContent-ID: <response-{part['Content-ID'][1:]}\r\n\r\n"
+                    f"HTTP/1.1 {status} {'OK' if status == 200 else 'Not Found'}\r\nContent-Type: application/json; charset=UTF-8\r\n\r\n"
+                    f"{json.dumps(body)}\r\n"
+                )
+            self.send(200, f"multipart/mixed; boundary={boundary}", ("".join(parts) + f"--{boundary}--\r\n").encode())
+
+        def route(self, target):
+            url = urlsplit(target)
+            path = url.path.strip("/").split("/")
+            query = parse_qs(url.query)
+            # gmail/v1/users/me/...
+            if path[4:5] == ["history"]:
+                records, history_id = mailbox.history_since(int(query["startHistoryId"][0]))
+                return 200, {
+                    "history": [{"id": str(record_id), "messages": [{"id": message_id, "threadId": thread_id}]} for record_id, message_id, thread_id in records],
+                    "historyId": str(history_id)
+                }
+            if path[4:5] == ["messages"] and len(path) == 6:
+                message = mailbox.messages.get(path[5])
+                return (200, message) if message is not None else (404, {"error": {"code": 404, "message": "Not Found"}})
+            if path[4:5] == ["messages"] and path[6:7] == ["attachments"]:
+                data = mailbox.attachments.get((path[5], path[7]))
+                if data is not None:
+                    return 200, {"size": len(data), "data": base64.urlsafe_b64encode(data).decode()}
+            return 404, {"error": {"code": 404, "message": "Not Found"}}
+
+        def send(self, status, content_type, body):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), GmailApiHandler)
+    threading.Thread(target=server.serve_forever, daemon=True, name="FakeGmailApi").start()
+    return server
+
+
+def start_socket_sink(tracker):
+    """Stands in for the websocket server and hands the daemon's events to the tracker"""
+    import socketio
+    from werkzeug.serving import make_server
+
+    sink = socketio.Server(async_mode="threading")
+
+    @sink.on("whatsapp_chat")
+    def on_chat(sid, data):
+        tracker.on_chat(data)
+
+    @sink.on("whatsapp_chat_media")
+    def on_chat_media(sid, data):
+        tracker.on_chat_media(data)
+
+    server = make_server("127.0.0.1", 0, socketio.WSGIApp(sink), threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True, name="SocketSink").start()
+    return server
+
+
+def poll_status_receipts(tracker, db_params, stop):
+    import psycopg2
+    conn = psycopg2.connect(**db_params)
+    conn.autocommit = True
+    try:
+        while not stop.is_set():
+            pending = tracker.pending("whatsapp_status")
+            if pending:
+                with conn.cursor() as cursor:
+                    cursor.execute(
+                        "SELECT messageid FROM manage_conversation_usermessage WHERE messageid = ANY(%s) AND status = 'delivered'",
+                        (pending,)
+                    )
+                    for (message_id,) in cursor.fetchall():
+                        tracker.complete(message_id)
+            time.sleep(STATUS_POLL_SECONDS)
+    finally:
+        conn.close()
+
+
+def skip_to_topic_end(bootstrap_servers, topic, group_id):
+    """Commits the end of the topic for the run's group so earlier traffic is not replayed"""
+    from confluent_kafka import Consumer, TopicPartition
+    consumer = Consumer({"bootstrap.servers": bootstrap_servers, "group.id": group_id, "enable.auto.commit": False})
+    try:
+        metadata = consumer.list_topics(topic, timeout=10)
+        offsets = []
+        topic_metadata = metadata.topics.get(topic)
+        for partition in (topic_metadata.partitions if topic_metadata else ()):
+            _, high = consumer.get_watermark_offsets(TopicPartition(topic, partition), timeout=10)
+            offsets.append(TopicPartition(topic, partition, high))
+        if offsets:
+            consumer.commit(offsets=offsets, asynchronous=False)
+    finally:
+        consumer.close()
+
+
+class TrafficGenerator:
+    """Builds provider webhook payloads from a seeded random generator"""
+    def __init__(self, seed, run_id, customers):
+        self.random = random.Random(seed)
+        self.run_id = run_id
+        self.names = fixture_names(run_id)
+        self.customers = [f"91{self.random.randrange(10**9, 10**10)}" for _ in range(customers)]
+        self.page_scoped_ids = [str(self.random.randrange(10**15, 10**16)) for _ in range(customers)]
+        self.statuses_sent = 0
+
+    def plan(self, messages):
+        kinds = [kind for kind, _ in MESSAGE_MIX]
+        weights = [weight for _, weight in MESSAGE_MIX]
+        return self.random.choices(kinds, weights=weights, k=messages)
+
+    def text(self):
+        words = ("order", "refund", "delivery", "invoice", "hello", "price", "status", "thanks", "urgent", "help")
+        return " ".join(self.random.choice(words) for _ in range(self.random.randint(3, 30)))
+
+    def whatsapp(self, value):
+        value = {"messaging_product": "whatsapp", "metadata": {"display_phone_number": "15550000000", "phone_number_id": self.names["whatsapp_login_id"]}, **value}
+        return {"object": "whatsapp_business_account", "entry": [{"id": "benchmark", "changes": [{"field": "messages", "value": value}]}]}
+
+    def whatsapp_text(self, token):
+        sender = self.random.choice(self.customers)
+        return self.whatsapp({
+            "contacts": [{"profile": {"name": sender}, "wa_id": sender}],
+            "messages": [{"from": sender, "id": f"wamid.{token}", "timestamp": str(int(time.time())), "type": "text", "text": {"body": f"{token} {self.text()}"}}]
+        })
+
+    def whatsapp_image(self, token):
+        sender = self.random.choice(self.customers)
+        return self.whatsapp({
+            "contacts": [{"profile": {"name": sender}, "wa_id": sender}],
+            "messages": [{
+                "from": sender, "id": f"wamid.{token}", "timestamp": str(int(time.time())), "type": "image",
+                "image": {"id": f"media-{token}", "mime_type": "image/jpeg", "sha256": hashlib.sha256(token.encode()).hexdigest(), "caption": token}
+            }]
+        })
+
+    def whatsapp_status(self):
+        message_id = status_message_id(self.run_id, self.statuses_sent)
+        self.statuses_sent += 1
+        payload = self.whatsapp({
+            "statuses": [{"id": message_id, "status": "delivered", "timestamp": str(int(time.time())), "recipient_id": self.random.choice(self.customers)}]
+        })
+        return message_id, payload
+
+    def messenger_text(self, token):
+        sender = self.random.choice(self.page_scoped_ids)
+        now_ms = int(time.time() * 1000)
+        return {"object": "page", "entry": [{"id": self.names["messenger_login_id"], "time": now_ms, "messaging": [{
+            "sender": {"id": sender}, "recipient": {"id": self.names["messenger_login_id"]}, "timestamp": now_ms,
+            "message": {"mid": f"m_{token}", "text": f"{token} {self.text()}"}
+        }]}]}
+
+    def gmail(self, token):
+        """A Gmail API message resource in format=full, and the bytes of its attachment if it has one"""
+        sender = self.random.choice(self.customers)
+        html = f"<div><p>{token}</p><p>{self.text()}</p></div>"
+        parts = [{"partId": "0", "mimeType": "text/html", "filename": "", "body": {"size": len(html), "data": base64.urlsafe_b64encode(html.encode()).decode()}}]
+        attachment = None
+        if self.random.random() < 0.3:
+            attachment = self.random.randbytes(self.random.randint(1, 64) * 1024)
+            parts.append({"partId": "1", "mimeType": "application/octet-stream", "filename": f"{token}.bin", "body": {"size": len(attachment), "attachmentId": f"attachment-{token}"}})
+        return {
+            "id": token,
+            "threadId": token,
+            "internalDate": str(int(time.time() * 1000)),
+            "payload": {
+                "mimeType": "multipart/mixed",
+                "headers": [
+                    {"name": "From", "value": f"Customer <{sender}@customer.local>"},
+                    {"name": "To", "value": self.names["gmail_login_id"]},
+                    {"name": "Subject", "value": f"Re: {self.text()[:40]}"},
+                    {"name": "Message-ID", "value": f"<{token}@customer.local>"},
+                ],
+                "parts": parts
+            }
+        }, attachment
+
+    def gmail_push(self, history_id):
+        data = json.dumps({"emailAddress": self.names["gmail_login_id"], "historyId": history_id}).encode()
+        return {"message": {"data": base64.b64encode(data).decode(), "messageId": uuid.uuid4().hex}, "subscription": "projects/benchmark/subscriptions/gmail"}
+
+
+def load_webhook_server():
+    spec = importlib.util.spec_from_file_location("webhook_server", os.path.join(DAEMONS_DIR, "webhook-server.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def post_signed(client, path, payload):
+    body = json.dumps(payload).encode()
+    signature = hmac.new(BENCH_SECRET.encode(), msg=body, digestmod=hashlib.sha256).hexdigest()
+    response = client.post(path, data=body, content_type="application/json", headers={"X-Hub-Signature-256": f"sha256={signature}"})
+    if response.status_code != 200:
+        raise Exception(f"Webhook {path} answered {response.status_code}: {response.get_data(as_text=True)}")
+
+
+def post_push(client, path, payload):
+    """Pub/Sub pushes carry no provider signature"""
+    response = client.post(path, data=json.dumps(payload), content_type="application/json")
+    if response.status_code != 200:
+        raise Exception(f"Webhook {path} answered {response.status_code}: {response.get_data(as_text=True)}")
+
+
+def run_fixture_process(action, run_id, statuses):
+    subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--fixtures", action, "--run-id", run_id, "--statuses", str(statuses)],
+        cwd=PROJECT_DIR,
+        check=True
+    )
+
+
+def main(args):
+    run_id = uuid.uuid4().hex[:8]
+    generator = TrafficGenerator(args.seed, run_id, args.customers)
+    plan = generator.plan(args.messages)
+    tracker = LatencyTracker()
+
+    graph_api = start_fake_graph_api(args.seed, args.media_kb * 1024)
+    mailbox = FakeMailbox()
+    gmail_api = start_fake_gmail_api(mailbox)
+    socket_sink = start_socket_sink(tracker)
+    os.environ["GRAPH_API_URL"] = f"http://127.0.0.1:{graph_api.server_port}"
+    os.environ["GMAIL_API_URL"] = f"http://127.0.0.1:{gmail_api.server_port}"
+    # The fixture's access token never expires, these are only read to build the credentials
+    os.environ.setdefault("GOOGLE_CLIENT_ID", "benchmark")
+    os.environ.setdefault("GOOGLE_CLIENT_SECRET", "benchmark")
+    os.environ["SOCKET_URL"] = f"http://127.0.0.1:{socket_sink.server_port}?token={{access_token}}"
+    os.environ["KAFKA_CONFIG_GRP_ID"] = f"benchmark-{run_id}"
+    os.environ.setdefault("SERVER", "localhost:9092")
+    os.environ["KAFKA_STARTUP_WAIT_SECONDS"] = "0"
+    os.environ["METRICS_PORT"] = "0"
+
+    run_fixture_process("seed", run_id, plan.count("whatsapp_status"))
+    stop = threading.Event()
+    try:
+        import start_conversation_tasks
+        webhook_server = load_webhook_server()
+        skip_to_topic_end(os.environ["SERVER"], webhook_server.TOPIC, os.environ["KAFKA_CONFIG_GRP_ID"])
+        consumer = start_conversation_tasks.WhatsAppKafkaConsumer()
+        logging.getLogger().setLevel(args.log_level)
+        threading.Thread(target=consumer.consume, daemon=True, name="KafkaConsumer").start()
+        threading.Thread(target=poll_status_receipts, args=(tracker, consumer.db_params, stop), daemon=True, name="StatusPoller").start()
+        client = webhook_server.app.test_client()
+
+        # The first message waits for the group to be assigned its partitions, keep it out of the results
+        warmup = f"{TOKEN_PREFIX}{run_id}-warmup"
+        tracker.start(1)
+        tracker.sent_now(warmup, "warmup")
+        post_signed(client, "/whatsapp", generator.whatsapp_text(warmup))
+        if not tracker.all_done.wait(args.timeout):
+            raise Exception("The consumer did not process the warm up message, is kafka running?")
+
+        tracker.start(len(plan) + plan.count("whatsapp_image"))
+
+        interval = 1 / args.rate if args.rate else 0
+        started_at = time.perf_counter()
+        for index, kind in enumerate(plan):
+            token = f"{TOKEN_PREFIX}{run_id}-{index}"
+            if kind == "whatsapp_status":
+                message_id, payload = generator.whatsapp_status()
+                tracker.sent_now(message_id, kind)
+                post_signed(client, "/whatsapp", payload)
+            elif kind == "whatsapp_image":
+                tracker.sent_now(token, kind)
+                tracker.sent_now(token + ":upload", "whatsapp_image_upload")
+                post_signed(client, "/whatsapp", generator.whatsapp_image(token))
+            elif kind == "messenger_text":
+                tracker.sent_now(token, kind)
+                post_signed(client, "/messenger", generator.messenger_text(token))
+            elif kind == "gmail":
+                message, attachment = generator.gmail(token)
+                tracker.sent_now(token, kind)
+                history_id = mailbox.deliver(message, attachment)
+                post_push(client, "/webhook/gmail/push", generator.gmail_push(history_id))
+            else:
+                tracker.sent_now(token, kind)
+                post_signed(client, "/whatsapp", generator.whatsapp_text(token))
+            if interval:
+                time.sleep(max(0, started_at + (index + 1) * interval - time.perf_counter()))
+        webhook_server.producer.flush()
+
+        if not tracker.all_done.wait(args.timeout):
+            print(f"Timed out after {args.timeout}s, {len(tracker.completed)}/{tracker.expected} messages completed")
+        rows, total = tracker.report(started_at)
+        print(f"\nrun {run_id}, seed {args.seed}, {args.messages} messages, {args.media_kb}KB media\n")
+        print(f"{'type':<24}{'sent':>8}{'done':>8}{'msg/s':>10}{'p50 ms':>10}{'p99 ms':>10}")
+        for row in rows + [total]:
+            print(f"{row['type']:<24}{row['sent']:>8}{row['completed']:>8}{row['throughput_per_s']:>10}{str(row.get('p50_ms', '')):>10}{str(row.get('p99_ms', '')):>10}")
+        if args.json:
+            with open(args.json, "w") as out:
+                json.dump({"run_id": run_id, "seed": args.seed, "messages": args.messages, "results": rows + [total]}, out, indent=2)
+    finally:
+        stop.set()
+        if not args.keep_fixtures:
+            run_fixture_process("cleanup", run_id, 0)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the webhook -> kafka -> conversation daemon pipeline")
+    parser.add_argument("--messages", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--customers", type=int, default=200, help="distinct senders the traffic is spread over")
+    parser.add_argument("--rate", type=float, default=0, help="messages per second to send, 0 sends as fast as possible")
+    parser.add_argument("--media-kb", type=int, default=256)
+    parser.add_argument("--timeout", type=int, default=300, help="seconds to wait for the pipeline to drain")
+    parser.add_argument("--json", help="also write the results to this file")
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--keep-fixtures", action="store_true")
+    parser.add_argument("--fixtures", choices=("seed", "cleanup"), help=argparse.SUPPRESS)
+    parser.add_argument("--run-id", help=argparse.SUPPRESS)
+    parser.add_argument("--statuses", type=int, default=0, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.fixtures:
+        run_fixtures(args.fixtures, args.run_id, args.statuses)
+    else:
+        main(args)
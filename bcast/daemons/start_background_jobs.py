@@ -7,10 +7,10 @@ import logging
 import mimetypes
 import psycopg2
 from datetime import datetime, timedelta
-import boto3
-from botocore.client import Config
 from decouple import config
 
+from VendorApi.B2.client import get_s3_client
+
 os.environ["PG_DB"] = config("PG_DB")
 os.environ["PG_HOST"] = config("PG_HOST")
 os.environ["PG_PORT"] = config("PG_PORT")
@@ -41,13 +41,10 @@ def generate_presigned_url(object_key, expiry_seconds=3600):
     if content_type is None:
         content_type = 'application/octet-stream'
 
-    s3_client = boto3.client(
-        's3',
+    s3_client = get_s3_client(
         endpoint_url=os.environ["B2_ENDPOINT_URL"],
-        aws_access_key_id=os.environ["B2_ACCESS_KEY_ID"],
-        aws_secret_access_key=os.environ["B2_SECRET_ACCESS_KEY"],
-        config=Config(signature_version='s3v4'),
-        region_name='us-west-002'
+        access_key_id=os.environ["B2_ACCESS_KEY_ID"],
+        secret_access_key=os.environ["B2_SECRET_ACCESS_KEY"]
     )
 
     return s3_client.generate_presigned_url(
@@ -4,6 +4,7 @@ import time
 import logging
 import traceback
 from contextlib import contextmanager
+from functools import wraps
 from datetime import datetime, timedelta
 from io import BytesIO
 import sqlite3
@@ -12,19 +13,34 @@ import mimetypes
 import pytz
 import re
 import uuid
+import select
+import threading
+from threading import Thread
+import queue
+import zlib
+import heapq
+import itertools
+from collections import deque, OrderedDict
 from email.utils import parseaddr
 
 import jwt
+import orjson
+from cachetools import LRUCache, TTLCache
 import psycopg2
+from psycopg2 import pool as pg_pool
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE, TRANSACTION_STATUS_UNKNOWN
 from psycopg2.extras import RealDictCursor  # if using PostgreSQL
-import boto3
-from botocore.client import Config
+from psycopg2.extensions import cursor as PgCursor
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
 import socketio
 import requests
-from confluent_kafka import Consumer as ConfluentConsumer, KafkaError
+from confluent_kafka import Consumer as ConfluentConsumer, KafkaError, KafkaException, TopicPartition
 from decouple import config
 
 from VendorApi.Whatsapp.message import TextMessage
+from VendorApi.B2.client import get_s3_client
 
 AUTO_ASSIGNMENT_MSG = 'Thank you for reaching out!\n\nMr./Mrs. {consultant_name} is now assigned as your consultant for this conversation. Please feel free to reach out for any assistance.\n\n{organization_name}'
 
@@ -43,11 +59,128 @@ os.environ["B2_ENDPOINT_URL"] = config("B2_ENDPOINT_URL")
 os.environ["B2_ACCESS_KEY_ID"] = config("B2_ACCESS_KEY_ID")
 os.environ["B2_SECRET_ACCESS_KEY"] = config("B2_SECRET_ACCESS_KEY")
 os.environ["B2_STORAGE_BUCKET_NAME"] = config("B2_STORAGE_BUCKET_NAME")
-if os.getenv("PRODUCTION") == '1':
-    os.environ["SOCKET_URL"] = "https://websocket.jackdesk.com?token={access_token}"
-    #os.environ["SOCKET_URL"] = "http://localhost:5001?token={access_token}"
-else:
-    os.environ["SOCKET_URL"] = "https://websocket.jackdesk.com?token={access_token}"
+#os.environ["SOCKET_URL"] = "http://localhost:5001?token={access_token}"
+os.environ["SOCKET_URL"] = config("SOCKET_URL", default="https://websocket.jackdesk.com?token={access_token}")
+os.environ["GRAPH_API_URL"] = config("GRAPH_API_URL", default="https://graph.facebook.com/v18.0")
+os.environ["PG_POOL_MIN_CONN"] = config("PG_POOL_MIN_CONN", default="2")
+os.environ["PG_POOL_MAX_CONN"] = config("PG_POOL_MAX_CONN", default="10")
+os.environ["KAFKA_BATCH_SIZE"] = config("KAFKA_BATCH_SIZE", default="100")
+os.environ["KAFKA_BATCH_LINGER_MS"] = config("KAFKA_BATCH_LINGER_MS", default="200")
+os.environ["KAFKA_WORKER_LANES"] = config("KAFKA_WORKER_LANES", default="4")
+os.environ["KAFKA_MAX_IN_FLIGHT_BATCHES"] = config("KAFKA_MAX_IN_FLIGHT_BATCHES", default="4")
+os.environ["KAFKA_STARTUP_WAIT_SECONDS"] = config("KAFKA_STARTUP_WAIT_SECONDS", default="60")
+os.environ["METADATA_CACHE_SIZE"] = config("METADATA_CACHE_SIZE", default="10000")
+os.environ["METADATA_CACHE_TTL_SECONDS"] = config("METADATA_CACHE_TTL_SECONDS", default="300")
+os.environ["FOLDER_CACHE_SIZE"] = config("FOLDER_CACHE_SIZE", default="50000")
+os.environ["FOLDER_CACHE_TTL_SECONDS"] = config("FOLDER_CACHE_TTL_SECONDS", default="3600")
+os.environ["MEDIA_UPLOAD_PART_MB"] = config("MEDIA_UPLOAD_PART_MB", default="8")
+os.environ["MEDIA_UPLOAD_CONCURRENCY"] = config("MEDIA_UPLOAD_CONCURRENCY", default="2")
+os.environ["MEDIA_WORKERS"] = config("MEDIA_WORKERS", default="2")
+os.environ["MEDIA_QUEUE_SIZE"] = config("MEDIA_QUEUE_SIZE", default="100")
+os.environ["MEDIA_CLAIM_SECONDS"] = config("MEDIA_CLAIM_SECONDS", default="900")
+os.environ["MEDIA_SWEEP_INTERVAL_SECONDS"] = config("MEDIA_SWEEP_INTERVAL_SECONDS", default="30")
+os.environ["MEDIA_RETRY_BASE_SECONDS"] = config("MEDIA_RETRY_BASE_SECONDS", default="30")
+os.environ["MEDIA_MAX_ATTEMPTS"] = config("MEDIA_MAX_ATTEMPTS", default="6")
+os.environ["STATUS_RETRY_BASE_SECONDS"] = config("STATUS_RETRY_BASE_SECONDS", default="5")
+os.environ["STATUS_RETRY_MAX_ATTEMPTS"] = config("STATUS_RETRY_MAX_ATTEMPTS", default="5")
+os.environ["STATUS_RETRY_CLAIM_SECONDS"] = config("STATUS_RETRY_CLAIM_SECONDS", default="60")
+os.environ["SOCKET_EMIT_MAX_PENDING"] = config("SOCKET_EMIT_MAX_PENDING", default="10000")
+os.environ["SOCKET_EMIT_BATCH_SIZE"] = config("SOCKET_EMIT_BATCH_SIZE", default="100")
+os.environ["SOCKET_RECONNECT_DELAY_MAX"] = config("SOCKET_RECONNECT_DELAY_MAX", default="30")
+os.environ["INBOUND_DEDUP_CACHE_SIZE"] = config("INBOUND_DEDUP_CACHE_SIZE", default="100000")
+# 0 disables the metrics endpoint
+os.environ["METRICS_PORT"] = config("METRICS_PORT", default="9108")
+os.environ["METRICS_LAG_INTERVAL_SECONDS"] = config("METRICS_LAG_INTERVAL_SECONDS", default="15")
+
+# Media is streamed to B2 in fixed size multipart parts. A streamed body cannot be seeked, so
+# boto3 buffers the parts it read ahead, capped at one more than the parts being uploaded.
+MEDIA_UPLOAD_PART_BYTES = int(os.getenv("MEDIA_UPLOAD_PART_MB", "8")) * 1024 * 1024
+MEDIA_UPLOAD_CONCURRENCY = int(os.getenv("MEDIA_UPLOAD_CONCURRENCY", "2"))
+MEDIA_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=MEDIA_UPLOAD_PART_BYTES,
+    multipart_chunksize=MEDIA_UPLOAD_PART_BYTES,
+    max_concurrency=MEDIA_UPLOAD_CONCURRENCY,
+    max_in_memory_upload_chunks=MEDIA_UPLOAD_CONCURRENCY + 1
+)
+
+# status_details of an incoming media message until its upload completes, followed by
+# "<media_id>:<file name>" so the upload can be resumed after a restart
+MEDIA_PENDING_PREFIX = "media_pending:"
+
+# Highest schema_version header this consumer understands, see publish_message in webhook-server.py
+KAFKA_SCHEMA_VERSION = 1
+
+# Delivery receipts only move a message forward through these states
+WHATSAPP_STATUS_RANK = {"sent": 1, "delivered": 2, "read": 3, "failed": 4}
+
+# Must match METADATA_NOTIFY_CHANNEL in manage_platform/signals.py
+METADATA_NOTIFY_CHANNEL = "daemon_metadata_invalidation"
+
+# Prometheus metrics served on METRICS_PORT
+MESSAGES_CONSUMED = Counter(
+    "conversation_messages_consumed_total", "Kafka messages handed to the handlers",
+    ["app_name", "msg_from_type"]
+)
+CONSUMER_LAG = Gauge(
+    "conversation_consumer_lag", "Messages between the committed offset and the end of the partition",
+    ["topic", "partition"]
+)
+HANDLER_LATENCY = Histogram(
+    "conversation_handler_seconds", "Time spent in a message handler", ["handler"]
+)
+HANDLER_QUERIES = Histogram(
+    "conversation_handler_queries", "Database queries run by one handler call", ["handler"],
+    buckets=(1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+)
+HANDLER_DB_TIME = Histogram(
+    "conversation_handler_db_seconds", "Time a handler call spent waiting on the database", ["handler"]
+)
+STATUS_RETRY_DEPTH = Gauge("conversation_status_retry_depth", "Status notifications waiting for a retry")
+MEDIA_QUEUE_DEPTH = Gauge("conversation_media_queue_depth", "Media uploads waiting for a media worker")
+MEDIA_UPLOADED_BYTES = Counter("conversation_media_uploaded_bytes_total", "Bytes of media streamed to B2")
+MEDIA_UPLOAD_LATENCY = Histogram(
+    "conversation_media_upload_seconds", "Time to stream one media file to B2",
+    buckets=(0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+)
+SOCKET_EMIT_PENDING = Gauge("conversation_socket_emit_pending", "Socket notifications waiting to be sent")
+SOCKET_EMIT_FAILURES = Counter("conversation_socket_emit_failures_total", "Socket notifications that failed to send")
+SOCKET_EMIT_DROPPED = Counter("conversation_socket_emit_dropped_total", "Socket notifications dropped from a full queue")
+GMAIL_ATTACHMENTS_MISSING = Counter("conversation_gmail_attachments_missing_total", "Gmail attachments saved as missing since their claim was gone")
+
+# Per thread count and duration of the queries run through CountingCursor
+query_stats = threading.local()
+
+
+class MissingAttachmentClaim(Exception):
+    """The object a gmail attachment was parked under is gone, e.g. expired by the lifecycle rule"""
+
+
+class CountingCursor(PgCursor):
+    """psycopg2 cursor recording how many queries the current thread ran and how long they took"""
+    def execute(self, query, vars=None):
+        started = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            query_stats.queries = getattr(query_stats, "queries", 0) + 1
+            query_stats.seconds = getattr(query_stats, "seconds", 0.0) + time.perf_counter() - started
+
+
+def instrumented(handler):
+    """Records latency, query count and database time of every call of a handler"""
+    @wraps(handler)
+    def wrapper(*args, **kwargs):
+        queries = getattr(query_stats, "queries", 0)
+        db_seconds = getattr(query_stats, "seconds", 0.0)
+        started = time.perf_counter()
+        try:
+            return handler(*args, **kwargs)
+        finally:
+            HANDLER_LATENCY.labels(handler=handler.__name__).observe(time.perf_counter() - started)
+            HANDLER_QUERIES.labels(handler=handler.__name__).observe(getattr(query_stats, "queries", 0) - queries)
+            HANDLER_DB_TIME.labels(handler=handler.__name__).observe(getattr(query_stats, "seconds", 0.0) - db_seconds)
+    return wrapper
+
 
 def generate_forever_token():
     payload = {
@@ -59,110 +192,765 @@ def generate_forever_token():
     return token
 
 
-class AutoAssigner:
-    def __init__(self, logger, param_style):
+def conversation_key(message):
+    """
+    Routing key of a kafka message, (platform login_id, customer id). The webhook producer
+    keys messages with the same value so a conversation always lands on one partition.
+    """
+    login_id = message.get("phone_number_id") or message.get("page_owner_id") or ""
+    sender = message.get("recipient_id") or message.get("sender_id") or ""
+    if isinstance(sender, dict):
+        sender = sender.get("id", "")
+    if message.get("app_name") == "GMAIL":
+        sender = parseaddr(sender)[1] or sender
+    return f"{login_id}:{sender}"
+
+
+class CountingReader:
+    """
+    Read only file like wrapper that counts the bytes going through it, so the size of a
+    streamed upload is known once the upload completes.
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.bytes_read += len(data)
+        return data
+
+
+class BatchTracker:
+    """Completion state of one kafka batch that was split across worker lanes"""
+    def __init__(self, msgs, pending_lanes):
+        self.msgs = msgs
+        self.ok = True
+        self._pending_lanes = pending_lanes
+        self._lock = threading.Lock()
+        self.done = threading.Event()
+        if pending_lanes == 0:
+            self.done.set()
+
+    def lane_finished(self, ok):
+        with self._lock:
+            self.ok = self.ok and ok
+            self._pending_lanes -= 1
+            if self._pending_lanes == 0:
+                self.done.set()
+
+
+class ConversationWorkerPool:
+    """
+    Fixed set of worker lanes, each one a single thread draining its own queue.
+    Messages of a conversation always hash onto the same lane so they are handled in
+    order, while different conversations and organizations run in parallel.
+    """
+    def __init__(self, logger, lanes, process_batch):
         self.logger = logger
-        self.param = param_style  # '?' or '%s'
+        self.process_batch = process_batch
+        self.queues = [queue.Queue() for _ in range(lanes)]
+        for index, lane_queue in enumerate(self.queues):
+            Thread(target=self.run_lane, args=(lane_queue,), daemon=True, name=f"ConversationLane-{index}").start()
+
+    def lane_for(self, key):
+        # crc32 instead of hash() since the latter is salted per process
+        return zlib.crc32(key.encode("utf-8")) % len(self.queues)
+
+    def submit(self, msgs, routed):
+        """
+        Splits a batch across lanes, keeping kafka order within each lane. Lanes get the
+        (route, raw value, decoded value) of each message. Bodies are decoded by the lane that
+        handles them, unless routing an unkeyed message needed them decoded here already.
+        """
+        per_lane = {}
+        for msg, route in routed:
+            message_value = None
+            if msg.key():
+                key = msg.key().decode("utf-8")
+            else:
+                # Published unkeyed (KAFKA_KEY_SCHEME=none or older producers), undecodable ones fail in their lane
+                try:
+                    message_value = orjson.loads(msg.value())
+                    key = conversation_key(message_value)
+                except orjson.JSONDecodeError:
+                    key = ""
+            per_lane.setdefault(self.lane_for(key), []).append((route, msg.value(), message_value))
+        tracker = BatchTracker(msgs, pending_lanes=len(per_lane))
+        for lane, messages in per_lane.items():
+            self.queues[lane].put((tracker, messages))
+        return tracker
+
+    def run_lane(self, lane_queue):
+        while True:
+            tracker, messages = lane_queue.get()
+            ok = False
+            try:
+                ok = self.process_batch(messages)
+            except Exception as e:
+                self.logger.critical("Error in conversation lane: %s", e, exc_info=True)
+            finally:
+                tracker.lane_finished(ok)
+
+
+class MediaWorkerPool:
+    """
+    Bounded pool of threads downloading and uploading media, kept apart from the
+    conversation lanes so a large attachment never holds up the text behind it.
+    submit() blocks once queue_size jobs are waiting, pushing back on the lanes.
+    """
+    def __init__(self, logger, workers, queue_size):
+        self.logger = logger
+        self.jobs = queue.Queue(maxsize=queue_size)
+        for index in range(workers):
+            Thread(target=self.run_worker, daemon=True, name=f"MediaWorker-{index}").start()
+
+    def submit(self, job, *args):
+        self.jobs.put((job, args))
+
+    def run_worker(self):
+        while True:
+            job, args = self.jobs.get()
+            try:
+                job(*args)
+            except Exception as e:
+                self.logger.error("Error in media worker: %s", e, exc_info=True)
 
-    def get_organization_config(self, cursor, org_id):
-        cursor.execute(
-            f"SELECT auto_allocation_enabled, auto_allocation_algorithm, owner_id FROM manage_organization_organization WHERE id = {self.param}",
-            (org_id,)
-        )
-        return cursor.fetchone()
+
+class RetryScheduler:
+    """
+    Min-heap of retries ordered by due time, drained by one thread that sleeps until the
+    earliest one is due. The retries themselves are stored in a table, the heap only
+    holds when to look at them so it can be rebuilt from the table after a restart.
+    A retry is scheduled once per args, scheduling it again moves it and cancel() drops it.
+    """
+    def __init__(self, logger, run_retry):
+        self.logger = logger
+        self.run_retry = run_retry
+        self._heap = []
+        # Due time of every scheduled retry by its args, heap entries not matching it are stale
+        self._due = {}
+        # Tie breaker so entries due at the same time never compare their args
+        self._sequence = itertools.count()
+        self._wakeup = threading.Condition()
+        Thread(target=self.run, daemon=True, name="RetryScheduler").start()
+
+    def __len__(self):
+        return len(self._due)
+
+    def schedule(self, due_at, *args):
+        """due_at is an epoch timestamp"""
+        with self._wakeup:
+            self._due[args] = due_at
+            heapq.heappush(self._heap, (due_at, next(self._sequence), args))
+            self._wakeup.notify()
+
+    def cancel(self, *args):
+        with self._wakeup:
+            self._due.pop(args, None)
+
+    def run(self):
+        while True:
+            with self._wakeup:
+                while True:
+                    # Entries of cancelled or moved retries are dropped as they come up
+                    while self._heap and self._due.get(self._heap[0][2]) != self._heap[0][0]:
+                        heapq.heappop(self._heap)
+                    if self._heap and self._heap[0][0] <= time.time():
+                        break
+                    self._wakeup.wait(timeout=self._heap[0][0] - time.time() if self._heap else None)
+                _, _, args = heapq.heappop(self._heap)
+                del self._due[args]
+            try:
+                self.run_retry(*args)
+            except Exception as e:
+                self.logger.error("Error running retry %s: %s", args, e, exc_info=True)
+
+
+class SocketEmitter:
+    """
+    Sends socket.io notifications from a background thread so handlers never wait on the
+    websocket server. A queued notification is replaced by a newer one with the same
+    coalesce key. While the socket is down notifications are held, dropping the oldest
+    once max_pending are waiting.
+    Up to batch_size notifications are taken off the queue per lock acquisition, each is
+    still sent as an event of its own since the websocket server has no batched event.
+    """
+    def __init__(self, logger, sio, max_pending, batch_size):
+        self.logger = logger
+        self.sio = sio
+        self.max_pending = max_pending
+        self.batch_size = batch_size
+        self.dropped = 0
+        self._pending = OrderedDict()
+        # Key of notifications that are never coalesced
+        self._sequence = itertools.count()
+        self._wakeup = threading.Condition()
+        Thread(target=self.run, daemon=True, name="SocketEmitter").start()
+
+    def emit(self, event, payload, coalesce_key=None):
+        key = (event, coalesce_key) if coalesce_key is not None else next(self._sequence)
+        with self._wakeup:
+            if key not in self._pending and len(self._pending) >= self.max_pending:
+                self._pending.popitem(last=False)
+                self.dropped += 1
+                SOCKET_EMIT_DROPPED.inc()
+                if self.dropped % 1000 == 1:
+                    self.logger.warning("Socket notification queue full, %d notifications dropped so far", self.dropped)
+            # Replacing an existing key keeps its place in the queue
+            self._pending[key] = (event, payload)
+            self._wakeup.notify()
+
+    def run(self):
+        while True:
+            with self._wakeup:
+                while not self._pending or not self.sio.connected:
+                    self._wakeup.wait(timeout=1)
+                batch = [self._pending.popitem(last=False) for _ in range(min(self.batch_size, len(self._pending)))]
+            for index, (key, (event, payload)) in enumerate(batch):
+                try:
+                    self.sio.emit(event, payload)
+                except Exception as e:
+                    SOCKET_EMIT_FAILURES.inc()
+                    self.logger.warning("Failed to emit %s: %s", event, e)
+                    if not self.sio.connected:
+                        self.requeue(batch[index:])
+                        break
+
+    def __len__(self):
+        return len(self._pending)
+
+    def requeue(self, batch):
+        """Puts notifications back at the front, unless a newer one with the same key arrived"""
+        with self._wakeup:
+            for key, item in reversed(batch):
+                if key not in self._pending:
+                    self._pending[key] = item
+                    self._pending.move_to_end(key, last=False)
+
+
+class PgConnectionPool:
+    """
+    Thread safe pool of long lived postgres connections shared by the kafka loop,
+    the socket.io callbacks and the retry worker. Checkout blocks when every
+    connection is busy instead of failing, and dead connections are replaced.
+    A thread already holding a connection may check out a second one, e.g. for a
+    transaction of its own next to the batch one. Threads holding none never take the
+    last connection, so such a nested checkout always gets one eventually instead of
+    every thread holding one connection while waiting for another.
+    """
+    # Connections idle longer than this are pinged before being handed out
+    PING_AFTER_IDLE_SECONDS = 30
+
+    def __init__(self, logger, minconn, maxconn, **conn_kwargs):
+        if maxconn < 2:
+            raise ValueError("PG_POOL_MAX_CONN must be at least 2, one connection is kept for nested checkouts")
+        self.logger = logger
+        self._pool = pg_pool.ThreadedConnectionPool(minconn, maxconn, **conn_kwargs)
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._outer_slots = threading.BoundedSemaphore(maxconn - 1)
+        self._last_used = {}
+        # Connections checked out by the current thread
+        self._held = threading.local()
+        # ids of the connections that took an outer slot
+        self._outer = set()
+
+    def _is_healthy(self, conn):
+        if conn.closed:
+            return False
+        if conn.get_transaction_status() == TRANSACTION_STATUS_UNKNOWN:
+            return False
+        if time.monotonic() - self._last_used.get(id(conn), 0) < self.PING_AFTER_IDLE_SECONDS:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def getconn(self):
+        outer = getattr(self._held, "count", 0) == 0
+        if outer:
+            self._outer_slots.acquire()
+        self._slots.acquire()
+        try:
+            # One retry is enough, the second connection handed out is a brand new one
+            # whenever the pool discarded the first.
+            for _ in range(2):
+                conn = self._pool.getconn()
+                if self._is_healthy(conn):
+                    self._held.count = getattr(self._held, "count", 0) + 1
+                    if outer:
+                        self._outer.add(id(conn))
+                    return conn
+                self.logger.warning("Discarding broken postgres connection from pool")
+                self._last_used.pop(id(conn), None)
+                self._pool.putconn(conn, close=True)
+            raise psycopg2.OperationalError("Unable to get a healthy postgres connection from pool")
+        except Exception:
+            self._slots.release()
+            if outer:
+                self._outer_slots.release()
+            raise
+
+    def putconn(self, conn, discard=False):
+        outer = id(conn) in self._outer
+        self._outer.discard(id(conn))
+        try:
+            if not discard and not conn.closed:
+                try:
+                    if conn.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+                        conn.rollback()
+                except psycopg2.Error:
+                    discard = True
+            discard = discard or bool(conn.closed)
+            if discard:
+                self._last_used.pop(id(conn), None)
+            else:
+                self._last_used[id(conn)] = time.monotonic()
+            self._pool.putconn(conn, close=discard)
+        finally:
+            self._held.count = getattr(self._held, "count", 1) - 1
+            self._slots.release()
+            if outer:
+                self._outer_slots.release()
+
+    def closeall(self):
+        self._pool.closeall()
+
+
+class MetadataCache:
+    """
+    TTL + LRU cache of the platform, organization, owner email, blocked contact and
+    employee rows every inbound handler looks up. Misses are loaded with the caller's cursor, entries
+    are dropped when django NOTIFYs a change on METADATA_NOTIFY_CHANNEL.
+    """
+    def __init__(self, logger, param_style, maxsize, ttl):
+        self.logger = logger
+        self.param = param_style  # '?' or '%s'
+        self._lock = threading.Lock()
+        # (id, owner_id, login_credentials, login_id, organization_id) keyed by login_id
+        self.platforms = TTLCache(maxsize=maxsize, ttl=ttl)
+        # webchat platform id keyed by organization_id
+        self.webchat_platforms = TTLCache(maxsize=maxsize, ttl=ttl)
+        # (id, owner_id, name) keyed by ("owner", owner_id) and ("id", organization_id)
+        self.organizations = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.owner_emails = TTLCache(maxsize=maxsize, ttl=ttl)
+        # frozenset of blocked contact values keyed by platform_id
+        self.blocked_contacts = TTLCache(maxsize=maxsize, ttl=ttl)
+        # ((user_id, username), ...) of the assignable employees keyed by organization_id
+        self.employees = TTLCache(maxsize=maxsize, ttl=ttl)
+        # Bumped by every invalidation, a lookup racing one must not cache what it read
+        self._generation = 0
+
+    def _get(self, cache, key):
+        """Returns the cached value and the generation a miss has to be filled under"""
+        with self._lock:
+            return cache.get(key), self._generation
+
+    def _set(self, cache, key, value, generation):
+        with self._lock:
+            if generation == self._generation:
+                cache[key] = value
+
+    def get_platform_by_login_id(self, cursor, login_id):
+        row, generation = self._get(self.platforms, login_id)
+        if row is None:
+            cursor.execute(f"""
+                SELECT id, owner_id, login_credentials, login_id, organization_id
+                FROM manage_platform_platform WHERE login_id={self.param}
+            """, (login_id,))
+            row = cursor.fetchone()
+            if row:
+                self._set(self.platforms, login_id, tuple(row), generation)
+        return row
+
+    def get_webchat_platform_id(self, cursor, organization_id):
+        platform_id, generation = self._get(self.webchat_platforms, organization_id)
+        if platform_id is None:
+            cursor.execute(f"SELECT id FROM manage_platform_platform WHERE platform_name={self.param} AND organization_id={self.param}", ('webchat', organization_id))
+            row = cursor.fetchone()
+            if not row:
+                return None
+            platform_id = row[0]
+            self._set(self.webchat_platforms, organization_id, platform_id, generation)
+        return platform_id
+
+    def _get_organization(self, cursor, key_kind, column, value):
+        row, generation = self._get(self.organizations, (key_kind, value))
+        if row is None:
+            cursor.execute(f"SELECT id, owner_id, name FROM manage_organization_organization WHERE {column}={self.param}", (value,))
+            row = cursor.fetchone()
+            if row:
+                row = tuple(row)
+                with self._lock:
+                    if generation == self._generation:
+                        self.organizations[("id", row[0])] = row
+                        self.organizations[("owner", row[1])] = row
+        return row
+
+    def get_organization_by_owner(self, cursor, owner_id):
+        return self._get_organization(cursor, "owner", "owner_id", owner_id)
+
+    def get_organization(self, cursor, organization_id):
+        return self._get_organization(cursor, "id", "id", organization_id)
+
+    def get_owner_email(self, cursor, owner_id):
+        """Email of a platform owner, who must be registered as an enterprise user"""
+        email, generation = self._get(self.owner_emails, owner_id)
+        if email is None:
+            cursor.execute(f"""
+                SELECT u.email, ep.user_id
+                FROM manage_users_customuser u
+                LEFT JOIN manage_users_enterpriseprofile ep ON ep.user_id = u.id
+                WHERE u.id={self.param}
+            """, (owner_id,))
+            row = cursor.fetchone()
+            if not row:
+                raise Exception("User not found in main user profile")
+            if row[1] is None:
+                self.logger.warning("Enterprise profile not found for owner_id: %s", owner_id)
+                raise Exception("User not registered as enterprise")
+            email = row[0]
+            self._set(self.owner_emails, owner_id, email, generation)
+        return email
 
     def get_employees(self, cursor, org_id, owner_id):
+        """Returns ((user_id, username), ...) of the employees conversations can be assigned to"""
+        employees, generation = self._get(self.employees, org_id)
+        if employees is not None:
+            return employees
         excluded_types = ('individual', 'agent', 'intern', 'manager', 'nontech')
         param_placeholders = ', '.join([self.param] * len(excluded_types))  # "%s, %s" or "?, ?"
         if owner_id:
             query = f"""
-                SELECT ep.user_id
+                SELECT ep.user_id, u.username
                 FROM manage_users_enterpriseprofile ep
                 INNER JOIN manage_users_customuser u ON ep.user_id = u.id
                 WHERE ep.organization_id = {self.param}
                   AND u.user_type NOT IN ({param_placeholders})
                   AND ep.user_id != {self.param}
+                ORDER BY ep.user_id
             """
             params = (org_id, *excluded_types, owner_id)
         else:
             query = f"""
-                SELECT ep.user_id
+                SELECT ep.user_id, u.username
                 FROM manage_users_enterpriseprofile ep
                 INNER JOIN manage_users_customuser u ON ep.user_id = u.id
                 WHERE ep.organization_id = {self.param}
                   AND u.user_type NOT IN ({param_placeholders})
+                ORDER BY ep.user_id
             """
             params = (org_id, *excluded_types)
         cursor.execute(query, params)
-        return [row[0] for row in cursor.fetchall()]
+        employees = tuple(tuple(row) for row in cursor.fetchall())
+        self._set(self.employees, org_id, employees, generation)
+        return employees
+
+    def is_blocked(self, cursor, platform_id, contact_value):
+        blocked, generation = self._get(self.blocked_contacts, platform_id)
+        if blocked is None:
+            cursor.execute(f"SELECT contact_value FROM manage_platform_blockedcontact WHERE platform_id={self.param}", (platform_id,))
+            blocked = frozenset(row[0] for row in cursor.fetchall())
+            self._set(self.blocked_contacts, platform_id, blocked, generation)
+        return contact_value in blocked
+
+    def invalidate(self, payload):
+        model = payload.get("model")
+        with self._lock:
+            self._generation += 1
+            if model == "platform":
+                platform_id = payload.get("id")
+                for login_id, row in list(self.platforms.items()):
+                    if row[0] == platform_id:
+                        self.platforms.pop(login_id, None)
+                self.webchat_platforms.pop(payload.get("organization_id"), None)
+                self.blocked_contacts.pop(platform_id, None)
+            elif model == "organization":
+                for key, row in list(self.organizations.items()):
+                    if row[0] == payload.get("id"):
+                        self.organizations.pop(key, None)
+                self.employees.pop(payload.get("id"), None)
+            elif model == "employee":
+                self.employees.pop(payload.get("organization_id"), None)
+            elif model == "blockedcontact":
+                self.blocked_contacts.pop(payload.get("platform_id"), None)
+            else:
+                self.clear_locked()
+
+    def clear_locked(self):
+        self._generation += 1
+        self.platforms.clear()
+        self.webchat_platforms.clear()
+        self.organizations.clear()
+        self.owner_emails.clear()
+        self.blocked_contacts.clear()
+        self.employees.clear()
+
+    def clear(self):
+        with self._lock:
+            self.clear_locked()
+
+    def listen_for_invalidations(self, connect):
+        """Blocking loop, LISTENs on its own connection and reconnects when it drops"""
+        while True:
+            conn = None
+            try:
+                conn = connect()
+                conn.set_session(autocommit=True)
+                with conn.cursor() as cursor:
+                    cursor.execute(f"LISTEN {METADATA_NOTIFY_CHANNEL}")
+                # Changes made while we were not listening are unknown
+                self.clear()
+                self.logger.info("Listening for metadata invalidations on %s", METADATA_NOTIFY_CHANNEL)
+                while True:
+                    if select.select([conn], [], [], 60) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        notify = conn.notifies.pop(0)
+                        try:
+                            self.invalidate(json.loads(notify.payload))
+                        except ValueError:
+                            self.clear()
+            except Exception as e:
+                self.logger.error("Metadata invalidation listener failed: %s", e, exc_info=True)
+                time.sleep(5)
+            finally:
+                if conn is not None:
+                    conn.close()
+
+
+class InboundDeduplicator:
+    """
+    Recognises inbound messages that were already saved by their provider message id.
+    Ids seen recently are answered from an in-process LRU, the others by the unique
+    (platform_id, messageid) index of manage_conversation_incomingmessage.
+    """
+    def __init__(self, param_style, maxsize):
+        self.param = param_style  # '?' or '%s'
+        self._lock = threading.Lock()
+        self._seen = LRUCache(maxsize=maxsize)
+
+    def is_duplicate(self, cursor, platform_id, provider_message_id):
+        if not provider_message_id:
+            return False
+        with self._lock:
+            if (platform_id, provider_message_id) in self._seen:
+                return True
+        cursor.execute(
+            f"SELECT 1 FROM manage_conversation_incomingmessage WHERE platform_id={self.param} AND messageid={self.param}",
+            (platform_id, provider_message_id)
+        )
+        if cursor.fetchone():
+            self.remember(platform_id, provider_message_id)
+            return True
+        return False
+
+    def remember(self, platform_id, provider_message_id):
+        """Called once the transaction that saved the message committed"""
+        if provider_message_id:
+            with self._lock:
+                self._seen[(platform_id, provider_message_id)] = True
+
+
+class FolderChainResolver:
+    """
+    Resolves the chain of folders a received media file is stored under. Folder ids are
+    cached by (owner_id, s3_key) so the common case costs a single primary key lookup that
+    makes sure none of them was deleted meanwhile, and missing levels are created together
+    in a single statement.
+    resolve() does not cache what it finds, the caller passes the ids to remember() once
+    the transaction that resolved them has committed.
+    """
+    # First key of the two int advisory lock taken while creating folders of an owner
+    ADVISORY_LOCK_NAMESPACE = 7301
+
+    def __init__(self, logger, param_style, maxsize, ttl):
+        self.logger = logger
+        self.param = param_style  # '?' or '%s'
+        self._lock = threading.Lock()
+        self.folder_ids = TTLCache(maxsize=maxsize, ttl=ttl)
+        # (user_id, organization_id, organization_name) keyed by user email
+        self.owners = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    def get_owner(self, cursor, email):
+        with self._lock:
+            owner = self.owners.get(email)
+        if owner is None:
+            cursor.execute(f"""
+                SELECT u.id, ep.organization_id, o.name
+                FROM manage_users_customuser u
+                JOIN manage_users_enterpriseprofile ep ON ep.user_id = u.id
+                JOIN manage_organization_organization o ON o.id = ep.organization_id
+                WHERE u.email={self.param}
+                LIMIT 1;
+            """, (email,))
+            owner = cursor.fetchone()
+            if not owner:
+                raise Exception("User or their organization not found.")
+            owner = tuple(owner)
+            with self._lock:
+                self.owners[email] = owner
+        return owner
+
+    def _select_existing(self, cursor, owner_id, s3_keys):
+        cursor.execute(f"""
+            SELECT s3_key, MIN(id) FROM manage_files_file
+            WHERE owner_id={self.param} AND s3_key = ANY({self.param}) AND is_deleted={self.param}
+            GROUP BY s3_key;
+        """, (owner_id, list(s3_keys), False))
+        return dict(cursor.fetchall())
+
+    def _insert_missing(self, cursor, owner_id, levels, ids):
+        """
+        Chains one INSERT ... RETURNING per missing level in a single statement, each
+        level taking the id returned by the level above it as its parent.
+        """
+        ctes = []
+        params = []
+        parent_cte, parent_id = None, None
+        created = []
+        for index, ((name, s3_key), folder_id) in enumerate(zip(levels, ids)):
+            if folder_id is not None:
+                parent_cte, parent_id = None, folder_id
+                continue
+            cte = f"level_{index}"
+            if parent_cte:
+                ctes.append(f"""{cte} AS (
+                    INSERT INTO manage_files_file (name, owner_id, s3_key, parent_id, created_at, size_gb, is_deleted)
+                    SELECT {self.param}, {self.param}, {self.param}, {parent_cte}.id, CURRENT_TIMESTAMP, 0, FALSE FROM {parent_cte}
+                    RETURNING id
+                )""")
+                params.extend((name, owner_id, s3_key))
+            else:
+                ctes.append(f"""{cte} AS (
+                    INSERT INTO manage_files_file (name, owner_id, s3_key, parent_id, created_at, size_gb, is_deleted)
+                    VALUES ({self.param}, {self.param}, {self.param}, {self.param}, CURRENT_TIMESTAMP, 0, FALSE)
+                    RETURNING id
+                )""")
+                params.extend((name, owner_id, s3_key, parent_id))
+            parent_cte = cte
+            created.append((index, cte))
+        select_ids = ", ".join(f"(SELECT id FROM {cte})" for _, cte in created)
+        cursor.execute(f"WITH {', '.join(ctes)} SELECT {select_ids};", params)
+        row = cursor.fetchone()
+        return [(index, folder_id) for (index, _), folder_id in zip(created, row)]
+
+    def resolve(self, cursor, owner_id, levels):
+        """
+        levels is the list of (name, s3_key) from the root folder down. Returns the folder
+        ids in the same order and the (folder_id, s3_key) of the levels that were created.
+        Creating levels takes an advisory lock held until the transaction ends, so it is
+        best called in a short transaction of its own.
+        """
+        with self._lock:
+            ids = [self.folder_ids.get((owner_id, s3_key)) for _, s3_key in levels]
+        cached = [folder_id for folder_id in ids if folder_id is not None]
+        if cached:
+            cursor.execute(
+                f"SELECT id FROM manage_files_file WHERE id = ANY({self.param}) AND is_deleted={self.param}",
+                (cached, False)
+            )
+            live = {row[0] for row in cursor.fetchall()}
+            if len(live) < len(cached):
+                with self._lock:
+                    for (_, s3_key), folder_id in zip(levels, ids):
+                        if folder_id is not None and folder_id not in live:
+                            self.folder_ids.pop((owner_id, s3_key), None)
+                ids = [folder_id if folder_id in live else None for folder_id in ids]
+        if all(folder_id is not None for folder_id in ids):
+            return ids, []
+
+        missing = [s3_key for (_, s3_key), folder_id in zip(levels, ids) if folder_id is None]
+        existing = self._select_existing(cursor, owner_id, missing)
+        ids = [folder_id or existing.get(s3_key) for (_, s3_key), folder_id in zip(levels, ids)]
+        created = []
+        if any(folder_id is None for folder_id in ids):
+            # Serialise folder creation per owner so parallel lanes do not create duplicates,
+            # then look again since another transaction may have created them meanwhile.
+            cursor.execute(f"SELECT pg_advisory_xact_lock({self.param}, {self.param});", (self.ADVISORY_LOCK_NAMESPACE, owner_id))
+            missing = [s3_key for (_, s3_key), folder_id in zip(levels, ids) if folder_id is None]
+            existing = self._select_existing(cursor, owner_id, missing)
+            ids = [folder_id or existing.get(s3_key) for (_, s3_key), folder_id in zip(levels, ids)]
+            if any(folder_id is None for folder_id in ids):
+                for index, folder_id in self._insert_missing(cursor, owner_id, levels, ids):
+                    ids[index] = folder_id
+                    created.append((folder_id, levels[index][1]))
+        return ids, created
+
+    def remember(self, owner_id, levels, ids):
+        with self._lock:
+            for (_, s3_key), folder_id in zip(levels, ids):
+                self.folder_ids[(owner_id, s3_key)] = folder_id
 
 
-    def get_round_robin_user(self, cursor, org_id, employee_ids):
-        if not employee_ids:
-            return None
+class AutoAssigner:
+    def __init__(self, logger, param_style, metadata_cache, own_transaction):
+        self.logger = logger
+        self.param = param_style  # '?' or '%s'
+        self.metadata_cache = metadata_cache
+        # Yields a connection whose transaction commits on exit, apart from the kafka batch one
+        self.own_transaction = own_transaction
+
+    def get_organization_config(self, cursor, org_id):
         cursor.execute(
-            f"""
-            SELECT assigned_user_id
-            FROM manage_conversation_conversation
-            WHERE organization_id = {self.param}
-              AND assigned_user_id IS NOT NULL
-              AND status != 'closed'
-            ORDER BY updated_at DESC
-            LIMIT 1
-            """,
+            f"SELECT auto_allocation_enabled, auto_allocation_algorithm, owner_id FROM manage_organization_organization WHERE id = {self.param}",
             (org_id,)
         )
-        last = cursor.fetchone()
-        if not last:
-            return employee_ids[0]
-        last_id = last[0]
-        try:
-            idx = employee_ids.index(last_id)
-            return employee_ids[(idx + 1) % len(employee_ids)]
-        except ValueError:
-            return employee_ids[0]
+        return cursor.fetchone()
 
-    def get_bandwidth_user(self, cursor, org_id, employee_ids):
+    def get_round_robin_user(self, cursor, org_id, employee_ids):
         if not employee_ids:
             return None
-        min_user = None
-        min_count = float('inf')
-        for uid in employee_ids:
-            cursor.execute(
+        # The row lock of the increment hands concurrent assignments consecutive positions. It is
+        # taken in a transaction of its own, within the batch it would be held until the batch commits.
+        position = None
+        with self.own_transaction() as conn:
+            cursor_conn = conn.cursor()
+            cursor_conn.execute(
                 f"""
-                SELECT COUNT(*)
-                FROM manage_conversation_conversation
-                WHERE organization_id = {self.param} AND assigned_user_id = {self.param} AND status != 'closed'
+                UPDATE manage_organization_organization
+                SET auto_allocation_cursor = auto_allocation_cursor + 1
+                WHERE id = {self.param}
+                RETURNING auto_allocation_cursor
                 """,
-                (org_id, uid)
+                (org_id,)
             )
-            count = cursor.fetchone()[0]
-            if count < min_count:
-                min_user = uid
-                min_count = count
-        return min_user
+            position = cursor_conn.fetchone()[0] - 1
+        if position is None:
+            return employee_ids[0]
+        return employee_ids[position % len(employee_ids)]
 
-    def assign_conversation(self, cursor, conv_id, user_id):
+    def get_bandwidth_user(self, cursor, org_id, employee_ids):
+        if not employee_ids:
+            return None
+        # One grouped count for the whole team, served by the open_conversations_by_assignee index
         cursor.execute(
             f"""
-            UPDATE manage_conversation_conversation
-            SET assigned_user_id = {self.param}, status = 'active'
-            WHERE id = {self.param}
+            SELECT assigned_user_id, COUNT(*)
+            FROM manage_conversation_conversation
+            WHERE organization_id = {self.param} AND assigned_user_id = ANY({self.param}) AND status != 'closed'
+            GROUP BY assigned_user_id
             """,
-            (user_id, conv_id)
+            (org_id, list(employee_ids))
         )
+        open_counts = dict(cursor.fetchall())
+        # Employees without open conversations have no row, ties go to the first employee
+        return min(employee_ids, key=lambda uid: open_counts.get(uid, 0))
 
-    def get_employee_name(self, cursor, user_id):
+    def assign_conversation(self, cursor, conv_id, user_id):
         cursor.execute(
             f"""
-            SELECT username
-            FROM manage_users_customuser
+            UPDATE manage_conversation_conversation
+            SET assigned_user_id = {self.param}, status = 'active'
             WHERE id = {self.param}
             """,
-            (user_id,)
+            (user_id, conv_id)
         )
-        employee_record = cursor.fetchone()
-        return employee_record[0]
 
     def auto_assign(self, cursor, conv_id, org_id):
         config = self.get_organization_config(cursor, org_id)
@@ -171,7 +959,8 @@ class AutoAssigner:
         enabled, algorithm, owner_id = config
         if not enabled:
             return (None, None)
-        employee_ids = self.get_employees(cursor, org_id, owner_id)
+        employees = self.metadata_cache.get_employees(cursor, org_id, owner_id)
+        employee_ids = [user_id for user_id, _ in employees]
         self.logger.info(f"employees {employee_ids}")
         if not employee_ids:
             return (None, None)
@@ -184,7 +973,7 @@ class AutoAssigner:
         if user_id:
             self.assign_conversation(cursor, conv_id, user_id)
             # Get username from employees list
-            username = self.get_employee_name(cursor, user_id)
+            username = dict(employees)[user_id]
             self.logger.info(f"Employee name {username}")
             return (user_id, username)
         return (None,None)
@@ -200,16 +989,27 @@ class WhatsAppKafkaConsumer:
         self.db_file = os.getenv("SQLITE_DB", "dev.sqlite3")
         self.topic = "whatsapp"
         self.group_id = os.getenv("KAFKA_CONFIG_GRP_ID")
-        self.sio = socketio.Client()
+        # Retries forever once connected, backing off up to SOCKET_RECONNECT_DELAY_MAX seconds
+        self.sio = socketio.Client(
+            reconnection=True,
+            reconnection_attempts=0,
+            reconnection_delay=1,
+            reconnection_delay_max=int(os.getenv("SOCKET_RECONNECT_DELAY_MAX"))
+        )
         self.access_token = generate_forever_token()
-        self.retry_org_queue = {"whatsapp": {}}
+        self.status_retry_base_seconds = int(os.getenv("STATUS_RETRY_BASE_SECONDS"))
+        self.status_retry_max_attempts = int(os.getenv("STATUS_RETRY_MAX_ATTEMPTS"))
+        self.status_retry_claim_seconds = int(os.getenv("STATUS_RETRY_CLAIM_SECONDS"))
+        self.media_claim_seconds = int(os.getenv("MEDIA_CLAIM_SECONDS"))
+        self.media_retry_base_seconds = int(os.getenv("MEDIA_RETRY_BASE_SECONDS"))
+        self.media_max_attempts = int(os.getenv("MEDIA_MAX_ATTEMPTS"))
+        self.batch_size = int(os.getenv("KAFKA_BATCH_SIZE"))
+        self.batch_linger_seconds = int(os.getenv("KAFKA_BATCH_LINGER_MS")) / 1000
+        self.max_in_flight_batches = int(os.getenv("KAFKA_MAX_IN_FLIGHT_BATCHES"))
+        # Holds the connection of the batch being processed by the kafka loop thread
+        self._local = threading.local()
         if not self.access_token:
             raise Exception("Cannot generate access token to connect with websocket server")
-        self.sio.connect(os.getenv("SOCKET_URL").format(access_token=self.access_token))
-
-        @self.sio.on("website_chatwidget_messages_front_to_back")
-        def on_website_chatwidget_messages(data):
-            self.handle_website_chatwidget_messages(data)
 
         # Setup logging
         logging.basicConfig(
@@ -217,32 +1017,155 @@ class WhatsAppKafkaConsumer:
             format="%(asctime)s - %(levelname)s - %(name)s - %(message)s"
         )
         self.logger = logging.getLogger(self.__class__.__name__)
+        # Pool must exist before the socket connects since its callbacks use get_conn
+        self.db_params = {
+            "dbname": os.getenv("PG_DB"),
+            "user": os.getenv("PG_USER"),
+            "password": os.getenv("PG_PASSWORD"),
+            "host": os.getenv("PG_HOST", "localhost"),
+            "port": os.getenv("PG_PORT", "5432")
+        }
+        self.db_pool = None if self.use_sqlite else PgConnectionPool(
+            logger=self.logger,
+            minconn=int(os.getenv("PG_POOL_MIN_CONN")),
+            maxconn=int(os.getenv("PG_POOL_MAX_CONN")),
+            cursor_factory=CountingCursor,
+            **self.db_params
+        )
+        self.metadata_cache = MetadataCache(
+            logger=self.logger,
+            param_style='?' if self.use_sqlite else '%s',
+            maxsize=int(os.getenv("METADATA_CACHE_SIZE")),
+            ttl=int(os.getenv("METADATA_CACHE_TTL_SECONDS"))
+        )
+        self.deduplicator = InboundDeduplicator(
+            param_style='?' if self.use_sqlite else '%s',
+            maxsize=int(os.getenv("INBOUND_DEDUP_CACHE_SIZE"))
+        )
+        self.folder_resolver = FolderChainResolver(
+            logger=self.logger,
+            param_style='?' if self.use_sqlite else '%s',
+            maxsize=int(os.getenv("FOLDER_CACHE_SIZE")),
+            ttl=int(os.getenv("FOLDER_CACHE_TTL_SECONDS"))
+        )
+        if not self.use_sqlite:
+            Thread(
+                target=self.metadata_cache.listen_for_invalidations,
+                args=(lambda: self.db_driver.connect(**self.db_params),),
+                daemon=True,
+                name="MetadataInvalidationListener"
+            ).start()
+
+        @self.sio.on("website_chatwidget_messages_front_to_back")
+        def on_website_chatwidget_messages(data):
+            self.handle_website_chatwidget_messages(data)
+
+        self.emitter = SocketEmitter(
+            logger=self.logger,
+            sio=self.sio,
+            max_pending=int(os.getenv("SOCKET_EMIT_MAX_PENDING")),
+            batch_size=int(os.getenv("SOCKET_EMIT_BATCH_SIZE"))
+        )
         self.auto_assigner = AutoAssigner(
             logger=self.logger,
-            param_style='?' if self.use_sqlite else '%s'
+            param_style='?' if self.use_sqlite else '%s',
+            metadata_cache=self.metadata_cache,
+            own_transaction=lambda: self.get_conn(own_transaction=True)
+        )
+        self.media_pool = MediaWorkerPool(
+            logger=self.logger,
+            workers=int(os.getenv("MEDIA_WORKERS")),
+            queue_size=int(os.getenv("MEDIA_QUEUE_SIZE"))
+        )
+        self.worker_pool = ConversationWorkerPool(
+            logger=self.logger,
+            lanes=int(os.getenv("KAFKA_WORKER_LANES")),
+            process_batch=self.process_batch
         )
+        # One connection per lane and media worker, the last one is kept for nested checkouts
+        busy_threads = int(os.getenv("KAFKA_WORKER_LANES")) + int(os.getenv("MEDIA_WORKERS"))
+        if not self.use_sqlite and int(os.getenv("PG_POOL_MAX_CONN")) <= busy_threads:
+            self.logger.warning(
+                "PG_POOL_MAX_CONN=%s leaves lanes and media workers waiting on connections, %d or more are recommended",
+                os.getenv("PG_POOL_MAX_CONN"), busy_threads + 2
+            )
+        self.retry_scheduler = RetryScheduler(logger=self.logger, run_retry=self.retry_org_message)
+        # Only once everything the socket callbacks use exists
+        self.sio.connect(os.getenv("SOCKET_URL").format(access_token=self.access_token))
+        self.lag_interval_seconds = int(os.getenv("METRICS_LAG_INTERVAL_SECONDS"))
+        STATUS_RETRY_DEPTH.set_function(lambda: len(self.retry_scheduler))
+        MEDIA_QUEUE_DEPTH.set_function(self.media_pool.jobs.qsize)
+        SOCKET_EMIT_PENDING.set_function(lambda: len(self.emitter))
+        if int(os.getenv("METRICS_PORT")):
+            start_http_server(int(os.getenv("METRICS_PORT")))
+        if not self.use_sqlite:
+            Thread(target=self.run_pending_media_sweeper, daemon=True, name="PendingMediaSweeper").start()
+            self.load_status_retries()
 
     @contextmanager
-    def get_conn(self, auto_commit=True):
-        conn = (
-            self.db_driver.connect(self.db_file)
-            if self.use_sqlite
-            else self.db_driver.connect(
-                dbname=os.getenv("PG_DB"),
-                user=os.getenv("PG_USER"),
-                password=os.getenv("PG_PASSWORD"),
-                host=os.getenv("PG_HOST", "localhost"),
-                port=os.getenv("PG_PORT", "5432")
-            )
-        )
+    def get_conn(self, auto_commit=True, own_transaction=False):
+        batch_conn = None if own_transaction else getattr(self._local, "batch_conn", None)
+        if batch_conn is not None:
+            # Inside a kafka batch every handler shares the batch transaction, a savepoint
+            # keeps one failing message from aborting the rest of the batch.
+            cursor = batch_conn.cursor()
+            callbacks = self._local.after_commit
+            registered = len(callbacks)
+            cursor.execute("SAVEPOINT kafka_message")
+            try:
+                yield batch_conn
+                cursor.execute("RELEASE SAVEPOINT kafka_message")
+            except Exception:
+                traceback.print_exc()
+                del callbacks[registered:]
+                cursor.execute("ROLLBACK TO SAVEPOINT kafka_message")
+            return
+
+        conn = self.open_conn()
+        outer_callbacks = getattr(self._local, "after_commit", None)
+        self._local.after_commit = callbacks = []
+        discard = False
+        committed = False
         try:
             yield conn
             if auto_commit:
                 conn.commit()
-        except Exception:
+                committed = True
+        except Exception as e:
             traceback.print_exc()
+            discard = self.is_connection_error(e)
         finally:
+            self._local.after_commit = outer_callbacks
+            self.release_conn(conn, discard=discard)
+        if committed:
+            self.run_after_commit(callbacks)
+
+    def after_commit(self, callback, *args):
+        """Defers callback until the transaction of the current get_conn block commits"""
+        self._local.after_commit.append((callback, args))
+
+    def run_after_commit(self, callbacks):
+        for callback, args in callbacks:
+            try:
+                callback(*args)
+            except Exception as e:
+                self.logger.error("Error in after commit callback: %s", e, exc_info=True)
+
+    def open_conn(self):
+        if self.use_sqlite:
+            return self.db_driver.connect(self.db_file)
+        return self.db_pool.getconn()
+
+    def release_conn(self, conn, discard=False):
+        if self.use_sqlite:
             conn.close()
+        else:
+            self.db_pool.putconn(conn, discard=discard)
+
+    @staticmethod
+    def is_connection_error(error):
+        # Connection level failures mean the socket is gone, let the pool reconnect
+        return isinstance(error, (psycopg2.OperationalError, psycopg2.InterfaceError))
 
     @property
     def param(self):
@@ -258,39 +1181,42 @@ class WhatsAppKafkaConsumer:
             "session.timeout.ms": config("TIMEOUT_MS"),
             "client.id": config("CLIENTID"),
             "auto.offset.reset": "earliest",
-            "enable.auto.commit": True
+            # Offsets are committed by consume() once the batch transaction is committed
+            "enable.auto.commit": False
         }
 
-    def process_message(self, message):
-        if message["msg_from_type"] == "CUSTOMER":
-            self.handle_customer_messages(message)
-        elif message["msg_from_type"] == "ORG":
-            self.handle_org_messages(message)
-
-    def handle_customer_messages(self, message):
-        if message["app_name"] == "WHATSAPP":
-            self.handle_customer_message_whatsapp(message)
-        elif  message["app_name"] == "MESSENGER":
-            self.handle_customer_message_messenger(message)
-        elif message["app_name"] == "GMAIL":
-            self.handle_customer_message_gmail(message)  # ✅ Add this
-
-    def handle_org_messages(self, message):
-        if message["app_name"] == "WHATSAPP":
-            self.handle_org_message_whatsapp(message)
-        elif  message["app_name"] == "MESSENGER":
-            self.handle_org_message_messenger(message)
+    def get_handler(self, msg_from_type, app_name):
+        return {
+            ("CUSTOMER", "WHATSAPP"): self.handle_customer_message_whatsapp,
+            ("CUSTOMER", "MESSENGER"): self.handle_customer_message_messenger,
+            ("CUSTOMER", "GMAIL"): self.handle_customer_message_gmail,
+            ("ORG", "WHATSAPP"): self.handle_org_message_whatsapp,
+            ("ORG", "MESSENGER"): self.handle_org_message_messenger,
+        }.get((msg_from_type, app_name))
+
+    @staticmethod
+    def read_route(msg):
+        """
+        (msg_from_type, app_name, schema_version) from the kafka headers, or None for messages
+        published before the webhook set them, which have to be routed on their decoded body.
+        """
+        headers = {key: value.decode("utf-8") for key, value in (msg.headers() or []) if value is not None}
+        if "msg_from_type" not in headers or "app_name" not in headers:
+            return None
+        return headers["msg_from_type"], headers["app_name"], int(headers.get("schema_version", 1))
 
     def requests_auth_header(self, token):
         return {"Authorization": f"Bearer {token}"}
 
     @contextmanager
     def download_from_provider(self, media_id, access_token):
+        """Yields the media as an unbuffered stream straight from the Graph API response"""
         file_data = None
+        media_file_response = None
         try:
             auth_header=self.requests_auth_header(access_token)
             media_info_response = requests.get(
-                f"https://graph.facebook.com/v18.0/{media_id}",
+                f"{os.getenv('GRAPH_API_URL')}/{media_id}",
                 headers=auth_header
             )
             if media_info_response.status_code not in range(200, 299):
@@ -301,39 +1227,38 @@ class WhatsAppKafkaConsumer:
             if media_url:
                 media_file_response = requests.get(media_url, headers=auth_header, stream=True)
                 if media_file_response.status_code == 200:
-                    file_data = BytesIO(media_file_response.content)
+                    media_file_response.raw.decode_content = True
+                    file_data = media_file_response.raw
                 else:
                     raise Exception(f"Failed to download media: {media_file_response.status_code}")
             yield file_data
         except Exception as download_exception:
             raise download_exception
         finally:
-            if file_data:
-                file_data.close()
-
-    def provide_permission(self, cursor, org_id, file_id, user_id):
+            if media_file_response is not None:
+                media_file_response.close()
+
+    def provide_permission(self, cursor, org_id, file_ids, user_id):
+        """
+        Grants every employee of the org access to all of file_ids in one statement.
+        The owner is skipped since he already has permission being the creator.
+        """
+        if not file_ids:
+            return
         cursor.execute(f"""
-            SELECT user_id FROM manage_users_enterpriseprofile
-            WHERE organization_id={self.param};
-        """, (org_id,))
-        employees = cursor.fetchall()
-        for employee in employees:
-            # employee[0] because the result returned is a tuple (1,)
-            if employee[0] == user_id:
-                # Skipping the owner since he already has permission being the creator
-                continue
-            cursor.execute(f"""
-                INSERT INTO manage_files_filepermission (
-                    file_id, user_id, inherited, can_read, can_write
-                ) VALUES ({self.param}, {self.param}, {self.param}, {self.param}, {self.param})
-                ON CONFLICT (file_id, user_id)
-                DO UPDATE SET
-                    inherited = EXCLUDED.inherited,
-                    can_read = EXCLUDED.can_read,
-                    can_write = EXCLUDED.can_write;
-            """, (file_id, employee[0], True, True, True))
-
-
+            INSERT INTO manage_files_filepermission (
+                file_id, user_id, inherited, can_read, can_write
+            )
+            SELECT f.id, ep.user_id, {self.param}, {self.param}, {self.param}
+            FROM manage_users_enterpriseprofile ep
+            CROSS JOIN unnest({self.param}::bigint[]) AS f(id)
+            WHERE ep.organization_id={self.param} AND ep.user_id <> {self.param}
+            ON CONFLICT (file_id, user_id)
+            DO UPDATE SET
+                inherited = EXCLUDED.inherited,
+                can_read = EXCLUDED.can_read,
+                can_write = EXCLUDED.can_write;
+        """, (True, True, True, list(file_ids), org_id, user_id))
 
     def generate_presigned_url(self, s3_client, object_key, expiry_seconds=86400):
         # Guess the MIME type from the object_key
@@ -353,269 +1278,207 @@ class WhatsAppKafkaConsumer:
         )
         return url
 
-    def save_media_file_to_s3_raw_sql(self, conn, user_identifier: str, receiver_name: str, filename: str, file_data: BytesIO):
-        # 1. Look up user and org
-        cursor = conn.cursor()
-        cursor.execute(f"""
-            SELECT u.id, ep.organization_id, o.name
-            FROM manage_users_customuser u
-            JOIN manage_users_enterpriseprofile ep ON ep.user_id = u.id
-            JOIN manage_organization_organization o ON o.id = ep.organization_id
-            WHERE u.email={self.param}
-            LIMIT 1;
-        """, (user_identifier,))
-        row = cursor.fetchone()
-        if not row:
-            raise Exception("User or their organization not found.")
-        user_id, org_id, org_name = row
+    def save_media_file_to_s3_raw_sql(self, conn, user_identifier: str, receiver_name: str, filename: str, file_data):
+        """file_data may be any readable stream, it is uploaded without being buffered whole"""
+        upload = self.upload_media_file(user_identifier, receiver_name, filename, file_data)
+        return self.record_media_file(conn.cursor(), upload)
+
+    def upload_media_file(self, user_identifier: str, receiver_name: str, filename: str, file_data):
+        """
+        Streams file_data to S3 under the owner's folder chain, creating the missing folders in a
+        short transaction of its own. Needs no connection of the caller, the returned upload is
+        saved with record_media_file.
+        """
+        # 1. Resolve the folder chain, creating only the levels that do not exist yet. The per
+        # owner advisory lock is released before the upload, and is not held until the batch commits.
+        owner = folder_ids = None
+        with self.get_conn(own_transaction=True) as folder_conn:
+            folder_cursor = folder_conn.cursor()
+            owner = self.folder_resolver.get_owner(folder_cursor, user_identifier)
+            levels, file_key = self.media_folder_levels(user_identifier, owner[2], receiver_name, filename)
+            folder_ids, created_folders = self.folder_resolver.resolve(folder_cursor, owner[0], levels)
+            # The whole chain, employees who joined after a folder was created get access too
+            self.provide_permission(folder_cursor, owner[1], folder_ids, owner[0])
+            self.after_commit(self.folder_resolver.remember, owner[0], levels, folder_ids)
+        if folder_ids is None:
+            raise Exception(f"Unable to resolve the folders of {filename} for {user_identifier}")
+        user_id, org_id, _ = owner
+
+        # 2. Upload folder placeholders of the new folders and the file to S3
+        s3 = get_s3_client(
+            endpoint_url=os.getenv("B2_ENDPOINT_URL"),
+            access_key_id=os.getenv("B2_ACCESS_KEY_ID"),
+            secret_access_key=os.getenv("B2_SECRET_ACCESS_KEY")
+        )
+        for folder_id, folder_key in created_folders:
+            s3.put_object(Bucket=os.getenv("B2_STORAGE_BUCKET_NAME"), Key=folder_key)
+        file_stream = CountingReader(file_data)
+        with MEDIA_UPLOAD_LATENCY.time():
+            s3.upload_fileobj(file_stream, os.getenv("B2_STORAGE_BUCKET_NAME"), file_key, Config=MEDIA_TRANSFER_CONFIG)
+        MEDIA_UPLOADED_BYTES.inc(file_stream.bytes_read)
+        self.logger.info(f"✅ Uploaded to {file_key}")
+        return {
+            "filename": filename,
+            "user_id": user_id,
+            "org_id": org_id,
+            "file_key": file_key,
+            "parent_id": folder_ids[-1],
+            "size_gb": file_stream.bytes_read / 1_000_000_000,
+            "signed_url": self.generate_presigned_url(s3, file_key, expiry_seconds=86400),
+        }
+
+    @staticmethod
+    def media_folder_levels(user_identifier, org_name, receiver_name, filename):
+        """(name, s3_key) of the folders from the owner's home down to today's, and the file's key"""
         org_name = org_name.replace(" ", "_")
         uname = user_identifier.split('@')[0] if '@' in user_identifier else user_identifier
         today = datetime.now().strftime('%Y-%m-%d')
-        size_gb = file_data.getbuffer().nbytes / 1_000_000_000
         customer_directory = "customer"
         received_directory_name = "received"
         receiver_directory = receiver_name.replace(" ", "_")
 
-        # 2. Generate folder paths
-
         home_directory_key = f"{uname}/"
         org_directory_key = f"{home_directory_key}{org_name}/"
         customer_directory_key = f"{org_directory_key}{customer_directory}/"
         received_directory_key = f"{customer_directory_key}{received_directory_name}/"
         receiver_folder_key = f"{received_directory_key}{receiver_directory}/"
         date_folder_key = f"{receiver_folder_key}{today}/"
-        file_key = f"{date_folder_key}{filename}"
-
-        # 3. Upload folder placeholder and file to S3
-        s3 = boto3.client(
-            's3',
-            endpoint_url=os.getenv("B2_ENDPOINT_URL"),
-            aws_access_key_id=os.getenv("B2_ACCESS_KEY_ID"),
-            aws_secret_access_key=os.getenv("B2_SECRET_ACCESS_KEY"),
-            config=Config(signature_version="s3v4"),
-            region_name='us-west-002'  # ✅ Add your correct region name here if required
-        )
-
-        s3.put_object(Bucket=os.getenv("B2_STORAGE_BUCKET_NAME"), Key=home_directory_key)
-        s3.put_object(Bucket=os.getenv("B2_STORAGE_BUCKET_NAME"), Key=org_directory_key)
-        s3.put_object(Bucket=os.getenv("B2_STORAGE_BUCKET_NAME"), Key=customer_directory_key)
-        s3.put_object(Bucket=os.getenv("B2_STORAGE_BUCKET_NAME"), Key=received_directory_key)
-        s3.put_object(Bucket=os.getenv("B2_STORAGE_BUCKET_NAME"), Key=receiver_folder_key)
-        s3.put_object(Bucket=os.getenv("B2_STORAGE_BUCKET_NAME"), Key=date_folder_key)
-        s3.upload_fileobj(file_data, os.getenv("B2_STORAGE_BUCKET_NAME"), file_key)
-
-        parent = None
-
-        # 5. Insert user home folder if not exists
-        cursor.execute(f"""
-            SELECT id FROM manage_files_file
-            WHERE s3_key={self.param} AND owner_id={self.param} AND is_deleted={self.param}
-            LIMIT 1;
-        """, (home_directory_key, user_id, False))
-        receiver_row = cursor.fetchone()
-        if receiver_row:
-            parent = receiver_row[0]
-        else:
-            cursor.execute(f"""
-                INSERT INTO manage_files_file (name, owner_id, s3_key, parent_id, created_at, size_gb, is_deleted)
-                VALUES ({self.param}, {self.param}, {self.param}, NULL, CURRENT_TIMESTAMP, 0, {self.param})
-                RETURNING id;
-            """, (uname, user_id, home_directory_key, False))
-            parent =  cursor.fetchone()[0]
-        self.provide_permission(cursor, org_id, parent, user_id)
-
-        # 4. Insert org folder if not exists
-        cursor.execute(f"""
-            SELECT id FROM manage_files_file
-            WHERE s3_key={self.param} AND owner_id={self.param} AND is_deleted={self.param}
-            LIMIT 1;
-        """, (org_directory_key, user_id, False))
-        receiver_row = cursor.fetchone()
-        if receiver_row:
-            parent = receiver_row[0]
-        else:
-            cursor.execute(f"""
-                INSERT INTO manage_files_file (name, owner_id, s3_key, parent_id, created_at, size_gb, is_deleted)
-                VALUES ({self.param}, {self.param}, {self.param}, {self.param}, CURRENT_TIMESTAMP, 0, {self.param})
-                RETURNING id;
-            """, (org_name, user_id, org_directory_key, parent, False))
-            parent =  cursor.fetchone()[0]
-        self.provide_permission(cursor, org_id, parent, user_id)
-
-        # 6. Insert customer folder if not exists
-        cursor.execute(f"""
-            SELECT id FROM manage_files_file
-            WHERE s3_key={self.param} AND owner_id={self.param} AND is_deleted={self.param}
-            LIMIT 1;
-        """, (customer_directory_key, user_id, False))
-        receiver_row = cursor.fetchone()
-        if receiver_row:
-            parent = receiver_row[0]
-        else:
-            cursor.execute(f"""
-                INSERT INTO manage_files_file (name, owner_id, s3_key, parent_id, created_at, size_gb, is_deleted)
-                VALUES ({self.param}, {self.param}, {self.param}, {self.param}, CURRENT_TIMESTAMP, 0, {self.param})
-                RETURNING id;
-            """, (customer_directory, user_id, customer_directory_key, parent, False))
-            parent =  cursor.fetchone()[0]
-        self.provide_permission(cursor, org_id, parent, user_id)
-
-        # 7. Insert received folder if not exists
-        cursor.execute(f"""
-            SELECT id FROM manage_files_file
-            WHERE s3_key={self.param} AND owner_id={self.param} AND is_deleted={self.param}
-            LIMIT 1;
-        """, (received_directory_key, user_id, False))
-        receiver_row = cursor.fetchone()
-        if receiver_row:
-            parent = receiver_row[0]
-        else:
-            cursor.execute(f"""
-                INSERT INTO manage_files_file (name, owner_id, s3_key, parent_id, created_at, size_gb, is_deleted)
-                VALUES ({self.param}, {self.param}, {self.param}, {self.param}, CURRENT_TIMESTAMP, 0, {self.param})
-                RETURNING id;
-            """, (received_directory_name, user_id, received_directory_key, parent, False))
-            parent =  cursor.fetchone()[0]
-        self.provide_permission(cursor, org_id, parent, user_id)
-
-        # 8. Insert receiver folder if not exists
-        cursor.execute(f"""
-            SELECT id FROM manage_files_file
-            WHERE s3_key={self.param} AND owner_id={self.param} AND is_deleted={self.param}
-            LIMIT 1;
-        """, (receiver_folder_key, user_id, False))
-        receiver_row = cursor.fetchone()
-        if receiver_row:
-            parent = receiver_row[0]
-        else:
-            cursor.execute(f"""
-                INSERT INTO manage_files_file (name, owner_id, s3_key, parent_id, created_at, size_gb, is_deleted)
-                VALUES ({self.param}, {self.param}, {self.param}, {self.param}, CURRENT_TIMESTAMP, 0, {self.param})
-                RETURNING id;
-            """, (receiver_directory, user_id, receiver_folder_key, parent, False))
-            parent =  cursor.fetchone()[0]
-        self.provide_permission(cursor, org_id, parent, user_id)
-
-        # 9. Insert date folder under receiver folder if not exists
-        cursor.execute(f"""
-            SELECT id FROM manage_files_file
-            WHERE s3_key={self.param} AND owner_id={self.param} AND is_deleted={self.param}
-            LIMIT 1;
-        """, (date_folder_key, user_id, False))
-        date_folder_row = cursor.fetchone()
-        if date_folder_row:
-            parent = date_folder_row[0]
-        else:
-            cursor.execute(f"""
-                INSERT INTO manage_files_file (name, owner_id, s3_key, parent_id, created_at, size_gb, is_deleted)
-                VALUES ({self.param}, {self.param}, {self.param}, {self.param}, CURRENT_TIMESTAMP, 0, {self.param})
-                RETURNING id;
-            """, (today, user_id, date_folder_key, parent, False))
-            parent =  cursor.fetchone()[0]
-        self.provide_permission(cursor, org_id, parent, user_id)
-
-        # 10. Insert file under date folder
-        signed_url = self.generate_presigned_url(s3, file_key, expiry_seconds=86400)
+        levels = [
+            (uname, home_directory_key),
+            (org_name, org_directory_key),
+            (customer_directory, customer_directory_key),
+            (received_directory_name, received_directory_key),
+            (receiver_directory, receiver_folder_key),
+            (today, date_folder_key),
+        ]
+        return levels, f"{date_folder_key}{filename}"
+
+    def record_media_file(self, cursor, upload):
+        """Inserts an uploaded file under its date folder along with its FileStorageEvent record"""
         utc = pytz.utc
         signed_url_expires_at = datetime.now(utc) + timedelta(seconds=86400)
         cursor.execute(f"""
-            INSERT INTO manage_files_file (name, owner_id, s3_key, parent_id, created_at, size_gb, is_deleted, signed_url, signed_url_expires_at)
-            VALUES ({self.param}, {self.param}, {self.param}, {self.param}, CURRENT_TIMESTAMP, {self.param}, {self.param}, {self.param}, {self.param})
-            RETURNING id;
-        """, (filename, user_id, file_key, parent, size_gb, False, signed_url, signed_url_expires_at))
-        self.logger.info(f"✅ Uploaded to {file_key}")
+            WITH new_file AS (
+                INSERT INTO manage_files_file (name, owner_id, s3_key, parent_id, created_at, size_gb, is_deleted, signed_url, signed_url_expires_at)
+                VALUES ({self.param}, {self.param}, {self.param}, {self.param}, CURRENT_TIMESTAMP, {self.param}, {self.param}, {self.param}, {self.param})
+                RETURNING id, name, owner_id, size_gb
+            )
+            INSERT INTO manage_files_filestorageevent (file_id_id, file_name, user_id, size_gb, start_time)
+            SELECT id, name, owner_id, size_gb, CURRENT_TIMESTAMP FROM new_file
+            RETURNING file_id_id;
+        """, (upload["filename"], upload["user_id"], upload["file_key"], upload["parent_id"], upload["size_gb"], False, upload["signed_url"], signed_url_expires_at))
         file_id = cursor.fetchone()[0]
-        self.provide_permission(cursor, org_id, file_id, user_id)
-
-        # 11. Insert a new FileStorageEvent record
-        cursor.execute(f"""
-            INSERT INTO manage_files_filestorageevent (
-                file_id_id, file_name, user_id, size_gb, start_time
-            ) VALUES ({self.param}, {self.param}, {self.param}, {self.param}, CURRENT_TIMESTAMP);
-        """, (file_id, filename, user_id, size_gb))
-        return file_id, signed_url
-
+        # Grant the org access to the file
+        self.provide_permission(cursor, upload["org_id"], [file_id], upload["user_id"])
+        return file_id, upload["signed_url"]
+
+    def upsert_contact_and_conversation(self, cursor, phone, name, organization_id, created_by_id, platform_name, platform_id, subject=None, thread_id=None):
+        """
+        Resolves the contact and its open conversation, creating either when missing, in one
+        statement. Returns (contact_id, contact_name, image_expires_at, contact_created,
+        conversation_id, conversation_created). When thread_id is given only an open
+        conversation of that thread matches, as gmail keeps one conversation per thread.
+        """
+        thread_filter = f"AND c.thread_id = {self.param}" if thread_id is not None else ""
+        params = (
+            phone, organization_id,
+            phone, name, organization_id, created_by_id, platform_name,
+            platform_id, organization_id, *((thread_id,) if thread_id is not None else ()),
+            platform_id, organization_id, subject, thread_id,
+        )
+        # Both inserts are skipped when the row exists, ON CONFLICT only covers a concurrent
+        # insert of the same contact or conversation. That case returns no row since the
+        # winner is not visible to this statement's snapshot, so the statement is re-run.
+        for _ in range(3):
+            cursor.execute(f"""
+                WITH existing_contact AS (
+                    SELECT id, name, image_expires_at FROM manage_contact_contact
+                    WHERE phone = {self.param} AND organization_id = {self.param}
+                ), new_contact AS (
+                    INSERT INTO manage_contact_contact (phone, name, organization_id, created_by_id, platform_name, created_at, updated_at)
+                    SELECT {self.param}, {self.param}, {self.param}, {self.param}, {self.param}, NOW(), NOW()
+                    WHERE NOT EXISTS (SELECT 1 FROM existing_contact)
+                    ON CONFLICT (phone, organization_id) DO NOTHING
+                    RETURNING id, name, image_expires_at
+                ), contact AS (
+                    SELECT id, name, image_expires_at, FALSE AS created FROM existing_contact
+                    UNION ALL
+                    SELECT id, name, image_expires_at, TRUE AS created FROM new_contact
+                ), existing_conversation AS (
+                    SELECT c.id FROM manage_conversation_conversation c JOIN contact ON c.contact_id = contact.id
+                    WHERE c.platform_id = {self.param} AND c.organization_id = {self.param}
+                      AND c.status IN ('new', 'active') {thread_filter}
+                    ORDER BY c.created_at DESC LIMIT 1
+                ), new_conversation AS (
+                    INSERT INTO manage_conversation_conversation (contact_id, platform_id, organization_id, open_by, status, subject, thread_id, created_at, updated_at)
+                    SELECT contact.id, {self.param}, {self.param}, 'customer', 'new', {self.param}, {self.param}, NOW(), NOW()
+                    FROM contact
+                    WHERE NOT EXISTS (SELECT 1 FROM existing_conversation)
+                    ON CONFLICT (contact_id, platform_id) WHERE status IN ('new', 'active') AND thread_id IS NULL DO NOTHING
+                    RETURNING id
+                ), conversation AS (
+                    SELECT id, FALSE AS created FROM existing_conversation
+                    UNION ALL
+                    SELECT id, TRUE AS created FROM new_conversation
+                )
+                SELECT contact.id, contact.name, contact.image_expires_at, contact.created, conversation.id, conversation.created
+                FROM contact CROSS JOIN conversation
+            """, params)
+            row = cursor.fetchone()
+            if row:
+                return row
+            self.logger.info("Contact %s or its conversation was created concurrently, retrying upsert", phone)
+        raise Exception(f"Unable to resolve contact and conversation for {phone}")
+
+    @instrumented
     def handle_customer_message_whatsapp(self, msg_data):
         try:
             recipient_id = msg_data['recipient_id']
             message_type = msg_data['msg_type']
             message_body = message_body_copy = msg_data['message_body']
             phone_number_id = msg_data['phone_number_id']
-            file_id = None
+            provider_message_id = msg_data.get('provider_message_id')
             with self.get_conn() as conn:
                 cursor = conn.cursor()
-                cursor.execute(f"SELECT id, owner_id, login_credentials, login_id FROM manage_platform_platform WHERE login_id={self.param}", (phone_number_id,))
-                platform_row = cursor.fetchone()
+                platform_row = self.metadata_cache.get_platform_by_login_id(cursor, phone_number_id)
                 if not platform_row:
                     self.logger.warning("Platform not found for phone_number_id: %s", phone_number_id)
                     return
-                platform_id, owner_id, login_credentials, login_id = platform_row
+                platform_id, owner_id, login_credentials, login_id, _ = platform_row
                 # Blocked contact check BEFORE creating/fetching contact
-                cursor.execute(f"""
-                    SELECT 1 FROM manage_platform_blockedcontact
-                    WHERE platform_id={self.param} AND contact_value={self.param}
-                    LIMIT 1
-                """, (platform_id, recipient_id))
-                is_blocked = cursor.fetchone()
-                if is_blocked:
+                if self.metadata_cache.is_blocked(cursor, platform_id, recipient_id):
                     self.logger.warning("🚫 Blocked contact %s on platform_id %s — skipping message.", recipient_id, platform_id)
                     return
+                if self.deduplicator.is_duplicate(cursor, platform_id, provider_message_id):
+                    self.logger.info("Skipping already saved whatsapp message %s", provider_message_id)
+                    return
 
-                signed_url = None
+                # Media is stored with a pending marker and uploaded by the media pool once this
+                # transaction commits, so the text behind it is not held up by the download
+                media_pending = None
                 if message_type != "text":
                     message_body_copy = message_body_copy.get("caption") or f"No_Caption_{time.time()}_{uuid.uuid4().hex}"
-                    cursor.execute(f"SELECT user_id from manage_users_enterpriseprofile where user_id={self.param}", (owner_id,))
-                    enterprise_profile = cursor.fetchone()
-                    if not enterprise_profile:
-                        self.logger.warning("Enterprise profile not found for owner_id: %s", owner_id)
-                        raise Exception("User not registered as enterprise")
-                    owner_user_id = enterprise_profile[0]
-                    cursor.execute(f"SELECT email from manage_users_customuser where id={self.param}", (owner_user_id,))
-                    owner_user_profile = cursor.fetchone()
-                    if not owner_user_profile:
-                        raise Exception("User not found in main user profile")
-                    owner_email = owner_user_profile[0]
-                    with self.download_from_provider(message_body.get("media_id"), login_credentials) as file_data:
-                        media_file_name = message_body.get("filename") if message_body.get("filename") else message_body_copy
-                        if message_type in ("image/jpeg", "image/png", "video/mp4", "video/3gpp", "audio/aac", "audio/mpeg", "audio/amr", "audio/ogg"):
-                            media_file_name = message_body_copy + "." + message_type.split('/')[-1]
-                        file_id, signed_url = self.save_media_file_to_s3_raw_sql(conn, owner_email, recipient_id, media_file_name, file_data)
-
-                cursor.execute(f"SELECT id, owner_id, name FROM manage_organization_organization WHERE owner_id={self.param}", (owner_id,))
-                org_row = cursor.fetchone()
+                    media_file_name = message_body.get("filename") if message_body.get("filename") else message_body_copy
+                    if message_type in ("image/jpeg", "image/png", "video/mp4", "video/3gpp", "audio/aac", "audio/mpeg", "audio/amr", "audio/ogg"):
+                        media_file_name = message_body_copy + "." + message_type.split('/')[-1]
+                    media_pending = f"{MEDIA_PENDING_PREFIX}{message_body.get('media_id')}:{media_file_name}"
+
+                org_row = self.metadata_cache.get_organization_by_owner(cursor, owner_id)
                 if not org_row:
                     self.logger.warning("Organization not found for owner_id: %s", owner_id)
                     return
                 organization_id, org_owner_id, organization_name = org_row
 
-                contact_id, contact_name = None, None
-                cursor.execute(f"SELECT id, name FROM manage_contact_contact WHERE phone={self.param} AND organization_id={self.param}", (recipient_id, organization_id))
-                contact_row = cursor.fetchone()
-                if contact_row:
-                    contact_id, contact_name = contact_row
-                else:
-                    cursor.execute(
-                        f"INSERT INTO manage_contact_contact (phone, name, organization_id, created_by_id, platform_name, created_at, updated_at) VALUES ({self.param}, {self.param}, {self.param}, {self.param}, {self.param}, {self.param}, {self.param}) RETURNING id, name",
-                        (recipient_id, recipient_id, organization_id, org_owner_id, 'whatsapp', datetime.now(), datetime.now())
-                    )
-                    contact_id, contact_name = cursor.fetchone()
-
-                is_conversation_new = True
-                cursor.execute(f"""
-                    SELECT id FROM manage_conversation_conversation
-                    WHERE contact_id={self.param} AND platform_id={self.param} AND organization_id={self.param} AND status IN ('new', 'active')
-                    ORDER BY created_at DESC LIMIT 1
-                """, (contact_id, platform_id, organization_id))
-                conv_row = cursor.fetchone()
-                if conv_row:
-                    conversation_id = conv_row[0]
-                    is_conversation_new = False
-                else:
-                    cursor.execute(f"""
-                        INSERT INTO manage_conversation_conversation (contact_id, platform_id, organization_id, open_by, status, created_at, updated_at)
-                        VALUES ({self.param}, {self.param}, {self.param}, {self.param}, {self.param}, {self.param}, {self.param}) RETURNING id
-                    """, (contact_id, platform_id, organization_id, 'customer', 'new', datetime.now(), datetime.now()))
-                    conversation_id = cursor.fetchone()[0]
+                contact_id, contact_name, _, _, conversation_id, is_conversation_new = self.upsert_contact_and_conversation(
+                    cursor,
+                    phone=recipient_id,
+                    name=recipient_id,
+                    organization_id=organization_id,
+                    created_by_id=org_owner_id,
+                    platform_name='whatsapp',
+                    platform_id=platform_id
+                )
+                if is_conversation_new:
                     assigned_user_id, consultant_name = self.auto_assigner.auto_assign(cursor=cursor, conv_id=conversation_id, org_id=organization_id)
                     if assigned_user_id:
                         self.logger.info(f"Conversation {conversation_id} auto-assigned to user {assigned_user_id}")
@@ -637,11 +1500,21 @@ class WhatsAppKafkaConsumer:
                     else:
                         self.logger.info(f"Auto-assignment skipped for conversation {conversation_id}")
                 cursor.execute(f"""
-                    INSERT INTO manage_conversation_incomingmessage (conversation_id, contact_id, platform_id, organization_id, message_body, message_type, status_details, status, received_time, created_at)
-                    VALUES ({self.param}, {self.param}, {self.param}, {self.param}, {self.param}, {self.param}, {self.param}, 'unread', CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
+                    INSERT INTO manage_conversation_incomingmessage (conversation_id, contact_id, platform_id, organization_id, message_body, message_type, messageid, status_details, status, received_time, created_at)
+                    VALUES ({self.param}, {self.param}, {self.param}, {self.param}, {self.param}, {self.param}, {self.param}, {self.param}, 'unread', CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
+                    ON CONFLICT (platform_id, messageid) WHERE messageid IS NOT NULL DO NOTHING
                     RETURNING id, received_time, status, status_details
-                """, (conversation_id, contact_id, platform_id, organization_id, message_body if message_type=="text" else message_body_copy, message_type, file_id))
+                """, (conversation_id, contact_id, platform_id, organization_id, message_body if message_type=="text" else message_body_copy, message_type, provider_message_id, media_pending))
                 msg_row = cursor.fetchone()
+                if not msg_row:
+                    self.logger.info("Whatsapp message %s was saved concurrently, skipping", provider_message_id)
+                    return
+                self.after_commit(self.deduplicator.remember, platform_id, provider_message_id)
+                if media_pending:
+                    self.after_commit(
+                        self.media_pool.submit, self.upload_pending_whatsapp_media,
+                        msg_row[0], conversation_id, organization_id, owner_id, recipient_id, login_credentials, media_pending
+                    )
                 payload = {
                     'id': contact_id,
                     'conversation_id': conversation_id,
@@ -655,88 +1528,344 @@ class WhatsAppKafkaConsumer:
                     'organization_id': organization_id,
                     'customer_name': contact_name,
                     'is_conversation_new': is_conversation_new,
-                    'media_url': signed_url
+                    'media_url': None,
+                    'media_pending': media_pending is not None,
+                    'message_id': msg_row[0]
                 }
                 self.logger.info("New customer message saved for conversation_id: %s", conversation_id)
-                self.sio.emit("whatsapp_chat", payload)
+                self.after_commit(self.emitter.emit, "whatsapp_chat", payload)
         except Exception as e:
             self.logger.error("Error in handle_customer_message_whatsapp: %s", e, exc_info=True)
 
-    def handle_org_message_whatsapp(self, msg_data):
+    @instrumented
+    def upload_pending_whatsapp_media(self, incoming_message_id, conversation_id, organization_id, owner_id, recipient_id, access_token, media_pending, attempts=None):
+        """
+        Runs on the media pool. Uploads the media of an incoming message saved with a pending
+        marker, swaps the marker for the file id and tells the clients the media is ready.
+        attempts is given when the sweeper already claimed the upload, otherwise it is claimed
+        here and skipped when another worker holds it. No connection is held while the media
+        is downloaded and uploaded.
+        """
+        if attempts is None:
+            attempts = self.claim_pending_media(incoming_message_id, media_pending)
+        elif not self.renew_pending_media(incoming_message_id, media_pending, attempts):
+            # Waited in the queue past its claim, which the sweeper handed to another job
+            attempts = None
+        if attempts is None:
+            self.logger.info("Media of incoming message %s is uploaded by another worker", incoming_message_id)
+            return
+        media_id, media_file_name = media_pending[len(MEDIA_PENDING_PREFIX):].split(":", 1)
+        owner_email = upload = None
+        with self.get_conn() as conn:
+            owner_email = self.metadata_cache.get_owner_email(conn.cursor(), owner_id)
+        if owner_email is not None:
+            try:
+                with self.download_from_provider(media_id, access_token) as file_data:
+                    upload = self.upload_media_file(owner_email, recipient_id, media_file_name, file_data)
+            except Exception as e:
+                self.logger.error("Media upload of incoming message %s failed: %s", incoming_message_id, e, exc_info=True)
+        if upload is None:
+            self.release_pending_media(incoming_message_id, attempts)
+            return
+
+        # Filled by after_commit, get_conn swallows a failed commit
+        saved = []
+        claim_lost = False
+        with self.get_conn() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f"""
+                SELECT 1 FROM manage_conversation_incomingmessage
+                WHERE id={self.param} AND status_details={self.param} AND media_attempts={self.param}
+                FOR UPDATE
+            """, (incoming_message_id, media_pending, attempts))
+            if cursor.fetchone() is None:
+                # The upload outlived its claim and another worker took over, the key is theirs now
+                claim_lost = True
+            else:
+                file_id, signed_url = self.record_media_file(cursor, upload)
+                cursor.execute(f"""
+                    UPDATE manage_conversation_incomingmessage SET status_details={self.param}
+                    WHERE id={self.param}
+                """, (str(file_id), incoming_message_id))
+                self.logger.info("Media of incoming message %s uploaded as file %s", incoming_message_id, file_id)
+                self.after_commit(saved.append, file_id)
+                self.after_commit(self.emitter.emit, "whatsapp_chat_media", {
+                    'message_id': incoming_message_id,
+                    'conversation_id': conversation_id,
+                    'organization_id': organization_id,
+                    'msg_from_type': 'CUSTOMER',
+                    'status_details': str(file_id),
+                    'media_url': signed_url
+                })
+        if saved:
+            return
+        if claim_lost:
+            self.logger.info("Claim on the media of incoming message %s expired during the upload", incoming_message_id)
+            return
+        self.delete_media_object(upload["file_key"])
+        self.release_pending_media(incoming_message_id, attempts)
+
+    def delete_media_object(self, file_key):
+        """Best effort removal of an uploaded file whose row could not be saved"""
+        try:
+            s3 = get_s3_client(
+                endpoint_url=os.getenv("B2_ENDPOINT_URL"),
+                access_key_id=os.getenv("B2_ACCESS_KEY_ID"),
+                secret_access_key=os.getenv("B2_SECRET_ACCESS_KEY")
+            )
+            s3.delete_object(Bucket=os.getenv("B2_STORAGE_BUCKET_NAME"), Key=file_key)
+        except Exception as e:
+            self.logger.error("Failed to delete orphaned media %s: %s", file_key, e)
+
+    def claim_pending_media(self, incoming_message_id, media_pending):
+        """Takes the upload for MEDIA_CLAIM_SECONDS and returns its attempt, None when it is held or done"""
+        attempts = None
+        with self.get_conn(own_transaction=True) as conn:
+            cursor = conn.cursor()
+            cursor.execute(f"""
+                UPDATE manage_conversation_incomingmessage
+                SET media_available_at = NOW() + make_interval(secs => {self.param}), media_attempts = media_attempts + 1
+                WHERE id={self.param} AND status_details={self.param}
+                  AND (media_available_at IS NULL OR media_available_at <= NOW())
+                RETURNING media_attempts
+            """, (self.media_claim_seconds, incoming_message_id, media_pending))
+            row = cursor.fetchone()
+            attempts = row[0] if row else None
+        return attempts
+
+    def renew_pending_media(self, incoming_message_id, media_pending, attempts):
+        """Extends a claim for another MEDIA_CLAIM_SECONDS, False when it is no longer ours"""
+        renewed = False
+        with self.get_conn(own_transaction=True) as conn:
+            cursor = conn.cursor()
+            cursor.execute(f"""
+                UPDATE manage_conversation_incomingmessage
+                SET media_available_at = NOW() + make_interval(secs => {self.param})
+                WHERE id={self.param} AND status_details={self.param} AND media_attempts={self.param}
+            """, (self.media_claim_seconds, incoming_message_id, media_pending, attempts))
+            renewed = cursor.rowcount == 1
+        return renewed
+
+    def release_pending_media(self, incoming_message_id, attempts):
+        """Makes a failed upload ready again after an exponential backoff, until the attempts run out"""
+        if attempts >= self.media_max_attempts:
+            # Left claimed, so neither the sweeper nor a restart picks it up again
+            self.logger.error("Giving up media upload of incoming message %s after %d attempts", incoming_message_id, attempts)
+            return
+        with self.get_conn(own_transaction=True) as conn:
+            cursor = conn.cursor()
+            # Only while the claim is still ours, another worker may have taken it over
+            cursor.execute(f"""
+                UPDATE manage_conversation_incomingmessage
+                SET media_available_at = NOW() + make_interval(secs => {self.param})
+                WHERE id={self.param} AND media_attempts={self.param}
+            """, (self.media_retry_base_seconds * 2 ** (attempts - 1), incoming_message_id, attempts))
+
+    def claim_due_pending_media(self, limit):
+        """
+        Claims up to limit pending uploads nobody holds, oldest first: those a stopped instance
+        left behind, those whose claim expired and failed ones whose backoff is over.
+        """
+        rows = []
+        with self.get_conn(own_transaction=True) as conn:
+            cursor = conn.cursor()
+            cursor.execute(f"""
+                WITH due AS (
+                    SELECT id FROM manage_conversation_incomingmessage
+                    WHERE status_details LIKE {self.param} AND media_attempts < {self.param}
+                      AND (media_available_at IS NULL OR media_available_at <= NOW())
+                    ORDER BY id
+                    LIMIT {self.param}
+                    FOR UPDATE SKIP LOCKED
+                )
+                UPDATE manage_conversation_incomingmessage im
+                SET media_available_at = NOW() + make_interval(secs => {self.param}), media_attempts = im.media_attempts + 1
+                FROM due, manage_platform_platform p, manage_contact_contact c
+                WHERE im.id = due.id AND p.id = im.platform_id AND c.id = im.contact_id
+                RETURNING im.id, im.conversation_id, im.organization_id, p.owner_id, c.phone, p.login_credentials, im.status_details, im.media_attempts
+            """, (MEDIA_PENDING_PREFIX + "%", self.media_max_attempts, limit, self.media_claim_seconds))
+            rows = cursor.fetchall()
+        return rows
+
+    def run_pending_media_sweeper(self):
+        """Hands the due pending uploads to the media pool, only as many as its queue has room for"""
+        interval = int(os.getenv("MEDIA_SWEEP_INTERVAL_SECONDS"))
+        while True:
+            free = self.media_pool.jobs.maxsize - self.media_pool.jobs.qsize()
+            if free > 0:
+                for row in self.claim_due_pending_media(free):
+                    self.logger.info("Resuming media upload of incoming message %s, attempt %d", row[0], row[-1])
+                    self.media_pool.submit(self.upload_pending_whatsapp_media, *row)
+            time.sleep(interval)
+
+    def handle_org_message_whatsapp(self, msg_data, retry_attempts=0):
+        self.handle_org_messages_whatsapp([msg_data], retry_attempts=retry_attempts)
+
+    @instrumented
+    def handle_org_messages_whatsapp(self, receipts, retry_attempts=0):
+        """
+        Applies a batch of whatsapp delivery receipts with one statement. Receipts of the same
+        message collapse to the furthest state, a message never moves back to an earlier one
+        and each touched conversation is notified once.
+        """
         try:
-            self.logger.info("Handling ORG level notification for whatsapp %s", msg_data)
-            message_id = msg_data['message_id']
-            message_status = msg_data['message_status']
-            error_details = msg_data.get("error_details", None)
-    
+            latest = {}
+            for msg_data in receipts:
+                current = latest.get(msg_data['message_id'])
+                if current is None or WHATSAPP_STATUS_RANK.get(msg_data['message_status'], 0) >= WHATSAPP_STATUS_RANK.get(current['message_status'], 0):
+                    latest[msg_data['message_id']] = msg_data
+            self.logger.info("Handling %d ORG level notifications for %d whatsapp messages", len(receipts), len(latest))
+
+            rows = []
+            params = []
+            for message_id, msg_data in latest.items():
+                error_details = msg_data.get("error_details", None)
+                rows.append(f"({self.param}::text, {self.param}::text, {self.param}::text, {self.param}::int)")
+                params.extend((
+                    message_id,
+                    msg_data['message_status'],
+                    json.dumps(error_details) if error_details else None,
+                    WHATSAPP_STATUS_RANK.get(msg_data['message_status'], 0)
+                ))
+
             with self.get_conn() as conn:
                 cursor = conn.cursor()
-                cursor.execute(
-                    "SELECT id, conversation_id, organization_id FROM manage_conversation_usermessage WHERE messageid=%s",
-                    (message_id,)
-                )
-                row = cursor.fetchone()
-    
-                if row:
-                    user_message_id, conversation_id, organization_id = row
-                    if error_details:
-                        self.logger.info("Found error_details")
-                        cursor.execute(
-                            "UPDATE manage_conversation_usermessage SET status=%s, status_details=%s WHERE id=%s",
-                            (message_status, json.dumps(error_details), user_message_id)
-                        )
-                    else:
-                        self.logger.info("No error_details found")
-                        cursor.execute(
-                            "UPDATE manage_conversation_usermessage SET status=%s WHERE conversation_id=%s AND status NOT IN ('failed', 'read')",
-                            (message_status, conversation_id)
-                        )
-    
-                    cursor.execute(
-                        "UPDATE manage_conversation_incomingmessage SET status='responded' WHERE conversation_id=%s",
-                        (conversation_id,)
+                # Failed receipts only touch their own message, the others move every message of
+                # the conversation that is behind them. The row a failed receipt updates is left
+                # out of the second update since a row must not be modified twice by a statement.
+                cursor.execute(f"""
+                    WITH receipts (messageid, status, status_details, rank) AS (
+                        VALUES {", ".join(rows)}
+                    ), matched AS (
+                        SELECT um.id, um.conversation_id, um.organization_id, r.messageid, r.status, r.status_details, r.rank
+                        FROM manage_conversation_usermessage um JOIN receipts r ON um.messageid = r.messageid
+                    ), failed AS (
+                        UPDATE manage_conversation_usermessage um
+                        SET status = m.status, status_details = m.status_details
+                        FROM matched m
+                        WHERE um.id = m.id AND m.status_details IS NOT NULL
+                    ), conversation_status AS (
+                        SELECT DISTINCT ON (conversation_id) conversation_id, status, rank
+                        FROM matched WHERE status_details IS NULL
+                        ORDER BY conversation_id, rank DESC
+                    ), progressed AS (
+                        UPDATE manage_conversation_usermessage um
+                        SET status = cs.status
+                        FROM conversation_status cs
+                        WHERE um.conversation_id = cs.conversation_id
+                          AND um.status IS DISTINCT FROM 'failed' AND um.status IS DISTINCT FROM 'read'
+                          AND CASE um.status WHEN 'sent' THEN 1 WHEN 'delivered' THEN 2 ELSE 0 END < cs.rank
+                          AND um.id NOT IN (SELECT id FROM matched WHERE status_details IS NOT NULL)
+                    ), responded AS (
+                        UPDATE manage_conversation_incomingmessage im
+                        SET status = 'responded'
+                        WHERE im.conversation_id IN (SELECT conversation_id FROM matched)
+                          AND im.status <> 'responded'
+                    ), cleared AS (
+                        DELETE FROM manage_conversation_statusretry sr
+                        WHERE sr.app_name = 'WHATSAPP' AND sr.message_id IN (SELECT messageid FROM matched)
                     )
-    
-                    self.logger.info("Updated message status for user_message_id: %s", user_message_id)
-    
-                    self.sio.emit("whatsapp_chat", {
+                    SELECT DISTINCT r.messageid, m.conversation_id, m.organization_id
+                    FROM receipts r LEFT JOIN matched m ON m.messageid = r.messageid
+                """, params)
+
+                conversations = {}
+                for message_id, conversation_id, organization_id in cursor.fetchall():
+                    if conversation_id is None:
+                        # The message is not saved yet, the receipt arrived ahead of it
+                        self.schedule_status_retry(cursor, "WHATSAPP", message_id, latest[message_id], retry_attempts + 1)
+                    else:
+                        conversations[conversation_id] = organization_id
+                        # Its stored retry, if any, was deleted by the statement
+                        self.after_commit(self.retry_scheduler.cancel, "WHATSAPP", message_id)
+                self.logger.info("Updated message status for %d conversations", len(conversations))
+
+                for conversation_id, organization_id in conversations.items():
+                    self.after_commit(self.emitter.emit, "whatsapp_chat", {
                         "conversation_id": conversation_id,
                         "msg_from_type": "ORG",
                         "organization_id": organization_id,
-                    })
-                else:
-                    retry_entry = self.retry_org_queue["whatsapp"].setdefault(
-                        message_id, {"retry_count": 0, "msg_data": msg_data}
-                    )
-                    if retry_entry["retry_count"] < 5:
-                        retry_entry["retry_count"] += 1
-                        self.logger.warning("Retrying message_id %s, attempt %d", message_id, retry_entry["retry_count"])
-                    else:
-                        self.logger.error("Retry limit exceeded for message_id %s", message_id)
+                    }, ("ORG", conversation_id))
         except Exception as e:
-            self.logger.critical("Error in handle_org_message_whatsapp: %s", e, exc_info=True)
-
-    def retry_whatsapp_org_task(self):
-        while True:
-            try:
-                if self.retry_org_queue["whatsapp"]:
-                    # Create a shallow copy to iterate while mutating original
-                    retry_items = list(self.retry_org_queue["whatsapp"].items())
-                    for message_id, entry in retry_items:
-                        self.handle_org_message_whatsapp(entry["msg_data"])
-                        # Remove only if retried or max retries exceeded
-                        if entry["retry_count"] >= 5:
-                            del self.retry_org_queue["whatsapp"][message_id]
-                else:
-                    time.sleep(60)
-            except Exception as e:
-                self.logger.critical("Error in retry_whatsapp_org_task: %s", e, exc_info=True)
-                time.sleep(60)
+            self.logger.critical("Error in handle_org_messages_whatsapp: %s", e, exc_info=True)
+
+    def schedule_status_retry(self, cursor, app_name, message_id, msg_data, attempts):
+        """
+        Stores a status notification whose message is not saved yet, to be retried after
+        an exponentially growing delay, or drops it once the attempts run out.
+        """
+        if attempts > self.status_retry_max_attempts:
+            cursor.execute(
+                f"DELETE FROM manage_conversation_statusretry WHERE app_name={self.param} AND message_id={self.param}",
+                (app_name, message_id)
+            )
+            self.after_commit(self.retry_scheduler.cancel, app_name, message_id)
+            self.logger.error("Retry limit exceeded for message_id %s", message_id)
+            return
+        next_attempt_at = datetime.now(pytz.utc) + timedelta(seconds=self.status_retry_base_seconds * 2 ** (attempts - 1))
+        cursor.execute(f"""
+            INSERT INTO manage_conversation_statusretry (app_name, message_id, payload, attempts, next_attempt_at, created_at)
+            VALUES ({self.param}, {self.param}, {self.param}, {self.param}, {self.param}, CURRENT_TIMESTAMP)
+            ON CONFLICT (app_name, message_id) DO UPDATE SET
+                payload = EXCLUDED.payload,
+                attempts = EXCLUDED.attempts,
+                next_attempt_at = EXCLUDED.next_attempt_at
+        """, (app_name, message_id, json.dumps(msg_data), attempts, next_attempt_at))
+        self.after_commit(self.retry_scheduler.schedule, next_attempt_at.timestamp(), app_name, message_id)
+        self.logger.warning("Retrying message_id %s, attempt %d at %s", message_id, attempts, next_attempt_at)
+
+    def retry_org_message(self, app_name, message_id):
+        """
+        Runs on the retry scheduler once a stored status notification is due. Every instance
+        schedules the retries it knows of, the one claiming the row runs it for
+        STATUS_RETRY_CLAIM_SECONDS while the others follow its next due time.
+        """
+        row = next_attempt_at = None
+        with self.get_conn() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f"""
+                UPDATE manage_conversation_statusretry
+                SET next_attempt_at = NOW() + make_interval(secs => {self.param})
+                WHERE id = (
+                    SELECT id FROM manage_conversation_statusretry
+                    WHERE app_name={self.param} AND message_id={self.param} AND next_attempt_at <= NOW()
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING payload, attempts, next_attempt_at
+            """, (self.status_retry_claim_seconds, app_name, message_id))
+            row = cursor.fetchone()
+            if not row:
+                cursor.execute(
+                    f"SELECT next_attempt_at FROM manage_conversation_statusretry WHERE app_name={self.param} AND message_id={self.param}",
+                    (app_name, message_id)
+                )
+                next_attempt_at = cursor.fetchone()
+        if not row:
+            # Already applied or dropped, otherwise claimed or moved by another instance
+            if next_attempt_at:
+                due_at = max(next_attempt_at[0].timestamp(), time.time() + self.status_retry_base_seconds)
+                self.retry_scheduler.schedule(due_at, app_name, message_id)
+            return
+        msg_data, attempts, claimed_until = row
+        # Looked at again once the claim expires, unless the attempt below applies or moves it
+        self.retry_scheduler.schedule(claimed_until.timestamp(), app_name, message_id)
+        if isinstance(msg_data, str):
+            msg_data = json.loads(msg_data)
+        if app_name == "WHATSAPP":
+            self.handle_org_message_whatsapp(msg_data, retry_attempts=attempts)
+
+    def load_status_retries(self):
+        """Puts the retries stored by a previous run back on the scheduler"""
+        with self.get_conn() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT app_name, message_id, next_attempt_at FROM manage_conversation_statusretry")
+            for app_name, message_id, next_attempt_at in cursor.fetchall():
+                self.retry_scheduler.schedule(next_attempt_at.timestamp(), app_name, message_id)
 
 
     @staticmethod
     def get_messenger_user_profile(psid, page_access_token):
-        url = f"https://graph.facebook.com/v18.0/{psid}"
+        url = f"{os.getenv('GRAPH_API_URL')}/{psid}"
         params = {
             "fields": "first_name,last_name,profile_pic",
             "access_token": page_access_token
@@ -747,6 +1876,7 @@ class WhatsAppKafkaConsumer:
         else:
             return {}
 
+    @instrumented
     def handle_customer_message_messenger(self, message):
         try:
             page_owner_id=message["page_owner_id"]
@@ -755,78 +1885,65 @@ class WhatsAppKafkaConsumer:
             msg=message["msg"]
             message_type=message["msg_type"]
             timestamp=message["timestamp"]
+            provider_message_id = message.get("provider_message_id")
             with self.get_conn() as conn:
                 cursor = conn.cursor()
-                cursor.execute(f"SELECT id, owner_id, login_credentials FROM manage_platform_platform WHERE login_id={self.param}", (page_owner_id,))
-                platform_row = cursor.fetchone()
+                platform_row = self.metadata_cache.get_platform_by_login_id(cursor, page_owner_id)
                 if not platform_row:
                     self.logger.warning("Platform not found for phone_number_id: %s", page_owner_id)
                     return
-                platform_id, owner_id, login_credentials = platform_row
+                platform_id, owner_id, login_credentials, _, _ = platform_row
+                if self.deduplicator.is_duplicate(cursor, platform_id, provider_message_id):
+                    self.logger.info("Skipping already saved messenger message %s", provider_message_id)
+                    return
 
-                cursor.execute(f"SELECT id, owner_id FROM manage_organization_organization WHERE owner_id={self.param}", (owner_id,))
-                org_row = cursor.fetchone()
+                org_row = self.metadata_cache.get_organization_by_owner(cursor, owner_id)
                 if not org_row:
                     self.logger.warning("Organization not found for owner_id: %s", owner_id)
                     return
-                organization_id, org_owner_id = org_row
-                contact_id, contact_name = None, None
+                organization_id, org_owner_id, _ = org_row
                 expires_at = int(time.time() * 1000) + 24 * 60 * 60 * 1000
                 current_ms = int(time.time() * 1000)
-                cursor.execute(f"SELECT id, name, image_expires_at FROM manage_contact_contact WHERE phone={self.param} AND organization_id={self.param}", (sender_id, organization_id))
-                contact_row = cursor.fetchone()
-                if contact_row:
-                    contact_id, contact_name, image_expires_at = contact_row
-                    # Check if image_expires_at is null or expired
-                    if image_expires_at is None or int(image_expires_at) < current_ms:
-                        # Refresh profile
-                        profile = WhatsAppKafkaConsumer.get_messenger_user_profile(sender_id, login_credentials)
-                        sender_name = profile.get("first_name")
-                        profile_pic_url = profile.get("profile_pic")
-
-                        # Update contact with new image and expiry time
-                        cursor.execute(
-                            f"""UPDATE manage_contact_contact
-                                SET image={self.param}, image_expires_at={self.param}, name={self.param}, updated_at={self.param}
-                                WHERE id={self.param}""",
-                            (profile_pic_url, expires_at, sender_name, datetime.now(), contact_id)
-                        )
-                else:
+                contact_id, contact_name, image_expires_at, _, conversation_id, is_conversation_new = self.upsert_contact_and_conversation(
+                    cursor,
+                    phone=sender_id,
+                    name=sender_id,
+                    organization_id=organization_id,
+                    created_by_id=org_owner_id,
+                    platform_name='messenger',
+                    platform_id=platform_id
+                )
+                # New contacts have no image_expires_at either, so this also fills their profile
+                if image_expires_at is None or int(image_expires_at) < current_ms:
+                    # Refresh profile
                     profile = WhatsAppKafkaConsumer.get_messenger_user_profile(sender_id, login_credentials)
-                    sender_name = profile.get("first_name")
+                    contact_name = profile.get("first_name") or contact_name
                     profile_pic_url = profile.get("profile_pic")
+
+                    # Update contact with new image and expiry time
                     cursor.execute(
-                        f"INSERT INTO manage_contact_contact (phone, name, image, image_expires_at, organization_id, created_by_id, platform_name, created_at, updated_at) VALUES ({self.param}, {self.param}, {self.param}, {self.param}, {self.param}, {self.param}, {self.param}, {self.param}, {self.param}) RETURNING id, name",
-                        (sender_id, sender_name, profile_pic_url, expires_at, organization_id, org_owner_id, 'messenger', datetime.now(), datetime.now())
+                        f"""UPDATE manage_contact_contact
+                            SET image={self.param}, image_expires_at={self.param}, name={self.param}, updated_at={self.param}
+                            WHERE id={self.param}""",
+                        (profile_pic_url, expires_at, contact_name, datetime.now(), contact_id)
                     )
-                    contact_id, contact_name = cursor.fetchone()
-                is_conversation_new = True
-                cursor.execute(f"""
-                    SELECT id FROM manage_conversation_conversation
-                    WHERE contact_id={self.param} AND platform_id={self.param} AND organization_id={self.param} AND status IN ('new', 'active')
-                    ORDER BY created_at DESC LIMIT 1
-                """, (contact_id, platform_id, organization_id))
-                conv_row = cursor.fetchone()
-                if conv_row:
-                    conversation_id = conv_row[0]
-                    is_conversation_new = False
-                else:
-                    cursor.execute(f"""
-                        INSERT INTO manage_conversation_conversation (contact_id, platform_id, organization_id, open_by, status, created_at, updated_at)
-                        VALUES ({self.param}, {self.param}, {self.param}, {self.param}, {self.param}, {self.param}, {self.param}) RETURNING id
-                    """, (contact_id, platform_id, organization_id, 'customer', 'new', datetime.now(), datetime.now()))
-                    conversation_id = cursor.fetchone()[0]
+                if is_conversation_new:
                     assigned_user_id, consultant_name = self.auto_assigner.auto_assign(cursor=cursor, conv_id=conversation_id, org_id=organization_id)
                     if assigned_user_id:
                         self.logger.info(f"Conversation {conversation_id} auto-assigned to user {assigned_user_id}")
                     else:
                         self.logger.info(f"Auto-assignment skipped for conversation {conversation_id}")
                 cursor.execute(f"""
-                    INSERT INTO manage_conversation_incomingmessage (conversation_id, contact_id, platform_id, organization_id, message_body, message_type, status_details, status, received_time, created_at)
-                    VALUES ({self.param}, {self.param}, {self.param}, {self.param}, {self.param}, {self.param}, {self.param}, 'unread', CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
+                    INSERT INTO manage_conversation_incomingmessage (conversation_id, contact_id, platform_id, organization_id, message_body, message_type, messageid, status_details, status, received_time, created_at)
+                    VALUES ({self.param}, {self.param}, {self.param}, {self.param}, {self.param}, {self.param}, {self.param}, {self.param}, 'unread', CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
+                    ON CONFLICT (platform_id, messageid) WHERE messageid IS NOT NULL DO NOTHING
                     RETURNING id, received_time, status, status_details
-                """, (conversation_id, contact_id, platform_id, organization_id, msg, message_type, None))
+                """, (conversation_id, contact_id, platform_id, organization_id, msg, message_type, provider_message_id, None))
                 msg_row = cursor.fetchone()
+                if not msg_row:
+                    self.logger.info("Messenger message %s was saved concurrently, skipping", provider_message_id)
+                    return
+                self.after_commit(self.deduplicator.remember, platform_id, provider_message_id)
                 payload = {
                     'id': contact_id,
                     'conversation_id': conversation_id,
@@ -842,10 +1959,11 @@ class WhatsAppKafkaConsumer:
                     'is_conversation_new': is_conversation_new
                 }
                 self.logger.info("New customer message saved for conversation_id: %s", conversation_id)
-                self.sio.emit("whatsapp_chat", payload)
+                self.after_commit(self.emitter.emit, "whatsapp_chat", payload)
         except Exception as e:
             self.logger.error("Error in handle_customer_message_whatsapp: %s", e, exc_info=True)
 
+    @instrumented
     def handle_org_message_messenger(self, message):
         try:
             page_owner_id=message["page_owner_id"]
@@ -855,19 +1973,17 @@ class WhatsAppKafkaConsumer:
             with self.get_conn() as conn:
                 # Step 1: Get conversation and organization based on sender_id and page_owner_id
                 cursor = conn.cursor()
-                cursor.execute(f"SELECT id, owner_id, login_credentials FROM manage_platform_platform WHERE login_id={self.param}", (page_owner_id,))
-                platform_row = cursor.fetchone()
+                platform_row = self.metadata_cache.get_platform_by_login_id(cursor, page_owner_id)
                 if not platform_row:
                     self.logger.warning("Platform not found for phone_number_id: %s", page_owner_id)
                     return
-                platform_id, owner_id, login_credentials = platform_row
+                platform_id, owner_id, login_credentials, _, _ = platform_row
 
-                cursor.execute(f"SELECT id, owner_id FROM manage_organization_organization WHERE owner_id={self.param}", (owner_id,))
-                org_row = cursor.fetchone()
+                org_row = self.metadata_cache.get_organization_by_owner(cursor, owner_id)
                 if not org_row:
                     self.logger.warning("Organization not found for owner_id: %s", owner_id)
                     return
-                organization_id, org_owner_id = org_row
+                organization_id, org_owner_id, _ = org_row
 
                 contact_id, contact_name = None, None
                 cursor.execute(f"SELECT id, name FROM manage_contact_contact WHERE phone={self.param} AND organization_id={self.param}", (sender_id, organization_id))
@@ -897,11 +2013,11 @@ class WhatsAppKafkaConsumer:
 
                         self.logger.info("Messenger | Updated message status for conversation_id: %s", conversation_id)
 
-                        self.sio.emit("whatsapp_chat", {
+                        self.after_commit(self.emitter.emit, "whatsapp_chat", {
                             "conversation_id": conversation_id,
                             "msg_from_type": "ORG",
                             'organization_id': organization_id,
-                        })
+                        }, ("ORG", conversation_id))
                     else:
                         self.logger.info("Messenger | Active conversation not found")
                 else:
@@ -911,6 +2027,7 @@ class WhatsAppKafkaConsumer:
 
 
 
+    @instrumented
     def handle_website_chatwidget_messages(self, data):
         try:
             print("Received web chat message:", data)
@@ -920,57 +2037,36 @@ class WhatsAppKafkaConsumer:
             message_body = data.get('data')
             helper_message = "Thank you for reaching us. Please wait whie we are looking for a best dedicated engineer to help with your query"
             if not organization_id:
-                self.sio.emit("website_chatwidget_messages_back_to_front", {
+                self.emitter.emit("website_chatwidget_messages_back_to_front", {
                     "message": "Warning: We found you are spoofing :)",
                     "user": data.get("user")
                 })
             with self.get_conn() as conn:
                 cursor = conn.cursor()
-                cursor.execute(f"SELECT id FROM manage_platform_platform WHERE platform_name={self.param} AND organization_id={self.param}", ('webchat', organization_id))
-                platform_row = cursor.fetchone()
-                if not platform_row:
+                platform_id = self.metadata_cache.get_webchat_platform_id(cursor, organization_id)
+                if not platform_id:
                     self.logger.warning("Platform not found for organization_id: %s", organization_id)
                     return
-                platform_id = platform_row[0]
 
                 # 1. Get Platform details
-                cursor.execute(f"SELECT owner_id FROM manage_organization_organization WHERE id={self.param}", (organization_id,))
-                org_row = cursor.fetchone()
+                org_row = self.metadata_cache.get_organization(cursor, organization_id)
                 if not org_row:
                     self.logger.warning("Organization not found for organization_id: %s", organization_id)
                     return
-                org_owner_id = org_row[0]
+                org_owner_id = org_row[1]
 
                 # 2. Get contact details
-                contact_id, contact_name = None, None
-                cursor.execute(f"SELECT id, name FROM manage_contact_contact WHERE phone={self.param} AND organization_id={self.param} AND platform_name={self.param}", (user_uuid_for_session, organization_id, 'webchat'))
-                contact_row = cursor.fetchone()
-                if contact_row:
-                    contact_id, contact_name = contact_row
-                else:
-                    cursor.execute(
-                        f"INSERT INTO manage_contact_contact (phone, name, organization_id, created_by_id, platform_name, created_at, updated_at) VALUES ({self.param}, {self.param}, {self.param}, {self.param}, {self.param}, {self.param}, {self.param}) RETURNING id, name",
-                        (user_uuid_for_session, user_uuid_for_session, organization_id, org_owner_id, 'webchat', datetime.now(), datetime.now())
-                    )
-                    contact_id, contact_name = cursor.fetchone()
-
-                is_conversation_new = True
-                #3. Start new / get existing conversation
-                cursor.execute(f"""
-                    SELECT id FROM manage_conversation_conversation
-                    WHERE contact_id={self.param} AND platform_id={self.param} AND organization_id={self.param} AND status IN ('new', 'active')
-                    ORDER BY created_at DESC LIMIT 1
-                """, (contact_id, platform_id, organization_id))
-                conv_row = cursor.fetchone()
-                if conv_row:
-                    is_conversation_new = False
-                    conversation_id = conv_row[0]
-                else:
-                    cursor.execute(f"""
-                        INSERT INTO manage_conversation_conversation (contact_id, platform_id, organization_id, open_by, status, created_at, updated_at)
-                        VALUES ({self.param}, {self.param}, {self.param}, {self.param}, {self.param}, {self.param}, {self.param}) RETURNING id
-                    """, (contact_id, platform_id, organization_id, 'customer', 'new', datetime.now(), datetime.now()))
-                    conversation_id = cursor.fetchone()[0]
+                # 2. Get contact details and 3. Start new / get existing conversation
+                contact_id, contact_name, _, _, conversation_id, is_conversation_new = self.upsert_contact_and_conversation(
+                    cursor,
+                    phone=user_uuid_for_session,
+                    name=user_uuid_for_session,
+                    organization_id=organization_id,
+                    created_by_id=org_owner_id,
+                    platform_name='webchat',
+                    platform_id=platform_id
+                )
+                if is_conversation_new:
                     assigned_user_id, consultant_name = self.auto_assigner.auto_assign(cursor=cursor, conv_id=conversation_id, org_id=organization_id)
                     if assigned_user_id:
                         self.logger.info(f"Conversation {conversation_id} auto-assigned to user {assigned_user_id}")
@@ -1006,15 +2102,44 @@ class WhatsAppKafkaConsumer:
                 }
                 self.logger.info("Webchat | New customer message saved for conversation_id: %s", conversation_id)
 
-                self.sio.emit("whatsapp_chat", payload_main_ui_client)
-                self.sio.emit("website_chatwidget_messages_back_to_front", payload_chat_widget_client)
+                self.after_commit(self.emitter.emit, "whatsapp_chat", payload_main_ui_client)
+                self.after_commit(self.emitter.emit, "website_chatwidget_messages_back_to_front", payload_chat_widget_client)
         except Exception as e:
             self.logger.error("Error in handle_website_chatwidget_messages: %s", e, exc_info=True)
 
+    @contextmanager
+    def open_gmail_attachment(self, attachment):
+        """
+        Yields a readable stream of a gmail attachment. The webhook parks attachments in B2 and
+        sends their claim_key, messages published by older webhooks carry base64 data or a path.
+        """
+        if attachment.get("claim_key"):
+            s3 = get_s3_client(
+                endpoint_url=os.getenv("B2_ENDPOINT_URL"),
+                access_key_id=os.getenv("B2_ACCESS_KEY_ID"),
+                secret_access_key=os.getenv("B2_SECRET_ACCESS_KEY")
+            )
+            try:
+                body = s3.get_object(Bucket=os.getenv("B2_STORAGE_BUCKET_NAME"), Key=attachment["claim_key"])["Body"]
+            except ClientError as e:
+                if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                    raise MissingAttachmentClaim(attachment["claim_key"]) from e
+                raise
+            try:
+                yield body
+            finally:
+                body.close()
+        elif attachment.get("data_base64"):
+            yield BytesIO(base64.b64decode(attachment["data_base64"]))
+        else:
+            with open(attachment["path"], "rb") as f:
+                yield f
+
     def normalize_subject(self, subject: str) -> str:
         # Remove Re:, Re[2]:, Fwd:, FW: etc.
         return re.sub(r'^(?:(re(\[\d+\])?|fw(d)?):\s*)+', '', subject, flags=re.IGNORECASE).strip()
 
+    @instrumented
     def handle_customer_message_gmail(self, message):
         try:
             email_address = message["phone_number_id"]
@@ -1039,57 +2164,39 @@ class WhatsAppKafkaConsumer:
             with self.get_conn() as conn:
                 cursor = conn.cursor()
                 # 1. Fetch Gmail platform
-                cursor.execute("""
-                    SELECT id, owner_id FROM manage_platform_platform
-                    WHERE login_id = %s
-                """, (email_address,))
-                platform_row = cursor.fetchone()
+                platform_row = self.metadata_cache.get_platform_by_login_id(cursor, email_address)
                 if not platform_row:
                     self.logger.warning("📭 Gmail platform not found for: %s", email_address)
                     return
-                platform_id, owner_id = platform_row
+                platform_id, owner_id = platform_row[:2]
                 # 2. Fetch organization
-                cursor.execute("""
-                    SELECT id FROM manage_organization_organization
-                    WHERE owner_id = %s
-                """, (owner_id,))
-                org_row = cursor.fetchone()
+                org_row = self.metadata_cache.get_organization_by_owner(cursor, owner_id)
                 if not org_row:
                     self.logger.warning("🏢 Organization not found for owner_id: %s", owner_id)
                     return
                 # 3. Blocked contact check BEFORE creating/fetching contact
-                cursor.execute(f"""
-                    SELECT 1 FROM manage_platform_blockedcontact
-                    WHERE platform_id={self.param} AND contact_value={self.param}
-                    LIMIT 1
-                """, (platform_id, sender_email_addr))
-                is_blocked = cursor.fetchone()
-                if is_blocked:
+                if self.metadata_cache.is_blocked(cursor, platform_id, sender_email_addr):
                     self.logger.warning("🚫 Blocked contact %s on platform_id %s — skipping message.", sender_email_addr, platform_id)
                     return
+                # Checked before the attachments are uploaded so a redelivery costs one lookup
+                if self.deduplicator.is_duplicate(cursor, platform_id, message_id):
+                    self.logger.info("Skipping already saved gmail message %s", message_id)
+                    return
                 organization_id = org_row[0]
-                # 4. Fetch or create contact
-                cursor.execute(f"""
-                    SELECT id, name FROM manage_contact_contact
-                    WHERE phone={self.param} AND organization_id={self.param}
-                """, (sender_email_addr, organization_id))
-                contact = cursor.fetchone()
-                if contact:
-                    contact_id, _ = contact
-                else:
-                    cursor.execute(f"""
-                        INSERT INTO manage_contact_contact
-                        (phone, name, organization_id, created_by_id, platform_name, created_at, updated_at)
-                        VALUES ({self.param}, {self.param}, {self.param}, {self.param}, {self.param}, NOW(), NOW())
-                        RETURNING id
-                    """, (sender_email_addr, sender_email_addr, organization_id, owner_id, 'gmail'))
-                    contact_id = cursor.fetchone()[0]
+                # 4. Fetch or create contact and 5. its conversation for this thread
+                contact_id, _, _, _, conversation_id, is_conversation_new = self.upsert_contact_and_conversation(
+                    cursor,
+                    phone=sender_email_addr,
+                    name=sender_email_addr,
+                    organization_id=organization_id,
+                    created_by_id=owner_id,
+                    platform_name='gmail',
+                    platform_id=platform_id,
+                    subject=normalized_subject,
+                    thread_id=thread_id
+                )
                 if attachments:
-                    cursor.execute(f"SELECT email FROM manage_users_customuser WHERE id={self.param}", (owner_id,))
-                    owner_email_row = cursor.fetchone()
-                    if not owner_email_row:
-                        raise Exception("Owner email not found")
-                    owner_email = owner_email_row[0]
+                    owner_email = self.metadata_cache.get_owner_email(cursor, owner_id)
                     #for attachment in attachments:
                     #    try:
                     #        filename = attachment.get("filename")
@@ -1120,27 +2227,19 @@ class WhatsAppKafkaConsumer:
                         try:
                             filename = attachment.get("filename")
                             mime_type = attachment.get("mime_type", "application/octet-stream")
-                            base64_data = attachment.get("data_base64")
                             file_path = attachment.get("path")
                             # Skip if no file source
-                            if not filename or (not base64_data and not file_path):
-                                continue
-                            # Load file from base64 or file path
-                            if base64_data:
-                                file_data = BytesIO(base64.b64decode(base64_data))
-                            elif file_path:
-                                with open(file_path, "rb") as f:
-                                    file_data = BytesIO(f.read())
-                            else:
+                            if not filename or not (attachment.get("claim_key") or attachment.get("data_base64") or file_path):
                                 continue
                             # Upload to S3
-                            file_id, signed_url = self.save_media_file_to_s3_raw_sql(
-                                conn=conn,
-                                user_identifier=owner_email,
-                                receiver_name=sender_email_addr,
-                                filename=filename,
-                                file_data=file_data
-                            )
+                            with self.open_gmail_attachment(attachment) as file_data:
+                                file_id, signed_url = self.save_media_file_to_s3_raw_sql(
+                                    conn=conn,
+                                    user_identifier=owner_email,
+                                    receiver_name=sender_email_addr,
+                                    filename=filename,
+                                    file_data=file_data
+                                )
                             file_ids.append(file_id)
                             signed_urls.append(signed_url)
                             file_type_map[file_id] = mime_type
@@ -1149,44 +2248,36 @@ class WhatsAppKafkaConsumer:
                                 "type": mime_type,
                                 "filename": filename
                             })
+                        except MissingAttachmentClaim as ex:
+                            # The webhook parks claims before publishing and reads are consistent,
+                            # redelivering would not bring it back. Saved flagged as missing instead.
+                            self.logger.error("Claim %s of attachment %s of gmail message %s is missing", ex, filename, message_id)
+                            GMAIL_ATTACHMENTS_MISSING.inc()
+                            content_blocks.append({"type": "attachment_missing", "filename": filename, "mime_type": mime_type})
+                            medial_urls_for_client.append({
+                                "url": None,
+                                "type": mime_type,
+                                "filename": filename,
+                                "missing": True
+                            })
                         except Exception as ex:
                             self.logger.error(f"Error saving attachment: {ex}", exc_info=True)
                         else:
                             if file_path:
                                 os.remove(file_path)
 
-                # 5. Fetch or create conversation by message_id
-                # AND LOWER(TRIM(REGEXP_REPLACE(subject, '^(re(\\[\\d+\\])?:|fw(d)?):\\s*', '', 'gi'))) = LOWER(%s)
-                cursor.execute("""
-                    SELECT id FROM manage_conversation_conversation
-                    WHERE contact_id = %s AND platform_id = %s AND organization_id = %s AND thread_id = %s
-                    AND status IN ('new', 'active')
-                    ORDER BY created_at DESC
-                    LIMIT 1
-                """, (contact_id, platform_id, organization_id, thread_id,))
-                convo = cursor.fetchone()
-                if convo:
-                    conversation_id = convo[0]
-                    is_conversation_new = False
+                if not is_conversation_new:
                     # ✅ Optionally update subject if it changed (while keeping same thread)
                     cursor.execute(f"""
                         UPDATE manage_conversation_conversation SET subject={self.param}, updated_at=NOW() WHERE id={self.param} AND subject !={self.param}""", (normalized_subject, conversation_id, normalized_subject))
                     cursor.execute(f"""
                         UPDATE manage_conversation_usermessage SET status={self.param} WHERE conversation_id={self.param} AND status NOT IN ('failed', 'read')""", ('read', conversation_id)) # Update all messages w.r.t conversation_id instead of specific user_message_id since all messages would have the same status by the action of customer like while opening and reading the message
                 else:
-                    cursor.execute(f"""
-                        INSERT INTO manage_conversation_conversation
-                        (contact_id, platform_id, organization_id, open_by, status, subject, thread_id, created_at, updated_at)
-                        VALUES ({self.param}, {self.param}, {self.param}, {self.param}, {self.param}, {self.param}, {self.param}, NOW(), NOW())
-                        RETURNING id
-                    """, (contact_id, platform_id, organization_id, 'customer', 'new', normalized_subject, thread_id))
-                    conversation_id = cursor.fetchone()[0]
                     assigned_user_id, consultant_name = self.auto_assigner.auto_assign(cursor=cursor, conv_id=conversation_id, org_id=organization_id)
                     if assigned_user_id:
                         self.logger.info(f"Conversation {conversation_id} auto-assigned to user {assigned_user_id}")
                     else:
                         self.logger.info(f"Auto-assignment skipped for conversation {conversation_id}")
-                    is_conversation_new = True
                 message_type = message_type if not file_type_map else json.dumps(file_type_map)
                 # 6. Insert into incoming messages
                 cursor.execute(f"""
@@ -1194,10 +2285,15 @@ class WhatsAppKafkaConsumer:
                     (conversation_id, contact_id, platform_id, organization_id,
                      message_body, message_type, messageid, content_blocks, status, status_details, received_time, created_at)
                     VALUES ({self.param}, {self.param}, {self.param}, {self.param}, {self.param}, {self.param}, {self.param}, {self.param}, 'unread', {self.param}, {self.param}, NOW())
+                    ON CONFLICT (platform_id, messageid) WHERE messageid IS NOT NULL DO NOTHING
                     RETURNING id, received_time
                 """, (conversation_id, contact_id, platform_id, organization_id,
                       message_body, message_type, message_id, json.dumps(content_blocks), json.dumps(file_ids), received_time))
                 msg_row = cursor.fetchone()
+                if not msg_row:
+                    # Raises so the savepoint drops the file rows created for this copy
+                    raise Exception(f"Gmail message {message_id} was saved concurrently")
+                self.after_commit(self.deduplicator.remember, platform_id, message_id)
                 # 7. Emit via Socket.IO
                 payload = {
                     'id': contact_id,
@@ -1215,7 +2311,7 @@ class WhatsAppKafkaConsumer:
                     'media_urls': medial_urls_for_client,
                     'content_blocks': content_blocks
                 }
-                self.sio.emit("whatsapp_chat", payload)
+                self.after_commit(self.emitter.emit, "whatsapp_chat", payload)
                 self.logger.info("📩 Gmail message saved for conversation_id: %s", conversation_id)
         except Exception as e:
             self.logger.error("❌ Error in handle_customer_message_gmail: %s", e, exc_info=True)
@@ -1225,31 +2321,200 @@ class WhatsAppKafkaConsumer:
         config['group.id'] = self.group_id
         config['auto.offset.reset'] = 'earliest'
         consumer = ConfluentConsumer(config)
-        consumer.subscribe([self.topic])
-        time.sleep(60) # Waiting for connection to be established with broker
+
+        # Batches handed to the worker lanes, offsets are committed strictly in this order
+        in_flight = deque()
+        # Batches taken off in_flight since one of them failed, rewound once all have finished
+        uncommitted = []
+
+        def commit(tracker):
+            try:
+                consumer.commit(offsets=self.batch_commit_offsets(tracker.msgs), asynchronous=False)
+            except KafkaException as e:
+                # Revoked meanwhile, the new owner resumes from the last commit that went through
+                self.logger.warning("Failed to commit offsets of a batch: %s", e)
+
+        def settle(tracker):
+            # Nothing after a failed batch is committed, that would skip the failed messages
+            if tracker.ok and not uncommitted:
+                commit(tracker)
+            else:
+                uncommitted.append(tracker)
+
+        def rewind():
+            # Every partition the uncommitted batches touched goes back to its earliest offset
+            # among them, batches that did commit after the failed one are delivered again too
+            for tp in self.batch_start_offsets([msg for batch in uncommitted for msg in batch.msgs]):
+                try:
+                    consumer.seek(tp)
+                except KafkaException as e:
+                    self.logger.warning("Failed to rewind %s[%s] to %s: %s", tp.topic, tp.partition, tp.offset, e)
+            uncommitted.clear()
+
+        def on_revoke(consumer, partitions):
+            # Only committed offsets survive the rebalance, so settle every batch in flight first.
+            # Runs inside poll, the lanes are waited on without polling.
+            self.logger.info("Partitions revoked, settling %d batches in flight", len(in_flight))
+            while in_flight:
+                tracker = in_flight.popleft()
+                tracker.done.wait()
+                settle(tracker)
+            if uncommitted:
+                rewind()
+
+        consumer.subscribe([self.topic], on_revoke=on_revoke)
+        time.sleep(int(os.getenv("KAFKA_STARTUP_WAIT_SECONDS"))) # Waiting for connection to be established with broker
         self.logger.info("Started Kafka consumer, subscribed to topic: %s", self.topic)
 
+        lag_recorded_at = 0
         try:
             while True:
-                msg = consumer.poll(timeout=1.0)
-                if msg is None:
+                if time.monotonic() - lag_recorded_at >= self.lag_interval_seconds:
+                    self.record_consumer_lag(consumer)
+                    lag_recorded_at = time.monotonic()
+                # Returns as soon as batch_size messages are available or the linger expires
+                msgs = consumer.consume(num_messages=self.batch_size, timeout=self.batch_linger_seconds)
+                batch = []
+                routed = []
+                for msg in msgs:
+                    if msg.error():
+                        if msg.error().code() == KafkaError._PARTITION_EOF:
+                            self.logger.debug("End of partition: %s", msg.error())
+                        else:
+                            self.logger.error("Kafka consumer error: %s", msg.error())
+                        continue
+                    batch.append(msg)
+                    try:
+                        route = self.read_route(msg)
+                        self.logger.debug("Received Kafka message %s[%s]@%s route %s", msg.topic(), msg.partition(), msg.offset(), route)
+                        routed.append((msg, route))
+                    except Exception as e:
+                        self.logger.error("Failed to route message: %s", e, exc_info=True)
+                if batch:
+                    in_flight.append(self.worker_pool.submit(batch, routed))
+
+                # Once a lane failed to commit the rest is drained before rewinding
+                while in_flight and (in_flight[0].done.is_set() or uncommitted or len(in_flight) > self.max_in_flight_batches):
+                    self.wait_for_batch(consumer, in_flight[0])
+                    # on_revoke may have settled it while polling
+                    if in_flight:
+                        settle(in_flight.popleft())
+                if uncommitted and not in_flight:
+                    rewind()
                     time.sleep(1)
-                    continue
-                if msg and msg.error():
-                    if msg.error().code() == KafkaError._PARTITION_EOF:
-                        self.logger.debug("End of partition: %s", msg.error())
-                    else:
-                        self.logger.error("Kafka consumer error: %s", msg.error())
-                    continue
+        finally:
+            self.logger.info("Stopping Kafka consumer...")
+            consumer.close()
+            if self.db_pool:
+                self.db_pool.closeall()
+
+    def process_batch(self, messages):
+        """
+        Runs every (route, raw value, decoded value) message of a lane's share of the batch
+        inside a single transaction. Returns True only when the transaction was committed.
+        """
+        conn = self.open_conn()
+        self._local.batch_conn = conn
+        self._local.after_commit = callbacks = []
+        discard = False
+        committed = False
+        try:
+            whatsapp_receipts = []
+            for route, raw_value, message_value in messages:
                 try:
-                    message_value = json.loads(msg.value().decode('utf-8'))
-                    self.logger.info("Received Kafka message: %s", message_value)
-                    self.process_message(message_value)
+                    if route is None:
+                        if message_value is None:
+                            message_value = orjson.loads(raw_value)
+                        route = (message_value.get("msg_from_type"), message_value.get("app_name"), 1)
+                    msg_from_type, app_name, schema_version = route
+                    MESSAGES_CONSUMED.labels(app_name=app_name or "unknown", msg_from_type=msg_from_type or "unknown").inc()
+                    if schema_version > KAFKA_SCHEMA_VERSION:
+                        self.logger.warning("Message schema_version %s is newer than %s, handling it anyway", schema_version, KAFKA_SCHEMA_VERSION)
+                    handler = self.get_handler(msg_from_type, app_name)
+                    if handler is None:
+                        self.logger.info("No handler for %s message from %s", app_name, msg_from_type)
+                        continue
+                    # Bodies are only decoded once a handler wants them
+                    if message_value is None:
+                        message_value = orjson.loads(raw_value)
+                    if handler == self.handle_org_message_whatsapp:
+                        # Applied together once the rest of the batch is processed
+                        whatsapp_receipts.append(message_value)
+                        continue
+                    handler(message_value)
                 except Exception as e:
                     self.logger.error("Failed to process message: %s", e, exc_info=True)
+            if whatsapp_receipts:
+                self.handle_org_messages_whatsapp(whatsapp_receipts)
+            conn.commit()
+            committed = True
+        except Exception as e:
+            self.logger.error("Failed to commit batch of %d messages: %s", len(messages), e, exc_info=True)
+            discard = self.is_connection_error(e)
+            try:
+                conn.rollback()
+            except Exception:
+                discard = True
         finally:
-            self.logger.info("Stopping Kafka consumer...")
-            consumer.close()
+            self._local.batch_conn = None
+            self._local.after_commit = None
+            self.release_conn(conn, discard=discard)
+        # Run once the connection is back in the pool, these may block on the media queue
+        if committed:
+            self.run_after_commit(callbacks)
+        return committed
+
+    def record_consumer_lag(self, consumer):
+        try:
+            assignment = consumer.assignment()
+            if not assignment:
+                return
+            for tp in consumer.committed(assignment, timeout=5):
+                low, high = consumer.get_watermark_offsets(tp, timeout=5)
+                # Negative offset means nothing was committed yet on that partition
+                committed = tp.offset if tp.offset >= 0 else low
+                CONSUMER_LAG.labels(topic=tp.topic, partition=tp.partition).set(max(high - committed, 0))
+        except Exception as e:
+            self.logger.warning("Failed to record consumer lag: %s", e)
+
+    def wait_for_batch(self, consumer, tracker):
+        """
+        Waits for the lanes to finish a batch while still polling with every partition paused,
+        so a slow lane, e.g. one blocked on a full media queue, cannot exceed
+        max.poll.interval.ms and get this consumer evicted from the group.
+        """
+        if tracker.done.is_set():
+            return
+        assignment = consumer.assignment()
+        consumer.pause(assignment)
+        try:
+            while not tracker.done.wait(timeout=1):
+                msg = consumer.poll(0)
+                if msg is not None and not msg.error():
+                    # Fetched before the pause took effect, read it again once resumed
+                    consumer.seek(TopicPartition(msg.topic(), msg.partition(), msg.offset()))
+        finally:
+            try:
+                consumer.resume(assignment)
+            except KafkaException as e:
+                # Revoked while waiting, newly assigned partitions are not paused
+                self.logger.info("Could not resume partitions after a rebalance: %s", e)
+
+    @staticmethod
+    def batch_commit_offsets(msgs):
+        offsets = {}
+        for msg in msgs:
+            key = (msg.topic(), msg.partition())
+            offsets[key] = max(offsets.get(key, -1), msg.offset() + 1)
+        return [TopicPartition(topic, partition, offset) for (topic, partition), offset in offsets.items()]
+
+    @staticmethod
+    def batch_start_offsets(msgs):
+        offsets = {}
+        for msg in msgs:
+            key = (msg.topic(), msg.partition())
+            offsets[key] = min(offsets.get(key, msg.offset()), msg.offset())
+        return [TopicPartition(topic, partition, offset) for (topic, partition), offset in offsets.items()]
 
     def devlmode(self):
         try:
@@ -1259,7 +2524,6 @@ class WhatsAppKafkaConsumer:
             self.logger.info("Closing long running main thread")
 
 
-from threading import Thread
 if __name__ == "__main__":
     consumer = WhatsAppKafkaConsumer()
     consumer.consume()
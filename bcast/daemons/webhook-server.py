@@ -1,71 +1,196 @@
 import os
+import sys
 import json
 import traceback
 import logging
 import time
-from threading import Thread
+import atexit
+import signal
+from threading import Thread, Lock, BoundedSemaphore, Condition, current_thread, main_thread
+import select
 import hmac
 import hashlib
 import psycopg2
+from psycopg2.pool import ThreadedConnectionPool
 from contextlib import contextmanager
 import base64
+from email.utils import parseaddr
 import json
 import re
 from html import escape
 
+import orjson
+from cachetools import TTLCache
 from flask import Flask, request, jsonify
 
-from confluent_kafka import Producer, KafkaError
+from confluent_kafka import Producer, KafkaException
+from prometheus_client import Counter, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
 
 from bs4 import BeautifulSoup
 
 from google.auth.transport.requests import Request
-from googleapiclient.errors import HttpError
 from google.auth.exceptions import RefreshError
 from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
+from googleapiclient.discovery import build, build_from_document
+from googleapiclient.discovery_cache import get_static_doc
 
 from decouple import config
 
+from VendorApi.B2.client import get_s3_client
+from VendorApi.Gmail.fetch import list_history_message_ids, get_messages, get_attachments
+
 db_driver = psycopg2
 
+# Gmail attachments are parked under this prefix and only their key goes through kafka, so
+# the consumer can read them from any node. Expire the prefix with a bucket lifecycle rule.
+CLAIM_CHECK_PREFIX = config("CLAIM_CHECK_PREFIX", default="claim-check/")
+
+# Workers fetching the mailboxes queued by Gmail pushes, see gmail_push_webhook
+GMAIL_PUSH_WORKERS = config("GMAIL_PUSH_WORKERS", default=4, cast=int)
+# A claimed mailbox not finished within this long is handed to another worker
+GMAIL_PUSH_CLAIM_SECONDS = config("GMAIL_PUSH_CLAIM_SECONDS", default=600, cast=int)
+GMAIL_PUSH_POLL_SECONDS = config("GMAIL_PUSH_POLL_SECONDS", default=5, cast=int)
+GMAIL_PUSH_RETRY_BASE_SECONDS = config("GMAIL_PUSH_RETRY_BASE_SECONDS", default=30, cast=int)
+GMAIL_PUSH_MAX_ATTEMPTS = config("GMAIL_PUSH_MAX_ATTEMPTS", default=6, cast=int)
+gmail_push_wakeup = Condition()
+# Another root than Google's for the Gmail API calls, e.g. the stand-in of benchmark_pipeline.py
+GMAIL_API_URL = config("GMAIL_API_URL", default="")
+
+# Must match METADATA_NOTIFY_CHANNEL in manage_platform/signals.py
+METADATA_NOTIFY_CHANNEL = "daemon_metadata_invalidation"
+
+db_params = {
+    "dbname": config("PG_DB"),
+    "user": config("PG_USER"),
+    "password": config("PG_PASSWORD"),
+    "host": config("PG_HOST", "localhost"),
+    "port": config("PG_PORT", "5432")
+}
+PG_POOL_MAX_CONN = config("PG_POOL_MAX_CONN", default=10, cast=int)
+db_pool = ThreadedConnectionPool(config("PG_POOL_MIN_CONN", default=1, cast=int), PG_POOL_MAX_CONN, **db_params)
+# Checkout blocks once every connection is busy instead of failing the request
+db_pool_slots = BoundedSemaphore(PG_POOL_MAX_CONN)
+
 @contextmanager
 def get_conn(auto_commit=True):
-    conn = db_driver.connect(
-        dbname=config("PG_DB"),
-        user=config("PG_USER"),
-        password=config("PG_PASSWORD"),
-        host=config("PG_HOST", "localhost"),
-        port=config("PG_PORT", "5432")
-    )
+    db_pool_slots.acquire()
+    conn = None
+    discard = False
     try:
+        conn = db_pool.getconn()
         yield conn
         if auto_commit:
             conn.commit()
-    except Exception:
+    except Exception as e:
         import traceback
         traceback.print_exc()
+        discard = isinstance(e, (psycopg2.OperationalError, psycopg2.InterfaceError))
         raise  # re-raise so caller knows about it
     finally:
-        conn.close()
+        if conn is not None:
+            discard = discard or conn.closed != 0
+            if not discard:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    discard = True
+            db_pool.putconn(conn, close=discard)
+        db_pool_slots.release()
+
+
+class SecretKeyCache:
+    """
+    Signature secrets of the platforms by login_id, so verifying a webhook stays in memory.
+    Login ids without a platform are remembered for a shorter time. Entries are dropped as
+    soon as django notifies that their platform changed.
+    """
+    def __init__(self, maxsize, ttl, unknown_ttl):
+        self._lock = Lock()
+        self._secrets = TTLCache(maxsize=maxsize, ttl=ttl)  # login_id -> (platform_id, secret_key)
+        self._unknown = TTLCache(maxsize=maxsize, ttl=unknown_ttl)
+        # Bumped by every invalidation, a lookup racing one must not cache what it read
+        self._generation = 0
+
+    def get(self, login_id):
+        with self._lock:
+            entry = self._secrets.get(login_id)
+            if entry is not None:
+                return entry[1]
+            if login_id in self._unknown:
+                return None
+            generation = self._generation
+        with get_conn(auto_commit=False) as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("""
+                    SELECT id, secret_key FROM manage_platform_platform
+                    WHERE login_id = %s
+                    LIMIT 1
+                """, (login_id,))
+                row = cursor.fetchone()
+        with self._lock:
+            if generation == self._generation:
+                if row:
+                    self._secrets[login_id] = tuple(row)
+                else:
+                    self._unknown[login_id] = True
+        return row[1] if row else None
+
+    def invalidate(self, payload):
+        with self._lock:
+            self._generation += 1
+            if payload.get("model") != "platform":
+                return
+            # The login_id itself may have changed, so match the cached rows by platform id too
+            self._unknown.pop(payload.get("login_id"), None)
+            self._secrets.pop(payload.get("login_id"), None)
+            for login_id, (platform_id, _) in list(self._secrets.items()):
+                if platform_id == payload.get("id"):
+                    self._secrets.pop(login_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._secrets.clear()
+            self._unknown.clear()
+
+    def listen_for_invalidations(self):
+        """Blocking loop, LISTENs on its own connection and reconnects when it drops"""
+        while True:
+            conn = None
+            try:
+                conn = db_driver.connect(**db_params)
+                conn.set_session(autocommit=True)
+                with conn.cursor() as cursor:
+                    cursor.execute(f"LISTEN {METADATA_NOTIFY_CHANNEL}")
+                # Changes made while we were not listening are unknown
+                self.clear()
+                while True:
+                    if select.select([conn], [], [], 60) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        notify = conn.notifies.pop(0)
+                        try:
+                            self.invalidate(json.loads(notify.payload))
+                        except ValueError:
+                            self.clear()
+            except Exception as e:
+                logger.error(f"Secret key invalidation listener failed: {e}")
+                time.sleep(5)
+            finally:
+                if conn is not None:
+                    conn.close()
 
 
-def get_secret_key_by_login_id(login_id: str):
-    query = """
-    SELECT secret_key FROM manage_platform_platform
-    WHERE login_id = %s
-    LIMIT 1
-    """
-    # Replace your_app_platform with your actual table name (usually app_label + model_name lowercase)
+secret_keys = SecretKeyCache(
+    maxsize=config("SECRET_KEY_CACHE_SIZE", default=10000, cast=int),
+    ttl=config("SECRET_KEY_CACHE_TTL_SECONDS", default=300, cast=int),
+    unknown_ttl=config("SECRET_KEY_UNKNOWN_TTL_SECONDS", default=60, cast=int)
+)
 
-    with get_conn(auto_commit=False) as conn:
-        with conn.cursor() as cursor:
-            cursor.execute(query, (login_id,))
-            row = cursor.fetchone()
-            if row:
-                return row[0]
-            else:
-                return None
+
+def get_secret_key_by_login_id(login_id: str):
+    return secret_keys.get(login_id)
 
 app = Flask(__name__)
 
@@ -75,6 +200,26 @@ logger = logging.getLogger(__name__)
 
 # Kafka Configuration
 TOPIC = 'whatsapp'
+# Bumped on incompatible payload changes, see KAFKA_SCHEMA_VERSION in start_conversation_tasks.py
+SCHEMA_VERSION = 1
+# Messages produced and not yet acknowledged by the broker. Past the budget webhooks are
+# answered with 503 so the provider retries them later instead of us queueing without bound.
+KAFKA_MAX_IN_FLIGHT = config("KAFKA_MAX_IN_FLIGHT", default=50000, cast=int)
+KAFKA_PRODUCE_WAIT_SECONDS = config("KAFKA_PRODUCE_WAIT_MS", default=200, cast=int) / 1000
+KAFKA_RETRY_AFTER_SECONDS = config("KAFKA_RETRY_AFTER_SECONDS", default=5, cast=int)
+# How long a shutdown waits for kafka to acknowledge what is still queued or lingering
+KAFKA_FLUSH_TIMEOUT_SECONDS = config("KAFKA_FLUSH_TIMEOUT_SECONDS", default=30, cast=int)
+# Messages the broker never acknowledged are appended here as JSON lines for replay
+KAFKA_DEAD_LETTER_PATH = config("KAFKA_DEAD_LETTER_PATH", default="undelivered_kafka_messages.jsonl")
+
+KAFKA_IN_FLIGHT = Gauge("webhook_kafka_in_flight", "Messages produced and not yet acknowledged by kafka")
+KAFKA_DELIVERY_LATENCY = Histogram(
+    "webhook_kafka_delivery_seconds", "Time from produce to the broker acknowledgement",
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+)
+KAFKA_DELIVERY_FAILURES = Counter("webhook_kafka_delivery_failures_total", "Messages kafka did not acknowledge")
+KAFKA_PRODUCE_REJECTED = Counter("webhook_kafka_produce_rejected_total", "Messages refused because the producer was saturated")
+KAFKA_PRODUCE_FAILURES = Counter("webhook_kafka_produce_failures_total", "Messages the producer raised an error for")
 
 def read_config():
     return {
@@ -82,7 +227,15 @@ def read_config():
         "message.max.bytes": 1000000000,  # 953 MB - MAX allowed
         "client.id": "jackdesk-webhook-1",
         "acks": "all",
-        "retries": 3
+        # Retries until message.timeout.ms without duplicating or reordering messages
+        "enable.idempotence": True,
+        "message.timeout.ms": config("KAFKA_MESSAGE_TIMEOUT_MS", default=300000, cast=int),
+        # none, gzip, snappy, lz4 or zstd
+        "compression.type": config("KAFKA_COMPRESSION", default="lz4"),
+        # Waiting a few ms fills larger batches, which compress better and cost fewer requests
+        "linger.ms": config("KAFKA_LINGER_MS", default=20, cast=int),
+        "batch.size": config("KAFKA_BATCH_BYTES", default=1000000, cast=int),
+        "queue.buffering.max.messages": KAFKA_MAX_IN_FLIGHT * 2
     }
 
 producer_config = read_config()
@@ -93,44 +246,151 @@ VERIFY_TOKEN = config("WHA_VERIFY_TOKEN")
 # Initialize Kafka Producer
 producer = Producer(producer_config)
 
+in_flight_slots = BoundedSemaphore(KAFKA_MAX_IN_FLIGHT)
+dead_letter_lock = Lock()
+
 time.sleep(5)
 print("Producer is ready to produce")
 
-def flush_kafka_messages_consistently():
+
+class ProducerUnavailable(Exception):
+    """Kafka did not take the message, the webhook is answered with 503 so it is redelivered"""
+
+
+class ProducerSaturated(ProducerUnavailable):
+    """Kafka cannot take more messages right now"""
+
+
+def flush_producer():
+    """Hands what is still queued or lingering in the producer to kafka before the process exits"""
+    remaining = producer.flush(KAFKA_FLUSH_TIMEOUT_SECONDS)
+    if remaining:
+        logger.critical(f"{remaining} kafka messages were not acknowledged before shutdown")
+
+
+def exit_on_sigterm(signum, frame):
+    # SystemExit unwinds the main thread, so the atexit flush runs
+    sys.exit(0)
+
+
+atexit.register(flush_producer)
+# Servers handling SIGTERM themselves, like gunicorn, already exit through sys.exit
+if signal.getsignal(signal.SIGTERM) is signal.SIG_DFL and current_thread() is main_thread():
+    signal.signal(signal.SIGTERM, exit_on_sigterm)
+
+
+def serve_delivery_reports():
+    """Runs the delivery callbacks as acknowledgements arrive, they free the in flight budget"""
     while True:
-        producer.flush()
-        time.sleep(2)
+        try:
+            producer.poll(0.1)
+        except Exception as e:
+            logger.error(f"Error serving kafka delivery reports: {e}")
 
 def start_background_tasks():
-    flush_thread = Thread(target=flush_kafka_messages_consistently, daemon=True)
-    flush_thread.start()
+    Thread(target=serve_delivery_reports, daemon=True, name="KafkaDeliveryReports").start()
+    for worker in range(GMAIL_PUSH_WORKERS):
+        Thread(target=run_gmail_push_worker, daemon=True, name=f"GmailPushWorker-{worker}").start()
+    Thread(target=secret_keys.listen_for_invalidations, daemon=True, name="SecretKeyInvalidationListener").start()
 
 def delivery_report(err, msg):
     """
     Callback for delivery reports. Logs the delivery result.
     """
+    in_flight_slots.release()
+    KAFKA_IN_FLIGHT.dec()
     if err is not None:
+        KAFKA_DELIVERY_FAILURES.inc()
         logger.error(f"Message delivery failed: {err}")
+        write_dead_letter(err, msg)
     else:
-        logger.info(f"Message delivered to {msg.topic()} [{msg.partition()}]")
+        if msg.latency() is not None:
+            KAFKA_DELIVERY_LATENCY.observe(msg.latency())
+        logger.debug(f"Message delivered to {msg.topic()} [{msg.partition()}]")
+
+def write_dead_letter(err, msg):
+    record = {
+        "error": str(err),
+        "topic": msg.topic(),
+        "key": msg.key().decode() if msg.key() else None,
+        "headers": {key: value.decode() for key, value in (msg.headers() or [])},
+        "value": msg.value().decode()
+    }
+    try:
+        with dead_letter_lock, open(KAFKA_DEAD_LETTER_PATH, "ab") as dead_letters:
+            dead_letters.write(orjson.dumps(record) + b"\n")
+    except OSError as e:
+        logger.critical(f"Lost undelivered kafka message {record}: {e}")
+
+def conversation_key(msg):
+    """
+    Kafka key of a message, (platform login_id, customer id). Must match conversation_key
+    in start_conversation_tasks.py so partitions line up with the consumer worker lanes.
+    A message and the status receipts about it share the key, so they stay in order.
+    """
+    login_id = msg.get("phone_number_id") or msg.get("page_owner_id") or ""
+    sender = msg.get("recipient_id") or msg.get("sender_id") or ""
+    if isinstance(sender, dict):
+        sender = sender.get("id", "")
+    if msg.get("app_name") == "GMAIL":
+        # The From header carries a display name that can change between mails
+        sender = parseaddr(sender)[1] or sender
+    return f"{login_id}:{sender}"
+
+def platform_key(msg):
+    return msg.get("phone_number_id") or msg.get("page_owner_id") or ""
+
+# conversation: per conversation ordering, spreads load over every partition
+# platform: per platform ordering, one busy number is limited to a single partition
+# none: no ordering, round robin over the partitions
+KAFKA_KEY_SCHEMES = {
+    "conversation": conversation_key,
+    "platform": platform_key,
+    "none": lambda msg: None,
+}
+KAFKA_KEY_SCHEME = config("KAFKA_KEY_SCHEME", default="conversation")
+if KAFKA_KEY_SCHEME not in KAFKA_KEY_SCHEMES:
+    raise Exception(f"Unknown KAFKA_KEY_SCHEME {KAFKA_KEY_SCHEME}, expected one of {', '.join(KAFKA_KEY_SCHEMES)}")
+message_key = KAFKA_KEY_SCHEMES[KAFKA_KEY_SCHEME]
 
 def publish_message(topic, msg):
     """
-    Publishes a message to Kafka asynchronously.
+    Publishes a message to Kafka asynchronously. Raises ProducerSaturated when no in flight
+    slot frees up within KAFKA_PRODUCE_WAIT_MS or the local queue is full, ProducerUnavailable
+    when the producer fails otherwise.
     """
+    if not in_flight_slots.acquire(timeout=KAFKA_PRODUCE_WAIT_SECONDS):
+        KAFKA_PRODUCE_REJECTED.inc()
+        raise ProducerSaturated("Kafka in flight budget exhausted")
     try:
         producer.produce(
             topic,
-            value=json.dumps(msg),
+            key=message_key(msg),
+            value=orjson.dumps(msg),
+            # Lets the consumer route without decoding the body
+            headers=[
+                ("msg_from_type", str(msg.get("msg_from_type", "")).encode()),
+                ("app_name", str(msg.get("app_name", "")).encode()),
+                ("schema_version", str(SCHEMA_VERSION).encode()),
+            ],
             callback=delivery_report
         )
-        print("Producer produced message")
-    except KafkaError as e:
+        KAFKA_IN_FLIGHT.inc()
+    except BufferError:
+        in_flight_slots.release()
+        KAFKA_PRODUCE_REJECTED.inc()
+        raise ProducerSaturated("Kafka producer queue is full")
+    except KafkaException as e:
+        in_flight_slots.release()
+        KAFKA_PRODUCE_FAILURES.inc()
         logger.error(f"Failed to produce message: {e}")
+        raise ProducerUnavailable(str(e)) from e
 
 def send_msg_from_org(**kwargs):
     try:
         publish_message(TOPIC, kwargs)
+    except ProducerUnavailable:
+        raise
     except Exception as e:
         logger.error(f"Error sending message: {e}")
 
@@ -140,6 +400,8 @@ def send_msg_from_customer(**kwargs):
     """
     try:
         publish_message(TOPIC, kwargs)
+    except ProducerUnavailable:
+        raise
     except Exception as e:
         logger.error(f"Error sending message: {e}")
 
@@ -184,6 +446,20 @@ def extract_plain_text(payload):
     return "[No Text]"
 
 
+@app.errorhandler(ProducerUnavailable)
+def producer_unavailable(e):
+    # Meta and Pub/Sub both redeliver on 503, the consumer skips whatever was already published
+    logger.warning(f"Rejecting webhook: {e}")
+    response = jsonify({"status": "error", "message": "Busy, retry later"})
+    response.headers["Retry-After"] = str(KAFKA_RETRY_AFTER_SECONDS)
+    return response, 503
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return generate_latest(), 200, {"Content-Type": CONTENT_TYPE_LATEST}
+
+
 @app.route('/whatsapp', methods=['GET', 'POST'])
 def whatsapp_webhook():
     """
@@ -249,6 +525,7 @@ def whatsapp_webhook():
                                 recipient_id=recipient_id,
                                 message_body=text_message,
                                 msg_type="text",
+                                provider_message_id=message.get('id'),
                                 msg_from_type="CUSTOMER",
                                 app_name="WHATSAPP"
                         )
@@ -265,6 +542,7 @@ def whatsapp_webhook():
                                 recipient_id=recipient_id,
                                 message_body=body_to_send,
                                 msg_type=mime_type,
+                                provider_message_id=message.get('id'),
                                 msg_from_type="CUSTOMER",
                                 app_name="WHATSAPP"
                         )
@@ -278,6 +556,7 @@ def whatsapp_webhook():
                                 recipient_id=recipient_id,
                                 message_body=body_to_send,
                                 msg_type=mime_type,
+                                provider_message_id=message.get('id'),
                                 msg_from_type="CUSTOMER",
                                 app_name="WHATSAPP"
                         )
@@ -294,6 +573,7 @@ def whatsapp_webhook():
                             recipient_id=recipient_id,
                             message_body=body_to_send,
                             msg_type=audio.get('mime_type') or "audio",
+                            provider_message_id=message.get('id'),
                             msg_from_type="CUSTOMER",
                             app_name="WHATSAPP"
                         )
@@ -308,6 +588,7 @@ def whatsapp_webhook():
                             recipient_id=recipient_id,
                             message_body=body_to_send,
                             msg_type="location",
+                            provider_message_id=message.get('id'),
                             msg_from_type="CUSTOMER",
                             app_name="WHATSAPP"
                         )
@@ -327,6 +608,7 @@ def whatsapp_webhook():
                             recipient_id=recipient_id,
                             message_body=contact_details,
                             msg_type="contacts",
+                            provider_message_id=message.get('id'),
                             msg_from_type="CUSTOMER",
                             app_name="WHATSAPP"
                         )
@@ -342,12 +624,15 @@ def whatsapp_webhook():
                             recipient_id=recipient_id,
                             message_body=body_to_send,
                             msg_type=vid.get('mime_type') or "video",
+                            provider_message_id=message.get('id'),
                             msg_from_type="CUSTOMER",
                             app_name="WHATSAPP"
                         )
                     else:
                         logger.info(f"Unsupported message type {message.get('type')}")
             return jsonify({"status": "success"}), 200
+        except ProducerUnavailable:
+            raise
         except Exception as e:
             logger.error(f"Error processing webhook: {e}")
             logger.debug(traceback.format_exc())
@@ -404,6 +689,7 @@ def messenger_webhook():
                                 sender_id=sender_id,
                                 message_status=message_status,
                                 msg=messaging.get('message').get("text"),
+                                provider_message_id=messaging.get('message').get("mid"),
                                 timestamp=timestamp,
                                 msg_type="text",
                                 msg_from_type="CUSTOMER",
@@ -412,6 +698,8 @@ def messenger_webhook():
                     else:
                         logger.info(f"Unsupported message type {message_status}")
             return jsonify({"status": "Processed"}), 200
+        except ProducerUnavailable:
+            raise
         except Exception as e:
             logger.error(f"Error processing messenger webhook: {e}")
             logger.debug(traceback.format_exc())
@@ -450,38 +738,57 @@ import base64
 import os
 import time
 
-def extract_attachments(service, user_id, payload, msg_id, sender_email):
-    attachments = []
-    # Create a unique path for this message's attachments
-    timestamp = str(time.time())
-    base_path = f"/tmp/{sender_email}/{timestamp}"
-    os.makedirs(base_path, exist_ok=True)
-    def walk_parts(parts):
+def store_attachment_claim(data, mime_type):
+    """
+    Uploads an attachment under a key derived from its content and returns that key. The
+    upload is repeated even when an earlier message parked the same content, since that
+    copy could expire under the lifecycle rule before the consumer reads this message.
+    """
+    claim_key = f"{CLAIM_CHECK_PREFIX}{hashlib.sha256(data).hexdigest()}"
+    s3 = get_s3_client(
+        endpoint_url=config("B2_ENDPOINT_URL"),
+        access_key_id=config("B2_ACCESS_KEY_ID"),
+        secret_access_key=config("B2_SECRET_ACCESS_KEY")
+    )
+    s3.put_object(Bucket=config("B2_STORAGE_BUCKET_NAME"), Key=claim_key, Body=data, ContentType=mime_type or "application/octet-stream")
+    return claim_key
+
+
+def extract_attachments(service, credentials, messages):
+    """
+    Downloads the attachments of all the messages concurrently, each is parked under its
+    claim check key as soon as it arrives. Returns {msg_id: [attachment, ...]}.
+    """
+    found = {}
+    mime_types = {}
+    def walk_parts(msg_id, parts):
         for part in parts:
             filename = part.get("filename")
-            body = part.get("body", {})
-            mime_type = part.get("mimeType", "")
-            attachment_id = body.get("attachmentId")
+            attachment_id = part.get("body", {}).get("attachmentId")
             if filename and attachment_id:
-                attachment = service.users().messages().attachments().get(
-                    userId=user_id, messageId=msg_id, id=attachment_id
-                ).execute()
-                data = base64.urlsafe_b64decode(attachment.get("data").encode("UTF-8"))
-                file_path = os.path.join(base_path, filename)
-                with open(file_path, "wb") as f:
-                    f.write(data)
-                attachments.append({
-                    "filename": filename,
-                    "mime_type": mime_type,
-                    "path": file_path
-                })
+                found[msg_id].append((filename, attachment_id))
+                mime_types[(msg_id, attachment_id)] = part.get("mimeType", "")
             elif part.get("parts"):
-                walk_parts(part["parts"])
-
-    if payload.get("parts"):
-        walk_parts(payload["parts"])
-    return attachments
-
+                walk_parts(msg_id, part["parts"])
+
+    for msg_id, message in messages.items():
+        found[msg_id] = []
+        walk_parts(msg_id, message.get("payload", {}).get("parts", []))
+    claims = get_attachments(
+        service,
+        credentials,
+        list(mime_types),
+        handle=lambda key, data: (store_attachment_claim(data, mime_types[key]), len(data))
+    )
+    return {
+        msg_id: [{
+            "filename": filename,
+            "mime_type": mime_types[(msg_id, attachment_id)],
+            "claim_key": claims[(msg_id, attachment_id)][0],
+            "size": claims[(msg_id, attachment_id)][1]
+        } for filename, attachment_id in attachments]
+        for msg_id, attachments in found.items()
+    }
 
 
 def extract_html_or_plain_part(payload):
@@ -523,7 +830,10 @@ def disable_links(html):
 
 @app.route("/webhook/gmail/push", methods=["POST"])
 def gmail_push_webhook():
-    logger.info(f"📥 Gmail Webhook Payload: {request.data}")
+    """
+    Only queues the push, the fetch workers read the mailbox history afterwards. Answering
+    right away keeps Pub/Sub from redelivering pushes while Google is slow.
+    """
     try:
         envelope = json.loads(request.data)
         pubsub_message = envelope.get("message", {})
@@ -542,171 +852,262 @@ def gmail_push_webhook():
             return jsonify({"error": "Missing fields"}), 400
 
         logger.info(f"📬 Gmail push for {email_address}, historyId={new_history_id}")
+        queue_gmail_push(email_address, int(new_history_id))
+        return jsonify({"status": "Queued"}), 200
 
-        # Fetch GmailAccount info
-        with get_conn() as conn:
-            with conn.cursor() as cursor:
-                cursor.execute("""
-                    SELECT id, access_token, refresh_token, history_id
-                    FROM manage_platform_gmailaccount
-                    WHERE email_address = %s AND active = TRUE
+    except (ValueError, TypeError) as e:
+        logger.warning(f"Malformed Gmail push: {e}")
+        return jsonify({"error": "Malformed push"}), 400
+    except Exception as e:
+        # Pub/Sub redelivers the push
+        logger.error(f"💥 Gmail webhook error: {e}")
+        return jsonify({"error": str(e)}), 500
+
+
+def queue_gmail_push(email_address, history_id):
+    with get_conn() as conn:
+        with conn.cursor() as cursor:
+            # A mailbox that is queued already keeps its place, it is fetched up to the newest push
+            cursor.execute("""
+                INSERT INTO manage_platform_gmailpushnotification (email_address, history_id, attempts, available_at, queued_at)
+                VALUES (%s, %s, 0, NULL, NOW())
+                ON CONFLICT (email_address) DO UPDATE
+                SET history_id = GREATEST(manage_platform_gmailpushnotification.history_id, EXCLUDED.history_id)
+            """, (email_address, history_id))
+    with gmail_push_wakeup:
+        gmail_push_wakeup.notify()
+
+
+def claim_gmail_push():
+    """Takes the oldest ready mailbox for GMAIL_PUSH_CLAIM_SECONDS, other workers skip it meanwhile"""
+    with get_conn() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                UPDATE manage_platform_gmailpushnotification
+                SET available_at = NOW() + make_interval(secs => %s), attempts = attempts + 1
+                WHERE id = (
+                    SELECT id FROM manage_platform_gmailpushnotification
+                    WHERE available_at IS NULL OR available_at <= NOW()
+                    ORDER BY queued_at
+                    FOR UPDATE SKIP LOCKED
                     LIMIT 1
-                """, (email_address,))
-                row = cursor.fetchone()
-                logger.info(f"Found from manage_platform_gmailaccount {row}")
-                if not row:
-                    logger.error(f"Gmail account {email_address} not found or not active")
-                    return jsonify({"error": "Gmail account not found or not active"}), 404
-                account_id, access_token, refresh_token, last_stored_history_id = row
-
-        if not last_stored_history_id:
-            logger.warning("🚫 No previous history ID stored. Skipping fetch.")
-            return jsonify({"error": "No previous history ID"}), 400
-
-        # Setup credentials
-        creds = Credentials(
-            token=access_token,
-            refresh_token=refresh_token,
-            token_uri='https://oauth2.googleapis.com/token',
-            client_id=config("GOOGLE_CLIENT_ID"),
-            client_secret=config("GOOGLE_CLIENT_SECRET")
-        )
+                )
+                RETURNING id, email_address, history_id, attempts
+            """, (GMAIL_PUSH_CLAIM_SECONDS,))
+            return cursor.fetchone()
 
-        logger.info(f"creds.valid {creds.valid} | creds.expired {creds.expired} | creds {creds}")
-        # Refresh if needed
-        if not creds.valid or creds.expired:
-            logger.info("🔁 Refreshing expired access token...")
-            creds.refresh(Request())
-            access_token = creds.token
-            with get_conn() as conn:
-                with conn.cursor() as cursor:
-                    cursor.execute("""
-                        UPDATE manage_platform_gmailaccount
-                        SET access_token=%s,
-                            token_expiry=%s,
-                            updated_at=NOW()
-                        WHERE id=%s
-                    """, (creds.token, creds.expiry, account_id))
 
-        # Use Gmail API
-        service = build('gmail', 'v1', credentials=creds)
+def finish_gmail_push(push_id, history_id, error=None, attempts=0):
+    with get_conn() as conn:
+        with conn.cursor() as cursor:
+            if error is not None and attempts < GMAIL_PUSH_MAX_ATTEMPTS:
+                cursor.execute("""
+                    UPDATE manage_platform_gmailpushnotification
+                    SET available_at = NOW() + make_interval(secs => %s)
+                    WHERE id = %s
+                """, (GMAIL_PUSH_RETRY_BASE_SECONDS * 2 ** (attempts - 1), push_id))
+                return
+            # The stored history id only moves on success, so a dropped push is caught up by the next one
+            cursor.execute("""
+                DELETE FROM manage_platform_gmailpushnotification WHERE id = %s AND history_id = %s
+            """, (push_id, history_id))
+            if cursor.rowcount == 0:
+                # Pushed again while we were fetching, make it ready for another pass
+                cursor.execute("""
+                    UPDATE manage_platform_gmailpushnotification
+                    SET available_at = NULL, attempts = 0
+                    WHERE id = %s
+                """, (push_id,))
+
 
+def run_gmail_push_worker():
+    while True:
         try:
-            history = service.users().history().list(
-                userId='me',
-                startHistoryId=last_stored_history_id,
-                historyTypes=['messageAdded']
-            ).execute()
-        except RefreshError as refresh_error:
-            logger.error(f"❌ Refresh failed after 401: {refresh_error}")
-            with get_conn() as conn:
-                with conn.cursor() as cursor:
-                    cursor.execute("""
-                        UPDATE manage_platform_gmailaccount
-                        SET active=FALSE,
-                            updated_at=NOW()
-                        WHERE id=%s
-                    """, (account_id,))
-            return jsonify({"error": "OAuth refresh failed. Reauthorization required."}), 401
-        logger.info(f"🔍 Gmail History keys: {history.keys()}")
-        logger.info(f"📚 Gmail history content: {json.dumps(history)}")
+            push = claim_gmail_push()
+        except Exception as e:
+            logger.error(f"Failed to claim a Gmail push: {e}")
+            push = None
+        if push is None:
+            with gmail_push_wakeup:
+                gmail_push_wakeup.wait(GMAIL_PUSH_POLL_SECONDS)
+            continue
+        push_id, email_address, history_id, attempts = push
+        error = None
+        try:
+            sync_gmail_mailbox(email_address, str(history_id))
+        except Exception as e:
+            error = e
+            logger.error(f"💥 Gmail fetch for {email_address} failed on attempt {attempts}: {e}")
+        try:
+            finish_gmail_push(push_id, history_id, error, attempts)
+        except Exception as e:
+            # The claim expires and the push is fetched again
+            logger.error(f"Failed to finish the Gmail push of {email_address}: {e}")
+
+
+def build_gmail_service(credentials):
+    if not GMAIL_API_URL:
+        return build('gmail', 'v1', credentials=credentials)
+    # The batch endpoint is taken from the discovery document's rootUrl, an api_endpoint
+    # client option would only move the single calls
+    document = json.loads(get_static_doc('gmail', 'v1'))
+    document["rootUrl"] = GMAIL_API_URL.rstrip("/") + "/"
+    return build_from_document(document, credentials=credentials)
 
-        with get_conn() as conn:
-            with conn.cursor() as cursor:
-                for record in history.get("history", []):
-                    for msg_meta in record.get("messages", []):
-                        msg_id = msg_meta["id"]
-                        # Check duplicate
-                        cursor.execute("""
-                            SELECT 1 FROM manage_platform_processedgmailmessage
-                            WHERE gmail_account_id = %s AND message_id = %s
-                            LIMIT 1
-                        """, (account_id, msg_id))
-                        if cursor.fetchone():
-                            logger.info(f"⏩ Already processed message {msg_id}")
-                            continue
-                        # Fetch full message
-                        #message = service.users().messages().get(userId='me', id=msg_id, format='full').execute()
-                        try:
-                            message = service.users().messages().get(userId='me', id=msg_id, format='full').execute()
-                        except HttpError as e:
-                            if e.resp.status == 404:
-                                logger.warning(f"⚠️ Message {msg_id} not found. Skipping.")
-                                continue
-                            else:
-                                logger.warning("Exception while processing the message")
-                                raise  # re-raise other errors
-                        content_blocks = []
-                        headers = {h["name"]: h["value"] for h in message.get("payload", {}).get("headers", [])}
-                        sender = headers.get("From")
-                        if not sender:
-                            # Save processed msg_id
-                            cursor.execute("""
-                                INSERT INTO manage_platform_processedgmailmessage
-                                (gmail_account_id, message_id, processed_at)
-                                VALUES (%s, %s, NOW())
-                            """, (account_id, msg_id))
-                            continue
-                        gmail_message_id = headers.get("Message-ID")
-                        gmail_thread_id = message.get("threadId")
-                        subject = headers.get("Subject", "No Subject")  # fallback
-                        attachments = extract_attachments(service, "me", message.get("payload", {}), msg_id, sender)
-                        logger.info(f"📎 Found {len(attachments)} attachments")
-                        timestamp = int(message.get("internalDate", 0)) // 1000
-                        # Extract raw HTML or plain
-                        mime_type, raw_content = extract_html_or_plain_part(message.get("payload", {}))
-                        logger.info(f"✉️ Extracted mime_type: {mime_type}")
-                        #if mime_type == "text/html" and raw_content:
-                        #    content_blocks = [{"type": "html", "html": raw_content}]
-                        if mime_type == "text/html" and raw_content:
-                            cleaned_html = disable_links(raw_content)
-                            content_blocks = [{"type": "html", "html": cleaned_html}]
-                        elif mime_type == "text/plain" and raw_content:
-                            plain_clean = re.sub(r'^>+', '', raw_content, flags=re.MULTILINE)
-                            html_wrapped = f"<pre>{escape(plain_clean)}</pre>"
-                            content_blocks = [{"type": "html", "html": html_wrapped}]
-                        else:
-                            content_blocks = []
-                        logger.info(f": content_blocks {content_blocks}")
-                        attachment_path = f"/tmp/{sender}/"
-                        # Push to Kafka
-                        send_msg_from_customer(
-                            phone_number_id=email_address,
-                            recipient_id=sender,
-                            message_body='',
-                            subject=subject,
-                            content_blocks = content_blocks,
-                            attachments=attachments,
-                            message_id=gmail_message_id,
-                            thread_id=gmail_thread_id,
-                            msg_type="email",
-                            msg_from_type="CUSTOMER",
-                            app_name="GMAIL"
-                        )
 
-                        # Save processed msg_id
-                        cursor.execute("""
-                            INSERT INTO manage_platform_processedgmailmessage
-                            (gmail_account_id, message_id, processed_at)
-                            VALUES (%s, %s, NOW())
-                        """, (account_id, msg_id))
+def sync_gmail_mailbox(email_address, new_history_id):
+    """Publishes the mails added to a mailbox since its stored history id"""
+    # Fetch GmailAccount info
+    with get_conn() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                SELECT id, access_token, refresh_token, history_id
+                FROM manage_platform_gmailaccount
+                WHERE email_address = %s AND active = TRUE
+                LIMIT 1
+            """, (email_address,))
+            row = cursor.fetchone()
+            logger.info(f"Found from manage_platform_gmailaccount {row}")
+            if not row:
+                logger.error(f"Gmail account {email_address} not found or not active")
+                return
+            account_id, access_token, refresh_token, last_stored_history_id = row
+
+    if not last_stored_history_id:
+        logger.warning("🚫 No previous history ID stored. Skipping fetch.")
+        return
+
+    # Setup credentials
+    creds = Credentials(
+        token=access_token,
+        refresh_token=refresh_token,
+        token_uri='https://oauth2.googleapis.com/token',
+        client_id=config("GOOGLE_CLIENT_ID"),
+        client_secret=config("GOOGLE_CLIENT_SECRET")
+    )
 
-                logger.warning("Message processing complete and returning")
-                # ✅ Finally, update the last stored historyId with this one
+    logger.info(f"creds.valid {creds.valid} | creds.expired {creds.expired} | creds {creds}")
+    # Refresh if needed
+    if not creds.valid or creds.expired:
+        logger.info("🔁 Refreshing expired access token...")
+        creds.refresh(Request())
+        access_token = creds.token
+        with get_conn() as conn:
+            with conn.cursor() as cursor:
                 cursor.execute("""
                     UPDATE manage_platform_gmailaccount
-                    SET history_id=%s, updated_at = NOW()
+                    SET access_token=%s,
+                        token_expiry=%s,
+                        updated_at=NOW()
                     WHERE id=%s
-                """, (new_history_id, account_id))
+                """, (creds.token, creds.expiry, account_id))
 
-        status = {"status": "Published to Kafka"}
-        logger.info(f"Returning status {status}")
-        return jsonify(status), 200
+    # Use Gmail API
+    service = build_gmail_service(creds)
 
-    except Exception as e:
-        logger.error(f"💥 Gmail webhook error: {e}")
-        return jsonify({"error": str(e)}), 500
+    try:
+        message_ids, _ = list_history_message_ids(service, last_stored_history_id)
+    except RefreshError as refresh_error:
+        logger.error(f"❌ Refresh failed after 401: {refresh_error}")
+        with get_conn() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("""
+                    UPDATE manage_platform_gmailaccount
+                    SET active=FALSE,
+                        updated_at=NOW()
+                    WHERE id=%s
+                """, (account_id,))
+        return
+    logger.info(f"🔍 Gmail history of {email_address} lists {len(message_ids)} messages")
 
+    if message_ids:
+        with get_conn() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("""
+                    SELECT message_id FROM manage_platform_processedgmailmessage
+                    WHERE gmail_account_id = %s AND message_id = ANY(%s)
+                """, (account_id, message_ids))
+                processed = {row[0] for row in cursor.fetchall()}
+        if processed:
+            logger.info(f"⏩ Already processed messages {processed}")
+        message_ids = [msg_id for msg_id in message_ids if msg_id not in processed]
+    # Bodies come GMAIL_BATCH_SIZE per round trip and the attachments of all of them
+    # concurrently, before a connection is taken for the inserts
+    messages = get_messages(service, message_ids, format='full')
+    attachments_by_message = extract_attachments(service, creds, {
+        msg_id: message for msg_id, message in messages.items()
+        if any(h["name"] == "From" for h in message.get("payload", {}).get("headers", []))
+    })
+
+    with get_conn() as conn:
+        with conn.cursor() as cursor:
+            for msg_id in message_ids:
+                message = messages.get(msg_id)
+                if message is None:
+                    logger.warning(f"⚠️ Message {msg_id} not found. Skipping.")
+                    continue
+                content_blocks = []
+                headers = {h["name"]: h["value"] for h in message.get("payload", {}).get("headers", [])}
+                sender = headers.get("From")
+                if not sender:
+                    # Save processed msg_id
+                    cursor.execute("""
+                        INSERT INTO manage_platform_processedgmailmessage
+                        (gmail_account_id, message_id, processed_at)
+                        VALUES (%s, %s, NOW())
+                    """, (account_id, msg_id))
+                    continue
+                gmail_message_id = headers.get("Message-ID")
+                gmail_thread_id = message.get("threadId")
+                subject = headers.get("Subject", "No Subject")  # fallback
+                attachments = attachments_by_message.get(msg_id, [])
+                logger.info(f"📎 Found {len(attachments)} attachments")
+                timestamp = int(message.get("internalDate", 0)) // 1000
+                # Extract raw HTML or plain
+                mime_type, raw_content = extract_html_or_plain_part(message.get("payload", {}))
+                logger.info(f"✉️ Extracted mime_type: {mime_type}")
+                #if mime_type == "text/html" and raw_content:
+                #    content_blocks = [{"type": "html", "html": raw_content}]
+                if mime_type == "text/html" and raw_content:
+                    cleaned_html = disable_links(raw_content)
+                    content_blocks = [{"type": "html", "html": cleaned_html}]
+                elif mime_type == "text/plain" and raw_content:
+                    plain_clean = re.sub(r'^>+', '', raw_content, flags=re.MULTILINE)
+                    html_wrapped = f"<pre>{escape(plain_clean)}</pre>"
+                    content_blocks = [{"type": "html", "html": html_wrapped}]
+                else:
+                    content_blocks = []
+                logger.info(f": content_blocks {content_blocks}")
+                # Push to Kafka
+                send_msg_from_customer(
+                    phone_number_id=email_address,
+                    recipient_id=sender,
+                    message_body='',
+                    subject=subject,
+                    content_blocks = content_blocks,
+                    attachments=attachments,
+                    message_id=gmail_message_id,
+                    thread_id=gmail_thread_id,
+                    msg_type="email",
+                    msg_from_type="CUSTOMER",
+                    app_name="GMAIL"
+                )
+
+                # Save processed msg_id
+                cursor.execute("""
+                    INSERT INTO manage_platform_processedgmailmessage
+                    (gmail_account_id, message_id, processed_at)
+                    VALUES (%s, %s, NOW())
+                """, (account_id, msg_id))
+
+            logger.warning("Message processing complete and returning")
+            # ✅ Finally, update the last stored historyId with this one
+            cursor.execute("""
+                UPDATE manage_platform_gmailaccount
+                SET history_id=%s, updated_at = NOW()
+                WHERE id=%s
+            """, (new_history_id, account_id))
+    logger.info(f"Gmail history of {email_address} synced up to {new_history_id}")
 
 
 start_background_tasks()
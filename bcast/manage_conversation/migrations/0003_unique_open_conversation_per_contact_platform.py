@@ -0,0 +1,31 @@
+from django.db import migrations, models
+
+
+# Older duplicates were never picked up again since lookups take the latest open one
+CLOSE_DUPLICATE_OPEN_CONVERSATIONS = """
+UPDATE manage_conversation_conversation
+SET status = 'closed', closed_reason = 'Duplicate', updated_at = NOW()
+WHERE id IN (
+    SELECT id FROM (
+        SELECT id, ROW_NUMBER() OVER (PARTITION BY contact_id, platform_id ORDER BY created_at DESC, id DESC) AS position
+        FROM manage_conversation_conversation
+        WHERE status IN ('new', 'active') AND thread_id IS NULL
+    ) ranked
+    WHERE position > 1
+);
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('manage_conversation', '0002_initial'),
+    ]
+
+    operations = [
+        migrations.RunSQL(CLOSE_DUPLICATE_OPEN_CONVERSATIONS, reverse_sql=migrations.RunSQL.noop),
+        migrations.AddConstraint(
+            model_name='conversation',
+            constraint=models.UniqueConstraint(condition=models.Q(('status__in', ['new', 'active']), ('thread_id__isnull', True)), fields=('contact', 'platform'), name='unique_open_conversation_per_contact_platform'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('manage_conversation', '0003_unique_open_conversation_per_contact_platform'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='usermessage',
+            name='messageid',
+            field=models.TextField(blank=True, db_index=True, null=True),
+        ),
+        migrations.CreateModel(
+            name='StatusRetry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('app_name', models.TextField()),
+                ('message_id', models.TextField()),
+                ('payload', models.JSONField()),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('next_attempt_at', models.DateTimeField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('app_name', 'message_id'), name='unique_status_retry_per_message')],
+            },
+        ),
+    ]
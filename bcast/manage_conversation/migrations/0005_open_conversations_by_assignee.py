@@ -0,0 +1,15 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('manage_conversation', '0004_statusretry_usermessage_messageid_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='conversation',
+            index=models.Index(condition=models.Q(('status', 'closed'), _negated=True), fields=['organization', 'assigned_user'], name='open_conversations_by_assignee'),
+        ),
+    ]
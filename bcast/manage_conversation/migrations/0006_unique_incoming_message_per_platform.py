@@ -0,0 +1,31 @@
+from django.db import migrations, models
+
+
+# Keeps the first copy of each provider message id, later copies stay but lose the id
+CLEAR_DUPLICATE_MESSAGE_IDS = """
+UPDATE manage_conversation_incomingmessage
+SET messageid = NULL
+WHERE id IN (
+    SELECT id FROM (
+        SELECT id, ROW_NUMBER() OVER (PARTITION BY platform_id, messageid ORDER BY id) AS position
+        FROM manage_conversation_incomingmessage
+        WHERE messageid IS NOT NULL
+    ) ranked
+    WHERE position > 1
+);
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('manage_conversation', '0005_open_conversations_by_assignee'),
+    ]
+
+    operations = [
+        migrations.RunSQL(CLEAR_DUPLICATE_MESSAGE_IDS, reverse_sql=migrations.RunSQL.noop),
+        migrations.AddConstraint(
+            model_name='incomingmessage',
+            constraint=models.UniqueConstraint(condition=models.Q(('messageid__isnull', False)), fields=('platform', 'messageid'), name='unique_incoming_message_per_platform'),
+        ),
+    ]
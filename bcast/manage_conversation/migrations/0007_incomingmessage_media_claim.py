@@ -0,0 +1,25 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('manage_conversation', '0006_unique_incoming_message_per_platform'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='incomingmessage',
+            name='media_attempts',
+            field=models.PositiveIntegerField(db_default=0, default=0),
+        ),
+        migrations.AddField(
+            model_name='incomingmessage',
+            name='media_available_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='incomingmessage',
+            index=models.Index(condition=models.Q(('status_details__startswith', 'media_pending:')), fields=['id'], name='pending_media_uploads'),
+        ),
+    ]
@@ -32,6 +32,24 @@ class Conversation(models.Model):
     def __str__(self):
         return f"Conversation with {self.contact}" 
 
+    class Meta:
+        constraints = [
+            # Gmail keeps one conversation per thread, every other platform one open conversation per contact
+            models.UniqueConstraint(
+                fields=['contact', 'platform'],
+                condition=models.Q(status__in=['new', 'active'], thread_id__isnull=True),
+                name='unique_open_conversation_per_contact_platform'
+            )
+        ]
+        indexes = [
+            # Open conversation count per agent used by bandwidth auto assignment
+            models.Index(
+                fields=['organization', 'assigned_user'],
+                condition=~models.Q(status='closed'),
+                name='open_conversations_by_assignee'
+            )
+        ]
+
 
 class IncomingMessage(models.Model):
     conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name='incoming_messages')
@@ -54,6 +72,29 @@ class IncomingMessage(models.Model):
 
     status_details = models.TextField(blank=True, null=True)
     created_at = models.DateTimeField(auto_now_add=True)
+    # Upload of media still pending, see MEDIA_PENDING_PREFIX in the conversation daemon.
+    # Claimed by a media worker or backing off after a failure until then, null when ready.
+    # The daemons insert rows with raw SQL, hence the database default.
+    media_attempts = models.PositiveIntegerField(default=0, db_default=0)
+    media_available_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # Pending media uploads swept by the conversation daemon
+            models.Index(
+                fields=['id'],
+                condition=models.Q(status_details__startswith='media_pending:'),
+                name='pending_media_uploads'
+            )
+        ]
+        constraints = [
+            # messageid is the provider's id, a redelivered message must not be saved twice
+            models.UniqueConstraint(
+                fields=['platform', 'messageid'],
+                condition=models.Q(messageid__isnull=False),
+                name='unique_incoming_message_per_platform'
+            )
+        ]
 
     def to_dict(self):
         return {
@@ -80,6 +121,24 @@ class UserMessage(models.Model):
 
     status = models.TextField(blank=True, null=True)
     status_details = models.TextField(blank=True, null=True)
-    messageid = models.TextField(blank=True, null=True)
+    messageid = models.TextField(blank=True, null=True, db_index=True)
     template = models.TextField(blank=True, null=True)
 
+
+class StatusRetry(models.Model):
+    """
+    Provider status notification that arrived before the message it refers to was saved.
+    The conversation daemon retries it with exponential backoff until the message shows
+    up or the attempts run out.
+    """
+    app_name = models.TextField()
+    message_id = models.TextField()
+    payload = models.JSONField()
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['app_name', 'message_id'], name='unique_status_retry_per_message')
+        ]
@@ -45,14 +45,11 @@ logger.info("Test log from conversation view")
 PLATFORM_NOT_SUPPORTED_WEBHOOK = ['gmail', 'webchat']
 
 User = get_user_model()
-from botocore.client import Config
-s3 = boto3.client(
-    's3',
+from VendorApi.B2.client import get_s3_client
+s3 = get_s3_client(
     endpoint_url=settings.B2_ENDPOINT_URL,
-    aws_access_key_id=settings.B2_ACCESS_KEY_ID,
-    aws_secret_access_key=settings.B2_SECRET_ACCESS_KEY,
-    config=Config(signature_version="s3v4"),
-    region_name='us-west-002'  # ✅ Add your correct region name here if required
+    access_key_id=settings.B2_ACCESS_KEY_ID,
+    secret_access_key=settings.B2_SECRET_ACCESS_KEY
 )
 
 ALLOWED_MIME_TYPES = {
@@ -13,6 +13,8 @@ from decouple import config
 
 from django.conf import settings
 
+from VendorApi.Gmail.fetch import list_history_message_ids, get_messages
+
 load_dotenv()
 
 
@@ -76,22 +78,18 @@ def handle_full_sync_unread(account, service):
             print("No unread messages found.")
             return
 
+        # One batched round trip per GMAIL_BATCH_SIZE messages instead of a request each
+        msg_details = get_messages(service, [message['id'] for message in messages], format='full')
         for message in messages:
-            msg_detail = service.users().messages().get(
-                userId='me',
-                id=message['id'],
-                format='full'  # or 'metadata' if you just need headers
-            ).execute()
+            msg_detail = msg_details.get(message['id'])
+            if msg_detail is None:
+                continue
 
             # Handle the unread message here (e.g., extract content, process sender/subject)
             print(f"Unread message from: {msg_detail['payload'].get('headers', [])}")
 
-        # Update history ID from the most recent unread message
-        latest_msg = service.users().messages().get(
-            userId='me',
-            id=messages[0]['id'],
-            format='metadata'
-        ).execute()
+        # Update history ID from the most recent unread message, full messages carry it too
+        latest_msg = msg_details.get(messages[0]['id'], {})
 
         new_history_id = latest_msg.get('historyId')
         if new_history_id:
@@ -106,27 +104,17 @@ def handle_full_sync_unread(account, service):
 
 def poll_history(account):
     service, creds = get_gmail_service(account)
-    result = []
-    result = service.users().history().list(
-        userId='me',
-        startHistoryId=account.history_id,
-        historyTypes=['messageAdded']
-    ).execute()
-
-
-    if result and 'history' in result:
-        for history in result['history']:
-            for msg in history.get('messages', []):
-                try:
-                    msg_detail = service.users().messages().get(
-                        userId='me', id=msg['id']).execute()
-                    snippet = msg_detail.get("snippet", "")
-                    print("Raw message ", msg_detail)
-                    print(f"[{account.email_address}] New message: {snippet}")
-                except HttpError as error:
-                    # Skip 404 error since reply to message changes the id
-                    pass
-    account.history_id = result.get('historyId', account.history_id)
+    message_ids, history_id = list_history_message_ids(service, account.history_id)
+    # Messages gone since (404) are left out, a reply to a message changes its id
+    msg_details = get_messages(service, message_ids)
+    for msg_id in message_ids:
+        msg_detail = msg_details.get(msg_id)
+        if msg_detail is None:
+            continue
+        snippet = msg_detail.get("snippet", "")
+        print("Raw message ", msg_detail)
+        print(f"[{account.email_address}] New message: {snippet}")
+    account.history_id = history_id or account.history_id
     account.access_token = creds.token
     #account.token_expiry = make_aware(creds.expiry)
     account.save()
\ No newline at end of file
@@ -7,8 +7,7 @@ from django.utils import timezone
 from django.db import models
 from django.conf import settings
 
-import boto3
-from botocore.client import Config
+from VendorApi.B2.client import get_s3_client
 
 
 def generate_presigned_url(object_key, expiry_seconds=3600):
@@ -17,13 +16,10 @@ def generate_presigned_url(object_key, expiry_seconds=3600):
     if content_type is None:
         content_type = 'application/octet-stream'  # Fallback for unknown types
 
-    s3_client = boto3.client(
-        's3',
+    s3_client = get_s3_client(
         endpoint_url=settings.B2_ENDPOINT_URL,
-        aws_access_key_id=settings.B2_ACCESS_KEY_ID,
-        aws_secret_access_key=settings.B2_SECRET_ACCESS_KEY,
-        config=Config(signature_version='s3v4'),
-        region_name='us-west-002'  # ✅ Add your correct region name here if required
+        access_key_id=settings.B2_ACCESS_KEY_ID,
+        secret_access_key=settings.B2_SECRET_ACCESS_KEY
     )
     url = s3_client.generate_presigned_url(
         ClientMethod='get_object',
@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class ManageOrganizationConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'manage_organization'
+
+    def ready(self):
+        # Registers the metadata invalidation receivers
+        from manage_organization import signals  # noqa: F401
@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('manage_organization', '0002_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='organization',
+            name='auto_allocation_cursor',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+    ]
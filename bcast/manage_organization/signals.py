@@ -0,0 +1,11 @@
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from manage_organization.models import Organization
+from manage_platform.signals import notify_metadata_change
+
+
+@receiver(post_save, sender=Organization)
+@receiver(post_delete, sender=Organization)
+def handle_organization_changed(sender, instance, **kwargs):
+    notify_metadata_change("organization", id=instance.id, owner_id=instance.owner_id)
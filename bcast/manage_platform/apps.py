@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class ManagePlatformConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'manage_platform'
+
+    def ready(self):
+        # Registers the metadata invalidation receivers
+        from manage_platform import signals  # noqa: F401
@@ -0,0 +1,22 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('manage_platform', '0002_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GmailPushNotification',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('email_address', models.EmailField(max_length=254, unique=True)),
+                ('history_id', models.BigIntegerField()),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('available_at', models.DateTimeField(blank=True, null=True)),
+                ('queued_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
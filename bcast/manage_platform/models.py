@@ -46,6 +46,19 @@ class ProcessedGmailMessage(models.Model):
     processed_at = models.DateTimeField(auto_now_add=True)
 
 
+class GmailPushNotification(models.Model):
+    """
+    Gmail push waiting for the webhook server's fetch workers. A mailbox has at most one row,
+    later pushes only raise its history_id so a burst is served by a single history fetch.
+    """
+    email_address = models.EmailField(unique=True)
+    history_id = models.BigIntegerField()
+    attempts = models.PositiveIntegerField(default=0)
+    # Claimed by a worker or backing off after a failure until then, null when ready
+    available_at = models.DateTimeField(null=True, blank=True)
+    queued_at = models.DateTimeField(auto_now_add=True)
+
+
 class BlockedContact(models.Model):
     platform = models.ForeignKey(Platform, on_delete=models.CASCADE, related_name='blocked_contacts')
     contact_value = models.TextField(help_text="Phone number or email address to block")
@@ -0,0 +1,45 @@
+"""
+Notifies the daemons over postgres LISTEN/NOTIFY whenever a row they keep in their
+in-process metadata cache changes, so they can drop it instead of waiting for the TTL.
+"""
+import json
+import logging
+
+from django.db import connection, transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from manage_platform.models import Platform, BlockedContact
+
+logger = logging.getLogger(__name__)
+
+# Must match METADATA_NOTIFY_CHANNEL in daemons/start_conversation_tasks.py
+METADATA_NOTIFY_CHANNEL = "daemon_metadata_invalidation"
+
+
+def notify_metadata_change(model, **payload):
+    if connection.vendor != 'postgresql':
+        return
+    payload["model"] = model
+
+    def send():
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT pg_notify(%s, %s)", [METADATA_NOTIFY_CHANNEL, json.dumps(payload)])
+        except Exception as e:
+            logger.error(f"Failed to notify metadata change for {model}: {e}")
+
+    # Listeners would otherwise reload the old row before the transaction commits
+    transaction.on_commit(send)
+
+
+@receiver(post_save, sender=Platform)
+@receiver(post_delete, sender=Platform)
+def handle_platform_changed(sender, instance, **kwargs):
+    notify_metadata_change("platform", id=instance.id, login_id=instance.login_id, organization_id=instance.organization_id)
+
+
+@receiver(post_save, sender=BlockedContact)
+@receiver(post_delete, sender=BlockedContact)
+def handle_blocked_contact_changed(sender, instance, **kwargs):
+    notify_metadata_change("blockedcontact", platform_id=instance.platform_id)
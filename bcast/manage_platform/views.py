@@ -2,6 +2,7 @@ import requests
 from datetime import timedelta
 
 from django.conf import settings
+from django.db import transaction
 from django.utils import timezone
 from django.shortcuts import get_object_or_404
 from django.http import HttpResponse
@@ -18,6 +19,7 @@ from VendorApi.Whatsapp.message import TemplateMessage
 from .models import Platform, GmailAccount, BlockedContact
 from .serializers import PlatformSerializer, BlockedContactSerializer
 from .permissions import IsOwnerOrPrivileged
+from .signals import notify_metadata_change
 
 class PlatformListCreateView(generics.ListCreateAPIView):
     serializer_class = PlatformSerializer
@@ -225,6 +227,10 @@ class BulkBlockContactView(APIView):
                 blocked_by=request.user
             )
             blocked_list.append(blocked_contact)
-        BlockedContact.objects.bulk_create(blocked_list)
+        with transaction.atomic():
+            BlockedContact.objects.bulk_create(blocked_list)
+            # bulk_create sends no post_save, the daemons' block list cache is told here
+            for platform_id in {blocked.platform_id for blocked in blocked_list}:
+                notify_metadata_change("blockedcontact", platform_id=platform_id)
         return Response({"blocked_count": len(blocked_list)}, status=status.HTTP_201_CREATED)
 
@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class ManageUsersConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'manage_users'
+
+    def ready(self):
+        # Registers the metadata invalidation receivers
+        from manage_users import signals  # noqa: F401
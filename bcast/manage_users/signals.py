@@ -0,0 +1,21 @@
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from manage_users.models import CustomUser, EnterpriseProfile
+from manage_platform.signals import notify_metadata_change
+
+
+@receiver(post_save, sender=EnterpriseProfile)
+@receiver(post_delete, sender=EnterpriseProfile)
+def handle_enterprise_profile_changed(sender, instance, **kwargs):
+    notify_metadata_change("employee", organization_id=instance.organization_id)
+
+
+@receiver(post_save, sender=CustomUser)
+def handle_user_changed(sender, instance, update_fields=None, **kwargs):
+    # Logins only touch last_login, which the daemons do not cache
+    if update_fields is not None and set(update_fields) <= {"last_login"}:
+        return
+    organization_id = EnterpriseProfile.objects.filter(user_id=instance.id).values_list("organization_id", flat=True).first()
+    if organization_id:
+        notify_metadata_change("employee", organization_id=organization_id)